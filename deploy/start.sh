@@ -1,3 +1,4 @@
 #!/bin/bash
 
-pipenv run "python src/main.py"
\ No newline at end of file
+# exec, damit systemd den Bot direkt überwacht und Signale (z.B. beim Neustart) ankommen
+exec pipenv run python src/main.py
\ No newline at end of file
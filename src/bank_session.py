@@ -0,0 +1,184 @@
+import asyncio
+from datetime import datetime, timedelta
+from typing import Optional
+from loguru import logger
+from onvistabank_api.OnVistaApi import OnVistaApi
+
+
+# Der gemeinsame Login-Zustand des Bots gegenüber der OnVistaBank.
+#
+# Es gibt nur ein Depot (und damit nur eine Cookie-Datei), aber potentiell mehrere
+# Telegram-Benutzer, die gleichzeitig /portfolio aufrufen. Würde jeder Aufruf ein
+# eigenes API-Objekt erzeugen und sich neu einloggen, würde der zweite Login den
+# ersten (inklusive bereits generiertem OTP) ungültig machen.
+#
+# Deshalb gibt es genau ein BankSession-Objekt mit einer kleinen Zustandsmaschine:
+#
+#   - otp_pending = False: Es wird auf kein OTP gewartet, ein Login kann versucht werden.
+#   - otp_pending = True: Es wurde bereits ein OTP generiert und per SMS verschickt. Weitere
+#     Benutzer, die jetzt /portfolio aufrufen, lösen keinen neuen Login aus, sondern werden
+#     in die Warteliste (waiting_chat_ids) eingetragen. Sobald irgendein Benutzer das
+#     richtige OTP eingibt, erhalten alle wartenden Chats ihre Antwort.
+#
+# Ein OTP ist nur begrenzt gültig. Wurde es nach otp_timeout (so lange wie die Konversation in
+# main.py) noch nicht eingegeben, gilt der Zustand automatisch als zurückgesetzt, auch wenn kein
+# Chat abgebrochen hat (z.B. weil der Timeout der Konversation nicht zugestellt werden konnte).
+#
+# Alle Zustandsübergänge erfolgen unter dem asyncio-Lock, damit sich gleichzeitige
+# Anfragen nicht gegenseitig überholen.
+#
+# Außerdem merkt sich die BankSession, wann die Sitzung zuletzt als gültig bestätigt wurde
+# (last_confirmed_valid). Ein Keep-Alive im Hintergrund (siehe main.py) hält die Sitzung im
+# Abstand von keep_alive_interval am Leben. Läuft die Sitzung trotzdem zwischen zwei Prüfungen
+# ab, ist sie offenbar kürzer gültig als das Intervall, das dann halbiert wird. Nach
+# GROW_AFTER_CONFIRMATIONS Bestätigungen in Folge wird es wieder verlängert (höchstens bis zum
+# ursprünglichen Intervall), sodass ein einzelner Ausreißer nicht dauerhaft zu häufigen Prüfungen
+# führt.
+#
+# Ist niemand eingeloggt, wird seltener geprüft (siehe next_check_in()): Das Intervall verdoppelt
+# sich mit jeder erfolglosen Prüfung bis max_idle_interval. Die Prüfung ist trotzdem nötig, da
+# sich z.B. ein anderer Prozess mit demselben Session-Store eingeloggt haben kann.
+#
+# Die Cookies (und der zuletzt abgefragte Snapshot) liegen im session_store (siehe
+# onvistabank_api/SessionStore.py). Das asyncio-Lock schützt nur innerhalb dieses Prozesses, die
+# Sperre um Login und OTP-Eingabe über Prozessgrenzen hinweg übernimmt die OnVistaApi.
+class BankSession:
+    GROW_AFTER_CONFIRMATIONS = 3
+
+    def __init__(
+        self,
+        session_store,
+        login_name,
+        password,
+        keep_alive_interval=timedelta(minutes=5),
+        min_keep_alive_interval=timedelta(minutes=1),
+        max_idle_interval=timedelta(hours=1),
+        otp_timeout=timedelta(minutes=10),
+        request_budget=None,
+        transport=None,
+    ):
+        self.api = OnVistaApi(
+            None,
+            login_name,
+            password,
+            session_store=session_store,
+            request_budget=request_budget,
+            transport=transport,
+            otp_timeout=otp_timeout.total_seconds(),
+        )
+        self.lock = asyncio.Lock()
+        self.otp_timeout = otp_timeout
+        self.otp_requested_at = None
+        self.waiting_chat_ids = set()
+
+        self.keep_alive_interval = keep_alive_interval
+        self.min_keep_alive_interval = min_keep_alive_interval
+        self.max_keep_alive_interval = keep_alive_interval
+        self.max_idle_interval = max_idle_interval
+        self.idle_interval = keep_alive_interval
+        self.confirmations = 0
+        self.last_confirmed_valid = None
+        self.last_check_valid = False
+
+    # Gibt zurück, ob auf ein OTP gewartet wird. Ist das OTP inzwischen abgelaufen, wird der
+    # Zustand zurückgesetzt.
+    @property
+    def otp_pending(self):
+        if self.otp_requested_at is None:
+            return False
+
+        if datetime.now() - self.otp_requested_at >= self.otp_timeout:
+            logger.info(
+                f"OTP was not entered within {self.otp_timeout}, resetting OTP state"
+            )
+            self.otp_requested_at = None
+            self.waiting_chat_ids = set()
+            return False
+
+        return True
+
+    # Trägt einen Chat in die Warteliste für das ausstehende OTP ein.
+    def add_waiting_chat(self, chat_id):
+        self.waiting_chat_ids.add(chat_id)
+
+    # Markiert, dass ein OTP angefordert wurde, auf das nun gewartet wird. Der anfragende
+    # Chat wird direkt in die Warteliste eingetragen.
+    def start_waiting_for_otp(self, chat_id):
+        logger.info(f"Waiting for OTP, requested by chat {chat_id}")
+        self.otp_requested_at = datetime.now()
+        self.add_waiting_chat(chat_id)
+
+    # Das OTP wurde erfolgreich eingegeben. Gibt die Chats zurück, die auf den Login
+    # gewartet haben, und setzt den Zustand zurück.
+    def finish_waiting_for_otp(self):
+        waiting_chat_ids = self.waiting_chat_ids
+        self.otp_requested_at = None
+        self.waiting_chat_ids = set()
+        return waiting_chat_ids
+
+    # Ein Chat wartet nicht mehr auf das OTP (z.B. /cancel oder Timeout). Wartet danach
+    # niemand mehr, wird der OTP-Zustand verworfen, sodass der nächste /portfolio-Aufruf
+    # wieder einen neuen Login (und damit ein neues OTP) auslöst.
+    def remove_waiting_chat(self, chat_id: Optional[int]):
+        self.waiting_chat_ids.discard(chat_id)
+
+        if self.otp_pending and not self.waiting_chat_ids:
+            logger.info("No chat is waiting for the OTP anymore, resetting OTP state")
+            self.otp_requested_at = None
+
+    # Speichert das Ergebnis einer Prüfung der Sitzung. War die Sitzung bei der vorherigen
+    # Prüfung noch gültig und ist es jetzt nicht mehr, ist sie trotz Keep-Alive abgelaufen.
+    # Das Intervall wird dann halbiert (aber nicht unter min_keep_alive_interval). Gibt zurück,
+    # ob sich die Gültigkeit seit der vorherigen Prüfung geändert hat, der nächste Keep-Alive
+    # also neu geplant werden sollte.
+    def record_session_check(self, valid: bool, now: Optional[datetime] = None):
+        now = now or datetime.now()
+        changed = valid != self.last_check_valid
+
+        if valid:
+            self.last_confirmed_valid = now
+            self.idle_interval = self.keep_alive_interval
+            self.confirmations = self.confirmations + 1 if not changed else 1
+
+            if (
+                self.confirmations >= self.GROW_AFTER_CONFIRMATIONS
+                and self.keep_alive_interval < self.max_keep_alive_interval
+            ):
+                self.keep_alive_interval = min(
+                    self.keep_alive_interval * 2, self.max_keep_alive_interval
+                )
+                self.confirmations = 0
+                logger.info(
+                    f"Session confirmed repeatedly, checking every {self.keep_alive_interval} from now on"
+                )
+        elif self.last_check_valid:
+            lifetime = now - self.last_confirmed_valid
+            self.keep_alive_interval = max(
+                min(self.keep_alive_interval, lifetime) / 2,
+                self.min_keep_alive_interval,
+            )
+            self.idle_interval = self.keep_alive_interval
+            self.confirmations = 0
+            logger.info(
+                f"Session expired within {lifetime} despite keep-alive, checking every {self.keep_alive_interval} from now on"
+            )
+        else:
+            self.idle_interval = min(self.idle_interval * 2, self.max_idle_interval)
+
+        self.last_check_valid = valid
+        return changed
+
+    # Gibt zurück, wann die Sitzung das nächste Mal geprüft werden soll: im Abstand von
+    # keep_alive_interval, solange sie gültig ist, ansonsten mit wachsendem Abstand.
+    def next_check_in(self):
+        return self.keep_alive_interval if self.last_check_valid else self.idle_interval
+
+    # Gibt zurück, ob die Sitzung innerhalb des Keep-Alive-Intervalls als gültig bestätigt wurde.
+    # Dann kann auf einen erneuten Login vor einer Anfrage verzichtet werden.
+    def session_confirmed_recently(self, now: Optional[datetime] = None):
+        now = now or datetime.now()
+        return (
+            self.last_check_valid
+            and self.last_confirmed_valid is not None
+            and now - self.last_confirmed_valid < self.keep_alive_interval
+        )
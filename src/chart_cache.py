@@ -0,0 +1,102 @@
+import hashlib
+import json
+import os
+from loguru import logger
+
+
+# Ein inhaltsadressierter Zwischenspeicher für gerenderte Diagramme (siehe portfolio_chart.py).
+#
+# Der Schlüssel eines Diagramms ist ein Hash über die zugrunde liegenden Snapshots und die
+# Parameter des Diagramms (siehe chart_key()). Ändern sich die Daten nicht, ändert sich auch der
+# Schlüssel nicht und das Diagramm muss nicht erneut gerendert werden.
+#
+# Die Bilder liegen als <Schlüssel>.png im Verzeichnis directory. Überschreitet die Summe der
+# Dateigrößen max_bytes, werden die am längsten nicht mehr verwendeten Bilder gelöscht (die
+# Änderungszeit der Datei wird bei jeder Verwendung aktualisiert).
+#
+# Zusätzlich merkt sich der Zwischenspeicher die file_id, die Telegram für ein hochgeladenes Bild
+# vergibt. Damit kann dasselbe Bild erneut verschickt werden, ohne es noch einmal hochzuladen.
+class ChartCache:
+    # Maximale Anzahl gemerkter file_ids, ältere werden verworfen.
+    MAX_FILE_IDS = 1000
+
+    def __init__(self, directory, max_bytes=20 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.file_ids_file_name = os.path.join(directory, "file_ids.json")
+
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.png")
+
+    # Gibt den Pfad des Bildes zum Schlüssel zurück oder None, falls es nicht vorhanden ist.
+    def get(self, key):
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+
+        os.utime(path)
+        return path
+
+    # Legt das gerenderte Bild (PNG als bytes) unter dem Schlüssel ab und gibt den Pfad zurück.
+    def put(self, key, png):
+        path = self._path(key)
+        with open(path + ".tmp", "wb") as png_file:
+            png_file.write(png)
+        os.replace(path + ".tmp", path)
+
+        self._evict()
+        return path
+
+    # Löscht die am längsten nicht verwendeten Bilder, bis max_bytes eingehalten wird.
+    def _evict(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".png"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+
+            logger.info(f"Evicting chart {path} from the cache")
+            os.remove(path)
+            total -= size
+
+    def _load_file_ids(self):
+        try:
+            with open(self.file_ids_file_name) as file_ids_file:
+                return json.load(file_ids_file)
+        except (IOError, ValueError):
+            return {}
+
+    # Gibt die Telegram-file_id zum Schlüssel zurück oder None.
+    def get_file_id(self, key):
+        return self._load_file_ids().get(key)
+
+    # Merkt sich die Telegram-file_id zum Schlüssel. Mit file_id = None wird sie vergessen, z.B.
+    # wenn Telegram sie nicht mehr akzeptiert.
+    def put_file_id(self, key, file_id):
+        file_ids = self._load_file_ids()
+        file_ids.pop(key, None)
+        if file_id:
+            file_ids[key] = file_id
+
+        # Dictionaries behalten die Einfügereihenfolge, die ältesten Einträge stehen vorne.
+        file_ids = dict(list(file_ids.items())[-self.MAX_FILE_IDS :])
+
+        with open(self.file_ids_file_name, "w") as file_ids_file:
+            json.dump(file_ids, file_ids_file, indent=4)
+
+
+# Bildet den Schlüssel eines Diagramms aus den Snapshots und den Parametern des Diagramms.
+def chart_key(snapshots, **params):
+    digest = hashlib.sha256()
+    digest.update(json.dumps(params, sort_keys=True).encode())
+    for snapshot in snapshots:
+        digest.update(json.dumps(snapshot, sort_keys=True).encode())
+
+    return digest.hexdigest()
@@ -36,3 +36,119 @@ def get_allowed_user_ids():
     config = read_secrets()
     allowed_user_ids = config.get("secrets", "ALLOWED_USER_IDS")
     return allowed_user_ids.split(",")
+
+
+# Gibt die Benutzer-IDs der Administratoren zurück, die z.B. /profile verwenden dürfen. Diese
+# sind optional in der secrets.properties Datei definiert. Gibt eine Liste von Strings zurück.
+def get_admin_user_ids():
+    config = read_secrets()
+    admin_user_ids = config.get("secrets", "ADMIN_USER_IDS", fallback="")
+    return [user_id for user_id in admin_user_ids.split(",") if user_id]
+
+
+# Gibt zurück, ob der Bot im Webhook-Modus läuft. Standardmäßig wird Polling verwendet.
+# Der Webhook-Modus wird in der secrets.properties im Abschnitt [webhook] mit
+# WEBHOOK_ENABLED = true aktiviert.
+def is_webhook_enabled():
+    config = read_secrets()
+    return config.getboolean("webhook", "WEBHOOK_ENABLED", fallback=False)
+
+
+# Gibt die Adresse zurück, auf der der lokale HTTP-Server für den Webhook lauscht. Hinter
+# einem Reverse-Proxy, der TLS terminiert, sollte hier 127.0.0.1 stehen.
+def get_webhook_listen():
+    config = read_secrets()
+    return config.get("webhook", "WEBHOOK_LISTEN", fallback="127.0.0.1")
+
+
+# Gibt den Port zurück, auf dem der lokale HTTP-Server für den Webhook lauscht.
+def get_webhook_port():
+    config = read_secrets()
+    return config.getint("webhook", "WEBHOOK_PORT", fallback=8443)
+
+
+# Gibt den Pfad zurück, unter dem der Webhook erreichbar ist (z.B. "telegram").
+def get_webhook_url_path():
+    config = read_secrets()
+    return config.get("webhook", "WEBHOOK_URL_PATH", fallback="telegram")
+
+
+# Gibt die öffentliche URL zurück, die bei Telegram als Webhook registriert wird, also z.B. die
+# URL des Reverse-Proxys.
+def get_webhook_url():
+    config = read_secrets()
+    return config.get("webhook", "WEBHOOK_URL")
+
+
+# Gibt das geheime Token zurück, das Telegram im Header X-Telegram-Bot-Api-Secret-Token
+# mitschickt. Anfragen ohne dieses Token werden vom Webhook-Server abgelehnt.
+def get_webhook_secret_token():
+    config = read_secrets()
+    return config.get("webhook", "WEBHOOK_SECRET_TOKEN")
+
+
+# Gibt die Pfade zu Zertifikat und privatem Schlüssel zurück, falls der Webhook-Server TLS
+# selbst terminieren soll. Hinter einem Reverse-Proxy bleiben beide leer (None).
+def get_webhook_tls_files():
+    config = read_secrets()
+    cert = config.get("webhook", "WEBHOOK_TLS_CERT", fallback=None)
+    key = config.get("webhook", "WEBHOOK_TLS_KEY", fallback=None)
+    return cert, key
+
+
+# Gibt das Backend zurück, in dem die Sitzung (Cookies) und der zuletzt abgefragte Snapshot
+# gespeichert werden: file (Standard), sqlite oder redis. Siehe onvistabank_api/SessionStore.py.
+def get_session_backend():
+    config = read_secrets()
+    return config.get("storage", "SESSION_BACKEND", fallback="file")
+
+
+# Gibt den Ort der Sitzung zurück: den Dateinamen (file, sqlite) bzw. die URL des Redis-Servers
+# (redis, z.B. redis://localhost:6379/0).
+def get_session_location():
+    config = read_secrets()
+    return config.get("storage", "SESSION_LOCATION", fallback="cookies.txt")
+
+
+# Gibt die Art der HTTP-Verbindung zur Bank zurück: requests (Standard) oder httpx (mit HTTP/2).
+# Siehe onvistabank_api/HttpTransport.py.
+def get_http_transport():
+    config = read_secrets()
+    return config.get("http", "HTTP_TRANSPORT", fallback="requests")
+
+
+# Gibt die Einstellungen der HTTP-Verbindung zur Bank als Dictionary zurück, das direkt an
+# make_transport() übergeben werden kann. Nicht gesetzte Werte werden nicht übergeben, es gelten
+# dann die Standardwerte des Transports.
+def get_http_transport_options():
+    config = read_secrets()
+    options = {
+        "base_url": config.get("http", "HTTP_BASE_URL", fallback=None),
+        "pool_size": config.getint("http", "HTTP_POOL_SIZE", fallback=None),
+        "keepalive_expiry": config.getint(
+            "http", "HTTP_KEEPALIVE_EXPIRY", fallback=None
+        ),
+        "timeout": config.getint("http", "HTTP_TIMEOUT", fallback=None),
+        "compression": config.getboolean("http", "HTTP_COMPRESSION", fallback=None),
+    }
+    return {name: value for name, value in options.items() if value is not None}
+
+
+# Gibt zurück, ob die lokale JSON-API (siehe json_api.py) gestartet wird. Sie wird in der
+# secrets.properties im Abschnitt [json_api] mit JSON_API_ENABLED = true aktiviert.
+def is_json_api_enabled():
+    config = read_secrets()
+    return config.getboolean("json_api", "JSON_API_ENABLED", fallback=False)
+
+
+# Gibt den Port zurück, auf dem die JSON-API auf 127.0.0.1 lauscht.
+def get_json_api_port():
+    config = read_secrets()
+    return config.getint("json_api", "JSON_API_PORT", fallback=8765)
+
+
+# Gibt das Token zurück, das Clients der JSON-API im Header Authorization: Bearer <Token>
+# mitschicken müssen.
+def get_json_api_token():
+    config = read_secrets()
+    return config.get("json_api", "JSON_API_TOKEN")
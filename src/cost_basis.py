@@ -0,0 +1,105 @@
+from collections import defaultdict, deque
+
+# Berechnet aus der Transaktionshistorie (siehe transaction_store.py) die Kostenbasis der
+# gehaltenen Positionen und die realisierten Gewinne.
+#
+# Wie steuerlich vorgeschrieben, gelten beim Verkauf die zuerst gekauften Anteile als zuerst
+# verkauft (FIFO). Die Kosten eines Kaufs enthalten die Gebühren (amount ist bei einem Kauf der
+# insgesamt abgebuchte Betrag), der Erlös eines Verkaufs ist der gutgeschriebene Betrag nach
+# Gebühren. Als Erträge zählen nur Dividenden, Ausschüttungen und Zinsen (INCOME_TYPES), nicht
+# z.B. Einzahlungen oder Überträge.
+
+BUY_TYPES = {"BUY"}
+SELL_TYPES = {"SELL"}
+INCOME_TYPES = {"DIVIDEND", "DISTRIBUTION", "INTEREST"}
+
+
+def _cost(transaction):
+    if "amount" in transaction:
+        return abs(transaction["amount"])
+    return transaction["quantity"] * transaction["price"] + transaction.get("fees", 0)
+
+
+def _proceeds(transaction):
+    if "amount" in transaction:
+        return abs(transaction["amount"])
+    return transaction["quantity"] * transaction["price"] - transaction.get("fees", 0)
+
+
+# Gibt für alle ISINs die gehaltene Anzahl, die Kostenbasis (Summe der Kosten der noch gehaltenen
+# Anteile), den durchschnittlichen Einstandskurs, den realisierten Gewinn und die Erträge zurück,
+# außerdem die realisierten Gewinne und Erträge je Jahr.
+#
+# Beispiel:
+#
+# {
+#     'positions': [
+#         {'isin': 'LU1681045370', 'name': 'AMUNDI MSCI EMU', 'quantity': 400, 'cost_basis': 28040.0, 'average_cost': 70.1, 'realized_gain': 112.6, 'income': 48.3}
+#     ],
+#     'years': {'2024': {'realized_gain': 112.6, 'income': 48.3}},
+#     'realized_gain': 112.6,
+#     'income': 48.3
+# }
+def compute_cost_basis(transactions):
+    # ISIN -> offene Kauf-Lots als [Anzahl, Kosten je Anteil], ältestes zuerst
+    lots = defaultdict(deque)
+    names = {}
+    realized = defaultdict(float)
+    income = defaultdict(float)
+    years = defaultdict(lambda: {"realized_gain": 0.0, "income": 0.0})
+
+    for transaction in sorted(transactions, key=lambda t: (t["date"], str(t["id"]))):
+        isin = transaction.get("isin")
+        kind = transaction.get("type")
+        year = transaction["date"][:4]
+        if isin and "label" in transaction:
+            names[isin] = transaction["label"]
+
+        if kind in BUY_TYPES:
+            quantity = transaction["quantity"]
+            lots[isin].append([quantity, _cost(transaction) / quantity])
+        elif kind in SELL_TYPES:
+            remaining = transaction["quantity"]
+            cost = 0.0
+            while remaining > 0 and lots[isin]:
+                lot = lots[isin][0]
+                used = min(lot[0], remaining)
+                cost += used * lot[1]
+                lot[0] -= used
+                remaining -= used
+                if lot[0] <= 0:
+                    lots[isin].popleft()
+
+            # Verkäufe ohne bekannte Käufe (z.B. vor Beginn der Historie) haben keine Kosten.
+            gain = _proceeds(transaction) - cost
+            realized[isin] += gain
+            years[year]["realized_gain"] += gain
+        elif kind in INCOME_TYPES:
+            income[isin] += transaction.get("amount", 0)
+            years[year]["income"] += transaction.get("amount", 0)
+
+    positions = []
+    # Erträge ohne ISIN (z.B. Zinsen) fließen nur in die Summen ein.
+    for isin in sorted(
+        isin for isin in set(lots) | set(realized) | set(income) if isin
+    ):
+        quantity = sum(lot[0] for lot in lots[isin])
+        cost_basis = sum(lot[0] * lot[1] for lot in lots[isin])
+        positions.append(
+            {
+                "isin": isin,
+                "name": names.get(isin, isin),
+                "quantity": quantity,
+                "cost_basis": cost_basis,
+                "average_cost": cost_basis / quantity if quantity else 0.0,
+                "realized_gain": realized[isin],
+                "income": income[isin],
+            }
+        )
+
+    return {
+        "positions": positions,
+        "years": dict(sorted(years.items())),
+        "realized_gain": sum(realized.values()),
+        "income": sum(income.values()),
+    }
@@ -0,0 +1,106 @@
+import json
+import os
+from datetime import datetime, timedelta
+from loguru import logger
+
+
+# Der Zustand der regelmäßigen Jobs (z.B. des monatlichen Portfolio-Updates), der in einer
+# JSON-Datei gespeichert wird und damit Neustarts des Bots übersteht.
+#
+# Für jeden Job werden der Zeitpunkt der letzten Ausführung (last_run), der Zeitpunkt der
+# nächsten fälligen Ausführung (next_due), ggf. ein neuer Versuch nach einem Fehler (retry_at)
+# und ein Hash des letzten Ergebnisses (last_result_hash) gespeichert. Nach einem Neustart wird
+# der Job damit zum ursprünglich geplanten Zeitpunkt ausgeführt, statt direkt nach dem Start und
+# mit neu beginnendem Intervall. Wurden während der Ausfallzeit Ausführungen verpasst, wird nur
+# eine davon nachgeholt.
+#
+# Beispiel-Datei:
+#
+# {
+#     "send_monthly": {
+#         "last_run": "2024-03-07T21:45:31",
+#         "next_due": "2024-04-06T21:45:31",
+#         "last_result_hash": "4f0c..."
+#     }
+# }
+class JobState:
+    def __init__(self, file_name):
+        self.file_name = file_name
+
+    def _load(self):
+        try:
+            with open(self.file_name) as state_file:
+                return json.load(state_file)
+        except (IOError, ValueError) as e:
+            logger.debug(f"No job state could be read from {self.file_name}: {e}")
+            return {}
+
+    def _save(self, state):
+        with open(self.file_name + ".tmp", "w") as state_file:
+            json.dump(state, state_file, indent=4)
+
+        # Erst vollständig schreiben, dann ersetzen, damit ein Absturz beim Schreiben den
+        # bisherigen Zustand nicht zerstört.
+        os.replace(self.file_name + ".tmp", self.file_name)
+
+    # Gibt den gespeicherten Zustand eines Jobs zurück (leeres Dictionary, falls er noch nie
+    # ausgeführt wurde).
+    def get(self, name):
+        return self._load().get(name, {})
+
+    # Gibt zurück, wie lange es bis zur nächsten fälligen Ausführung des Jobs dauert. Ist sie
+    # bereits überfällig (oder wurde der Job noch nie ausgeführt), wird min_delay zurückgegeben,
+    # damit der Bot vor der Ausführung vollständig gestartet ist.
+    def due_in(self, name, min_delay=timedelta(seconds=10), now=None):
+        now = now or datetime.now()
+        job = self.get(name)
+        next_due = job.get("retry_at", job.get("next_due"))
+        if next_due is None:
+            return min_delay
+
+        return max(datetime.fromisoformat(next_due) - now, min_delay)
+
+    # Speichert eine Ausführung des Jobs. Die nächste Ausführung ist interval nach der bisher
+    # geplanten Ausführung fällig, damit sich der Rhythmus durch Verzögerungen nicht verschiebt.
+    # Wurden dabei mehrere Ausführungen verpasst, wird direkt zur nächsten in der Zukunft
+    # gesprungen. Gibt die nächste fällige Ausführung zurück.
+    def record_run(self, name, interval, result_hash=None, now=None):
+        now = now or datetime.now()
+        state = self._load()
+        job = state.get(name, {})
+
+        next_due = datetime.fromisoformat(job.get("next_due", now.isoformat()))
+        while next_due <= now:
+            next_due += interval
+
+        job["last_run"] = now.isoformat(timespec="seconds")
+        job["next_due"] = next_due.isoformat(timespec="seconds")
+        job.pop("retry_at", None)
+        if result_hash is not None:
+            job["last_result_hash"] = result_hash
+
+        state[name] = job
+        self._save(state)
+
+        logger.info(
+            f"Job {name} ran at {job['last_run']}, next run at {job['next_due']}"
+        )
+        return next_due
+
+    # Plant nach einem Fehler einen neuen Versuch in delay (retry_at). Die regulär geplante
+    # Ausführung (next_due) bleibt dabei unverändert, der Rhythmus verschiebt sich also nicht.
+    # Gibt den Zeitpunkt des neuen Versuchs zurück.
+    def retry_later(self, name, delay, now=None):
+        now = now or datetime.now()
+        state = self._load()
+        job = state.get(name, {})
+
+        job["last_run"] = now.isoformat(timespec="seconds")
+        job["retry_at"] = (now + delay).isoformat(timespec="seconds")
+        job.setdefault("next_due", job["last_run"])
+
+        state[name] = job
+        self._save(state)
+
+        logger.info(f"Job {name} failed, retrying at {job['retry_at']}")
+        return now + delay
@@ -0,0 +1,181 @@
+import hashlib
+import hmac
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+from loguru import logger
+from onvistabank_api.OnVistaApi import OnVistaApi
+from snapshot_store import SnapshotStore, get_latest_snapshot
+
+# Die Felder einer Position, die /positions/<ISIN> je Snapshot in der Historie zurückgibt.
+POSITION_HISTORY_FIELDS = [
+    "quantity",
+    "lastValue",
+    "actualValue",
+    "totalPerformance",
+    "performancePercentage",
+]
+
+
+# Eine lokale, nur lesende JSON-API für andere Programme (Dashboards, Tabellenkalkulationen,
+# Hausautomatisierung), die das Depot auslesen möchten, ohne sich selbst bei der Bank einzuloggen.
+#
+# Alle Antworten kommen ausschließlich aus den vorhandenen Daten: dem zuletzt abgefragten Snapshot
+# im Session-Store (siehe onvistabank_api/SessionStore.py) und der Historie in der SnapshotStore.
+# Eine Anfrage an die JSON-API löst also nie einen Request an die Bank aus.
+#
+# Der Server lauscht nur auf 127.0.0.1 und verlangt das konfigurierte Token im Header
+# Authorization: Bearer <Token>. Endpunkte:
+#
+#   GET /snapshot                          -> der neueste Snapshot
+#   GET /history?since=...&until=...       -> alle Snapshots im Zeitraum (ISO-Zeitstempel, optional)
+#   GET /positions/<ISIN>                  -> die Position in allen Konten im neuesten Snapshot
+#                                             und ihre Entwicklung über die Historie
+#
+# Jede Antwort hat ein ETag, das nur vom Stand der Daten (Änderungszeit und Größe der Historie,
+# Zeitstempel des Snapshots im Session-Store) und der URL abhängt. Schickt der Client dieses ETag
+# in If-None-Match mit und hat sich nichts geändert, wird ohne Laden der Daten mit 304 geantwortet.
+class JsonApiServer:
+    def __init__(
+        self, api: OnVistaApi, snapshot_store: SnapshotStore, token, port=8765
+    ):
+        self.api = api
+        self.snapshot_store = snapshot_store
+        self.token = token
+        self.port = port
+        self.server = None
+
+    # Startet den Server in einem eigenen Thread.
+    def start(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", self.port), _JsonApiHandler)
+        self.server.json_api = self
+        threading.Thread(
+            target=self.server.serve_forever, name="json-api", daemon=True
+        ).start()
+        logger.info(f"JSON API listening on http://127.0.0.1:{self.port}/")
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+
+    # Prüft das Token aus dem Authorization-Header (in konstanter Zeit).
+    def is_authorized(self, authorization):
+        if not self.token or not authorization.startswith("Bearer "):
+            return False
+        return hmac.compare_digest(authorization[len("Bearer ") :], self.token)
+
+    # Gibt das ETag für eine URL zum aktuellen Stand der Daten zurück.
+    def etag(self, url):
+        try:
+            stat = os.stat(self.snapshot_store.file_name)
+            history_version = f"{stat.st_mtime_ns}:{stat.st_size}"
+        except OSError:
+            history_version = "-"
+
+        shared_snapshot = self.api.load_snapshot()
+        shared_version = shared_snapshot["timestamp"] if shared_snapshot else "-"
+
+        version = f"{url}|{history_version}|{shared_version}"
+        return '"' + hashlib.sha256(version.encode()).hexdigest()[:32] + '"'
+
+    # Gibt für eine URL den Statuscode und die Antwort (als JSON-fähiges Objekt) zurück.
+    def respond(self, path, query):
+        if path == "/snapshot":
+            snapshot = get_latest_snapshot(self.api, self.snapshot_store)
+            if snapshot is None:
+                return 404, {"error": "no snapshot available"}
+            return 200, snapshot
+
+        if path == "/history":
+            since = query.get("since", [None])[0]
+            until = query.get("until", [None])[0]
+            return 200, self.snapshot_store.load(since, until)
+
+        if path.startswith("/positions/"):
+            return self.position(path[len("/positions/") :].upper())
+
+        return 404, {"error": f"unknown endpoint {path}"}
+
+    def position(self, isin):
+        latest = get_latest_snapshot(self.api, self.snapshot_store)
+        if latest is None:
+            return 404, {"error": "no snapshot available"}
+
+        current = [
+            {"account": entry["account"]["iban"], **position}
+            for entry in latest["accounts"]
+            for position in entry["portfolio"]["positions"]
+            if position["isin"] == isin
+        ]
+        if not current:
+            return 404, {"error": f"position {isin} not found"}
+
+        history = []
+        for snapshot in self.snapshot_store.load():
+            positions = [
+                position
+                for entry in snapshot["accounts"]
+                for position in entry["portfolio"]["positions"]
+                if position["isin"] == isin
+            ]
+            if positions:
+                history.append(
+                    {
+                        "timestamp": snapshot["timestamp"],
+                        **{
+                            field: sum(position.get(field, 0) for position in positions)
+                            for field in POSITION_HISTORY_FIELDS
+                        },
+                    }
+                )
+
+        return 200, {
+            "timestamp": latest["timestamp"],
+            "isin": isin,
+            "positions": current,
+            "history": history,
+        }
+
+
+class _JsonApiHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        json_api = self.server.json_api
+
+        if not json_api.is_authorized(self.headers.get("Authorization", "")):
+            self._send(401, {"error": "unauthorized"})
+            return
+
+        url = urlparse(self.path)
+        etag = json_api.etag(self.path)
+        if etag in self.headers.get("If-None-Match", ""):
+            self._send(304, None, etag)
+            return
+
+        try:
+            status, data = json_api.respond(url.path.rstrip("/"), parse_qs(url.query))
+        except Exception as e:
+            logger.error(f"JSON API request {url.path} failed: {e}")
+            status, data = 500, {"error": str(e)}
+
+        self._send(status, data, etag if status == 200 else None)
+
+    def _send(self, status, data, etag=None):
+        body = json.dumps(data).encode() if data is not None else b""
+
+        self.send_response(status)
+        if etag:
+            self.send_header("ETag", etag)
+            self.send_header("Cache-Control", "no-cache")
+        if status != 304:
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if status != 304:
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(f"JSON API: {format % args}")
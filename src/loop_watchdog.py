@@ -0,0 +1,129 @@
+import asyncio
+import os
+import socket
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from loguru import logger
+
+
+# Sendet eine Statusmeldung (z.B. READY=1 oder WATCHDOG=1) an systemd. Läuft der Bot nicht als
+# systemd-Dienst mit Type=notify, ist NOTIFY_SOCKET nicht gesetzt und es passiert nichts. Das
+# Protokoll ist ein einzelnes Datagramm an einen Unix-Socket, daher wird kein zusätzliches Paket
+# (wie systemd-python) benötigt.
+def sd_notify(state):
+    address = os.environ.get("NOTIFY_SOCKET")
+    if not address:
+        return False
+
+    # Ein führendes @ steht für einen Socket im abstrakten Namensraum.
+    if address.startswith("@"):
+        address = "\0" + address[1:]
+
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as notify_socket:
+            notify_socket.sendto(state.encode(), address)
+        return True
+    except OSError as e:
+        logger.warning(f"Notifying systemd ({state}) failed: {e}")
+        return False
+
+
+# Überwacht die Verzögerung (Lag) der asyncio-Event-Loop.
+#
+# Die Requests an die Bank und andere langsame Aufrufe laufen in eigenen Threads (siehe
+# run_in_thread() in main.py) und halten die Event-Loop nicht auf. Der Watchdog erkennt daher die
+# Aufrufe, die versehentlich doch direkt in der Event-Loop blockieren (z.B. Datei-Zugriffe oder
+# Berechnungen), sowie eine hängende Event-Loop. Blockiert ein Aufruf zu lange, beantwortet der
+# Bot in dieser Zeit keine Befehle. Ein hängender Thread fällt dagegen nicht auf, die Event-Loop
+# läuft dabei ja weiter. Der Watchdog besteht aus zwei Teilen:
+#
+#   - run() läuft in der Event-Loop und schläft jeweils interval Sekunden. Wacht er später auf als
+#     geplant, ist die Differenz der Lag. Die letzten samples Messwerte werden für die Perzentile
+#     (siehe stats()) gespeichert. Bei jedem pünktlichen Durchlauf wird außerdem systemd
+#     benachrichtigt (WATCHDOG=1). Hängt die Event-Loop, bleibt die Benachrichtigung aus und
+#     systemd startet den Dienst nach WatchdogSec neu.
+#   - Ein eigener Thread prüft, ob run() länger als threshold Sekunden nicht mehr gelaufen ist.
+#     Dann wird der Stack der Event-Loop geloggt, also genau die Stelle, die die Loop gerade
+#     blockiert.
+class LoopWatchdog:
+    def __init__(self, interval=0.5, threshold=2.0, samples=2000):
+        self.interval = interval
+        self.threshold = threshold
+        self.lags = deque(maxlen=samples)
+        self.stalls = 0
+        self.last_tick = None
+        self.loop_thread_id = None
+
+        # systemd gibt das Intervall in WATCHDOG_USEC vor. Benachrichtigt wird doppelt so oft.
+        watchdog_usec = os.environ.get("WATCHDOG_USEC")
+        self.notify_interval = int(watchdog_usec) / 2e6 if watchdog_usec else None
+        self.last_notify = 0.0
+
+    # Misst dauerhaft den Lag der Event-Loop, in der diese Coroutine läuft.
+    async def run(self):
+        self.loop_thread_id = threading.get_ident()
+        self.last_tick = time.monotonic()
+        threading.Thread(
+            target=self._monitor, name="loop-watchdog", daemon=True
+        ).start()
+
+        while True:
+            started_at = time.monotonic()
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+
+            self.lags.append(max(now - started_at - self.interval, 0.0))
+            self.last_tick = now
+
+            if self.notify_interval and now - self.last_notify >= self.notify_interval:
+                sd_notify("WATCHDOG=1")
+                self.last_notify = now
+
+    # Läuft in einem eigenen Thread und loggt den Stack der Event-Loop, sobald sie länger als
+    # threshold blockiert ist (einmal je Blockade).
+    def _monitor(self):
+        reported_tick = None
+        while True:
+            time.sleep(self.interval / 2)
+            tick = self.last_tick
+            blocked = time.monotonic() - tick
+
+            if blocked < self.threshold or tick == reported_tick:
+                continue
+
+            reported_tick = tick
+            self.stalls += 1
+            frame = sys._current_frames().get(self.loop_thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame else "(unknown)"
+            logger.warning(
+                f"Event loop blocked for {blocked:.1f}s, currently running:\n{stack}"
+            )
+
+    # Gibt die Perzentile (50, 90, 99) und das Maximum des Lags (in Sekunden) über die letzten
+    # Messwerte sowie die Anzahl der geloggten Blockaden zurück.
+    def stats(self):
+        lags = sorted(self.lags)
+        if not lags:
+            return {
+                "samples": 0,
+                "p50": 0.0,
+                "p90": 0.0,
+                "p99": 0.0,
+                "max": 0.0,
+                "stalls": self.stalls,
+            }
+
+        def percentile(p):
+            return lags[min(int(len(lags) * p / 100), len(lags) - 1)]
+
+        return {
+            "samples": len(lags),
+            "p50": percentile(50),
+            "p90": percentile(90),
+            "p99": percentile(99),
+            "max": lags[-1],
+            "stalls": self.stalls,
+        }
@@ -2,33 +2,150 @@ from telegram import Update
 from telegram.ext import (
     ApplicationBuilder,
     CommandHandler,
+    CallbackQueryHandler,
     ContextTypes,
     ConversationHandler,
     MessageHandler,
+    TypeHandler,
     filters,
     Application,
 )
-from config import get_allowed_user_ids, get_telegram_token
-from onvistabank_api.OnVistaApi import OnVistaApiOTPRequiredException
-from onvistabank_api.OnVistaLowLevelApi import OnVistaOTPIsWrongException
-from datetime import timedelta
+from config import (
+    get_allowed_user_ids,
+    get_admin_user_ids,
+    get_telegram_token,
+    is_webhook_enabled,
+    get_webhook_listen,
+    get_webhook_port,
+    get_webhook_url_path,
+    get_webhook_url,
+    get_webhook_secret_token,
+    get_webhook_tls_files,
+    get_session_backend,
+    get_session_location,
+    get_http_transport,
+    get_http_transport_options,
+    is_json_api_enabled,
+    get_json_api_port,
+    get_json_api_token,
+)
+from onvistabank_api.OnVistaLowLevelApi import (
+    OnVistaException,
+    OnVistaAccessDeniedException,
+)
+from datetime import datetime, timedelta
 from loguru import logger
-import random
+import argparse
+import hashlib
+import re
 import asyncio
-from onvistabank_api.OnVistaApi import OnVistaApi
 from config import get_onvistabank_username, get_onvistabank_password
-from typing import Optional
+from bank_session import BankSession
+from onvistabank_api.SessionStore import make_session_store
+from onvistabank_api.HttpTransport import make_transport
+from onvistabank_api.RequestBudget import (
+    RequestBudget,
+    request_priority,
+    SCHEDULED,
+    BACKGROUND,
+)
 import telegram.ext as tg_ext
+from transaction_store import TransactionStore
+from cost_basis import compute_cost_basis
+from snapshot_store import (
+    SnapshotStore,
+    fetch_snapshot,
+    get_latest_snapshot,
+    get_shared_snapshot,
+)
+from position_index import PositionIndex
+from portfolio_analytics import analyze
+from portfolio_chart import MAX_POSITIONS, render_portfolio_chart
+from chart_cache import ChartCache, chart_key
+from telegram.error import BadRequest
+from json_api import JsonApiServer
+from loop_watchdog import LoopWatchdog, sd_notify
+from profiling import Profiler
+from job_state import JobState
+from portfolio_pages import CALLBACK_PREFIX, overview_page, page_for_callback
 from portfolio_message import (
-    get_portfolio_message_markdown,
+    get_snapshot_message_markdown,
+    get_analytics_message_markdown,
+    get_quotes_message_markdown,
+    get_position_message_markdown,
+    escape_markdown,
+    get_cost_basis_message_markdown,
+    ensure_login,
     OTPRequiredException,
     OTPWrongException,
 )
 
-# Das API-Objekt für die OnVistaBank-API
-# es wird in der portfolio()-Funktion initialisiert und in der reply_with_otp()-Funktion verwendet,
-# ist also global.
-api = None
+# Der gemeinsame Login-Zustand gegenüber der OnVistaBank. Es gibt nur ein Depot und damit nur
+# einen Login, der von allen Benutzern (und ggf. weiteren Prozessen mit demselben Session-Store)
+# gemeinsam verwendet wird. Siehe bank_session.py.
+#
+# Alle Requests an die Bank laufen über ein gemeinsames Budget (siehe RequestBudget.py), bei dem
+# die Befehle der Benutzer Vorrang vor den geplanten Jobs und dem Keep-Alive haben.
+#
+# Ein angefordertes OTP muss innerhalb von OTP_TIMEOUT eingegeben werden, so lange läuft auch die
+# Konversation (siehe portfolio_with_otp_handler).
+OTP_TIMEOUT = timedelta(minutes=10)
+request_budget = RequestBudget()
+bank_session = BankSession(
+    make_session_store(get_session_backend(), get_session_location()),
+    get_onvistabank_username(),
+    get_onvistabank_password(),
+    otp_timeout=OTP_TIMEOUT,
+    request_budget=request_budget,
+    transport=make_transport(get_http_transport(), **get_http_transport_options()),
+)
+
+# Die Historie aller abgefragten Snapshots des Depots, siehe snapshot_store.py. Sie ist die
+# Grundlage für /analytics.
+snapshot_store = SnapshotStore("snapshots.jsonl")
+
+# Der Suchindex über die Positionen des neuesten Snapshots für /position, siehe position_index.py.
+position_index = PositionIndex()
+
+# So viele Positionen werden bei /position höchstens angezeigt.
+MAX_POSITION_RESULTS = 5
+
+# Die Transaktions- und Orderhistorie, siehe transaction_store.py. Sie ist die Grundlage für /sync.
+transaction_store = TransactionStore("history.db")
+
+# Der gespeicherte Zustand der regelmäßigen Jobs, siehe job_state.py. Das monatliche
+# Portfolio-Update wird alle 30 Tage verschickt, nach einem Fehler wird es einen Tag später
+# erneut versucht.
+job_state = JobState("jobs.json")
+MONTHLY_JOB = "send_monthly"
+MONTHLY_INTERVAL = timedelta(days=30)
+MONTHLY_RETRY_DELAY = timedelta(days=1)
+
+# Der Name des Keep-Alive-Jobs, siehe schedule_keep_alive().
+KEEP_ALIVE_JOB = "keep_alive"
+
+# So lange vor dem monatlichen Update wird der Snapshot bereits abgefragt.
+PREWARM_LEAD = timedelta(minutes=5)
+
+# Ein Snapshot aus dem Session-Store, der höchstens so alt ist, wird von /analytics verwendet,
+# statt einen neuen abzufragen (siehe get_shared_snapshot()).
+SHARED_SNAPSHOT_MAX_AGE = timedelta(minutes=5)
+
+# Das Profiling im laufenden Betrieb, siehe profiling.py und /profile. profiling_job ist der Job,
+# der ein Profiling mit Zeitfenster beendet.
+profiler = Profiler()
+profiling_job = None
+
+# Misst die Verzögerung der Event-Loop, loggt blockierende Aufrufe und benachrichtigt den
+# systemd-Watchdog, siehe loop_watchdog.py.
+loop_watchdog = LoopWatchdog()
+
+# Die gerenderten Diagramme für /chart, siehe chart_cache.py.
+chart_cache = ChartCache("charts")
+
+# So viele Tage zeigt /chart standardmäßig bzw. höchstens an.
+DEFAULT_CHART_DAYS = 365
+MAX_CHART_DAYS = 3650
 
 # Es wird eine kurze Konversation mit dem Benutzer geführt, für den Fall, dass der Benutzer eine TAN eingeben muss. Im
 # Grundfall wird das Portfolio einfach angezeigt, aber wenn der Server eine TAN anfordert, wird diese Konversation
@@ -37,156 +154,806 @@ api = None
 REPLY_WITH_OTP = 1
 
 
-# Start der Konversation, wenn der Benutzer /portfolio aufruft. Rückgabewert entscheidet,
-# ob die Konversation mit der Eingabe der TAN fortgesetzt oder beendet wird.
-async def portfolio(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    global api
-    # Wir lassen nur geladene Gäste rein. ;-)
+# Wir lassen nur geladene Gäste rein. ;-) Gibt False zurück und informiert den Benutzer, wenn er
+# nicht berechtigt ist.
+async def check_allowed_user(update: Update) -> bool:
     if not update.effective_user or not str(update.effective_user.id) in (
         get_allowed_user_ids()
     ):
         logger.info(
             f"User {update.effective_user.id} tried to access the portfolio, but is not allowed. (allowed are {get_allowed_user_ids()}))"
         )
-        await update.message.reply_text(
+        await update.effective_message.reply_text(
             f"Sorry {update.effective_user.first_name}, I'm not allowed to send you any confidential information."
         )
-        return ConversationHandler.END
+        return False
 
-    api = OnVistaApi(
-        "cookies.txt", get_onvistabank_username(), get_onvistabank_password()
-    )
+    return True
+
+
+# Alle Requests an die Bank laufen in den Befehlen (wie in den Jobs) mit asyncio.to_thread() in
+# einem eigenen Thread. Wartet ein Request auf das Request-Budget oder antwortet die Bank langsam,
+# bearbeitet der Bot in der Zwischenzeit weiterhin die Befehle anderer Benutzer und die Jobs.
+# Läuft gerade ein Profiling, wird der Aufruf im Thread mitprofiliert (siehe Profiler.call()).
+async def run_in_thread(func, *args, **kwargs):
+    return await asyncio.to_thread(profiler.call, func, *args, **kwargs)
+
+
+# Führt einen Befehl aus, der einen bestehenden Login voraussetzt (z.B. /quote). Es wird kein
+# Login ausgelöst, dafür ist /portfolio (mit ggf. OTP-Eingabe) zuständig. Wird gerade auf ein OTP
+# gewartet, ist die Sitzung abgelaufen oder tritt ein anderer Fehler auf, wird der Benutzer
+# informiert.
+async def run_with_session(update: Update, command) -> None:
+    if bank_session.otp_pending:
+        await update.effective_message.reply_text(
+            "Es wird auf ein OTP (One-Time-Passwort) gewartet. Bitte zuerst mit /portfolio einloggen."
+        )
+        return
 
     try:
-        await update.message.reply_markdown_v2(get_portfolio_message_markdown(api))
-    except OTPRequiredException:
-        await update.message.reply_text(
-            f"Der Server hat ein OTP (One-Time-Passwort) angefordert. Bitte geben Sie es ein:"
+        await command()
+    except OnVistaAccessDeniedException:
+        await update.effective_message.reply_text(
+            "Die Sitzung ist abgelaufen. Bitte zuerst mit /portfolio einloggen."
         )
-        return REPLY_WITH_OTP
     except Exception as e:
         logger.error(f"An unknown error occured: {e}")
-        await update.message.reply_text(f"Ein unbekannter Fehler ist aufgetreten: {e}")
+        await update.effective_message.reply_text(
+            f"Ein unbekannter Fehler ist aufgetreten: {e}"
+        )
+
+
+# Start der Konversation, wenn der Benutzer /portfolio aufruft. Rückgabewert entscheidet,
+# ob die Konversation mit der Eingabe der TAN fortgesetzt oder beendet wird.
+async def portfolio(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    if not await check_allowed_user(update):
+        return ConversationHandler.END
+
+    chat_id = update.effective_chat.id
+
+    async with bank_session.lock:
+        # Ein anderer Benutzer hat bereits einen Login ausgelöst und es wird auf das OTP gewartet. Ein
+        # erneuter Login würde das bereits verschickte OTP ungültig machen, daher wird nur gewartet.
+        if bank_session.otp_pending:
+            bank_session.add_waiting_chat(chat_id)
+            await update.message.reply_text(
+                f"Es wird bereits auf ein OTP (One-Time-Passwort) gewartet, es wurde kein neues angefordert. Bitte das per SMS erhaltene OTP eingeben oder warten, bis ein anderer Benutzer es eingegeben hat:"
+            )
+            return REPLY_WITH_OTP
+
+        try:
+            # Hat der Keep-Alive die Sitzung gerade erst bestätigt, wird direkt abgefragt und
+            # nur bei einer abgelaufenen Sitzung doch noch ein Login durchgeführt.
+            try:
+                if not bank_session.session_confirmed_recently():
+                    await run_in_thread(ensure_login, bank_session.api)
+                text, keyboard = await run_in_thread(
+                    overview_page, bank_session.api, context.chat_data
+                )
+            except OnVistaAccessDeniedException:
+                await run_in_thread(ensure_login, bank_session.api)
+                text, keyboard = await run_in_thread(
+                    overview_page, bank_session.api, context.chat_data
+                )
+
+            if bank_session.record_session_check(True):
+                schedule_keep_alive(context.job_queue)
+            await update.message.reply_markdown_v2(text, reply_markup=keyboard)
+        except OTPRequiredException:
+            bank_session.start_waiting_for_otp(chat_id)
+            await update.message.reply_text(
+                f"Der Server hat ein OTP (One-Time-Passwort) angefordert. Bitte geben Sie es ein:"
+            )
+            return REPLY_WITH_OTP
+        except Exception as e:
+            logger.error(f"An unknown error occured: {e}")
+            await update.message.reply_text(
+                f"Ein unbekannter Fehler ist aufgetreten: {e}"
+            )
 
     return ConversationHandler.END
 
 
 # Konversation: Der Benutzer muss nun mit dem OTP antworten, danach wird diese Methode aufgerufen.
 async def reply_with_otp(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    global api
-    # Wir lassen nur geladene Gäste rein. ;-)
-    if not update.effective_user or not str(update.effective_user.id) in (
-        get_allowed_user_ids()
-    ):
-        logger.info(
-            f"User {update.effective_user.id} tried to access the portfolio, but is not allowed.  (allowed are {get_allowed_user_ids()})"
+    if not await check_allowed_user(update):
+        return ConversationHandler.END
+
+    chat_id = update.effective_chat.id
+
+    async with bank_session.lock:
+        # Ein anderer Benutzer hat das OTP in der Zwischenzeit bereits eingegeben, die Antwort
+        # wurde diesem Chat dann bereits zugestellt.
+        if not bank_session.otp_pending:
+            await update.message.reply_text(
+                f"Der Login ist bereits erfolgt, das OTP wurde nicht benötigt. (Mit /portfolio kann das Portfolio erneut abgerufen werden.)"
+            )
+            return ConversationHandler.END
+
+        otp = update.message.text
+        await update.message.reply_text(f"Login wird mit folgendem OTP versucht: {otp}")
+
+        try:
+            await run_in_thread(ensure_login, bank_session.api, otp)
+        except OTPRequiredException:
+            await update.message.reply_text(
+                f"Das eingegebene OTP (One-Time-Passwort) war falsch. Die Konversation kann mit /cancel abgebrochen werden. Bitte OTP eingeben:"
+            )
+            return REPLY_WITH_OTP
+        except OTPWrongException:
+            await update.message.reply_text(
+                f"Das eingegebene OTP (One-Time-Passwort) war falsch. Die Konversation kann mit /cancel abgebrochen werden. Bitte OTP eingeben:"
+            )
+            return REPLY_WITH_OTP
+        except Exception as e:
+            logger.error(f"An unknown error occured: {e}")
+            bank_session.remove_waiting_chat(chat_id)
+            await update.message.reply_text(
+                f"Ein unbekannter Fehler ist aufgetreten: {e}"
+            )
+            return ConversationHandler.END
+
+        # Alle Chats, die auf diesen Login gewartet haben, erhalten nun ebenfalls das Portfolio.
+        waiting_chat_ids = bank_session.finish_waiting_for_otp()
+        if bank_session.record_session_check(True):
+            schedule_keep_alive(context.job_queue)
+
+        try:
+            for waiting_chat_id in {chat_id} | waiting_chat_ids:
+                logger.info(f"Sending portfolio to waiting chat {waiting_chat_id}...")
+                text, keyboard = await run_in_thread(
+                    overview_page,
+                    bank_session.api,
+                    context.application.chat_data[waiting_chat_id],
+                )
+                await context.bot.send_message(
+                    chat_id=waiting_chat_id,
+                    text=text,
+                    parse_mode="MarkdownV2",
+                    reply_markup=keyboard,
+                )
+        except Exception as e:
+            logger.error(f"An unknown error occured: {e}")
+            await update.message.reply_text(
+                f"Ein unbekannter Fehler ist aufgetreten: {e}"
+            )
+
+    return ConversationHandler.END
+
+
+# Ein Button der Portfolio-Ansicht wurde gedrückt. Die angeforderte Seite wird abgefragt und
+# die bestehende Nachricht damit ersetzt. Siehe portfolio_pages.py.
+async def portfolio_page(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    if not await check_allowed_user(update):
+        await query.answer()
+        return
+
+    await query.answer()
+
+    if bank_session.otp_pending:
+        await query.edit_message_text(
+            "Es wird auf ein OTP (One-Time-Passwort) gewartet. Bitte zuerst mit /portfolio einloggen."
+        )
+        return
+
+    try:
+        text, keyboard = await run_in_thread(
+            page_for_callback, bank_session.api, context.chat_data, query.data
         )
+    except OnVistaException as e:
+        logger.info(f"Loading portfolio page {query.data} failed: {e}")
+        await query.edit_message_text(
+            "Die Sitzung ist abgelaufen. Mit /portfolio kann sie erneut gestartet werden."
+        )
+        return
+    except Exception as e:
+        logger.error(f"An unknown error occured: {e}")
+        await query.edit_message_text(f"Ein unbekannter Fehler ist aufgetreten: {e}")
+        return
+
+    await query.edit_message_text(text, parse_mode="MarkdownV2", reply_markup=keyboard)
+
+
+# Der Benutzer hat /quote ISIN [ISIN ...] aufgerufen. Die Kurse werden gemeinsam in einem Request
+# abgefragt, kürzlich abgefragte Kurse kommen aus dem Zwischenspeicher. Es wird kein Login
+# ausgelöst, dafür ist /portfolio (mit ggf. OTP-Eingabe) zuständig.
+async def quote(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not await check_allowed_user(update):
+        return
+
+    isins = [isin.upper() for isin in context.args]
+    if not isins or not all(
+        re.fullmatch(r"[A-Z]{2}[A-Z0-9]{10}", isin) for isin in isins
+    ):
         await update.message.reply_text(
-            f"Sorry {update.effective_user.first_name}, I'm not allowed to send you any confidential information."
+            "Bitte eine oder mehrere ISINs angeben, z.B. /quote LU1681045370 IE00B4L5Y983"
         )
-        return ConversationHandler.END
+        return
 
-    otp = update.message.text
-    await update.message.reply_text(f"Login wird mit folgendem OTP versucht: {otp}")
+    async def reply_with_quotes():
+        quotes = await run_in_thread(bank_session.api.get_quotes, isins)
+        await update.message.reply_markdown_v2(get_quotes_message_markdown(quotes))
 
-    try:
-        await update.message.reply_markdown_v2(get_portfolio_message_markdown(api, otp))
-    except OTPRequiredException:
+    await run_with_session(update, reply_with_quotes)
+
+
+# Fragt einen aktuellen Snapshot ab, legt ihn in der Historie ab und wertet diese aus. Wurde
+# gerade erst ein Snapshot abgefragt (ggf. von einem anderen Prozess), wird dieser verwendet und
+# nicht erneut angehängt. Das Abfragen, Laden und Auswerten läuft in einem eigenen Thread.
+def analyze_latest_snapshot():
+    snapshot = get_shared_snapshot(bank_session.api, max_age=SHARED_SNAPSHOT_MAX_AGE)
+    if snapshot is None:
+        snapshot = fetch_snapshot(bank_session.api)
+
+    snapshot_store.append_if_new(snapshot)
+    return analyze(snapshot_store.load())
+
+
+# Der Benutzer hat /analytics aufgerufen. Es wird ein aktueller Snapshot abgefragt, in der
+# Historie gespeichert und zusammen mit allen bisherigen Snapshots ausgewertet. Wie /quote
+# setzt der Befehl einen bestehenden Login voraus.
+async def analytics(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not await check_allowed_user(update):
+        return
+
+    async def reply_with_analytics():
+        analytics = await run_in_thread(analyze_latest_snapshot)
+        await update.message.reply_markdown_v2(
+            get_analytics_message_markdown(analytics)
+        )
+
+    await run_with_session(update, reply_with_analytics)
+
+
+# Der Benutzer hat /sync aufgerufen. Die Transaktions- und Orderhistorie wird mit der Bank
+# abgeglichen (nur die neuen Einträge, siehe transaction_store.py) und daraus die Kostenbasis und
+# die realisierten Gewinne berechnet. Wie /quote setzt der Befehl einen bestehenden Login voraus.
+#
+# Der Abgleich kann (vor allem beim ersten Mal) viele Requests benötigen. Er läuft daher in einem
+# eigenen Thread und mit der Priorität der geplanten Jobs, damit er andere Befehle nicht aufhält.
+async def sync(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not await check_allowed_user(update):
+        return
+
+    async def reply_with_cost_basis():
+        with request_priority(SCHEDULED):
+            added = await run_in_thread(transaction_store.sync, bank_session.api)
+
+        cost_basis = await run_in_thread(
+            compute_cost_basis, transaction_store.entries("transactions")
+        )
+        await update.message.reply_markdown_v2(
+            get_cost_basis_message_markdown(added, cost_basis)
+        )
+
+    await run_with_session(update, reply_with_cost_basis)
+
+
+# Liest den neuesten Snapshot für den Suchindex von /position. Jeder abgefragte Snapshot
+# (/analytics, das monatliche Update, ggf. auch von einem anderen Prozess) liegt im Session-Store,
+# es muss also nur dieser gelesen werden. Nur beim ersten Aufruf wird zusätzlich die Historie
+# gelesen, falls der Session-Store noch keinen Snapshot enthält.
+def load_position_snapshot():
+    if position_index.timestamp is None:
+        return get_latest_snapshot(bank_session.api, snapshot_store)
+    return bank_session.api.load_snapshot()
+
+
+# Bringt den Suchindex für /position auf den Stand des neuesten Snapshots. Nur das Lesen läuft
+# in einem eigenen Thread, der Index selbst wird nur in der Event-Loop geändert.
+async def refresh_position_index():
+    snapshot = await run_in_thread(load_position_snapshot)
+    if snapshot is not None:
+        changes = position_index.update(snapshot)
+        if any(changes.values()):
+            logger.info(
+                f"Position index updated to snapshot {snapshot['timestamp']}: {changes}"
+            )
+
+
+# Der Benutzer hat /position Suchbegriff aufgerufen. Gesucht wird nach ISIN, WKN oder Name im
+# neuesten Snapshot (siehe position_index.py), es wird also kein Request an die Bank ausgelöst
+# und auch kein Login vorausgesetzt.
+async def position(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not await check_allowed_user(update):
+        return
+
+    query = " ".join(context.args)
+    if not query:
         await update.message.reply_text(
-            f"Das eingegebene OTP (One-Time-Passwort) war falsch. Die Konversation kann mit /cancel abgebrochen werden. Bitte OTP eingeben:"
+            "Bitte eine ISIN, WKN oder einen Namen angeben, z.B. /position LU1681045370 oder /position msci"
         )
-        return REPLY_WITH_OTP
-    except OTPWrongException:
+        return
+
+    await refresh_position_index()
+    if position_index.timestamp is None:
         await update.message.reply_text(
-            f"Das eingegebene OTP (One-Time-Passwort) war falsch. Die Konversation kann mit /cancel abgebrochen werden. Bitte OTP eingeben:"
+            "Es liegt noch kein Snapshot vor. Snapshots werden z.B. mit /analytics erstellt."
+        )
+        return
+
+    results = position_index.search(query)
+    if not results:
+        await update.message.reply_text(f"Keine Position gefunden für: {query}")
+        return
+
+    message = escape_markdown(f"Stand: {position_index.timestamp}\n")
+    for i, account, found in results[:MAX_POSITION_RESULTS]:
+        message += "\n" + get_position_message_markdown(i, account, found)
+    if len(results) > MAX_POSITION_RESULTS:
+        message += escape_markdown(
+            f"\n... und {len(results) - MAX_POSITION_RESULTS} weitere Treffer\n"
         )
-        return REPLY_WITH_OTP
+
+    await update.message.reply_markdown_v2(message)
+
+
+# Lädt die Snapshots der letzten days Tage und sucht das Diagramm dazu im ChartCache. Gibt
+# (Snapshots, Schlüssel, file_id, Pfad) zurück, file_id und Pfad sind None, falls nicht vorhanden.
+# Bei weniger als zwei Snapshots ist auch der Schlüssel None.
+#
+# Bei einer langen Historie dauern das Laden und das Hashen der Snapshots (siehe chart_key())
+# mehrere Sekunden, daher läuft das in einem eigenen Thread (wie auch das Rendern).
+def load_chart(days):
+    since = (datetime.now() - timedelta(days=days)).isoformat(timespec="seconds")
+    snapshots = snapshot_store.load(since=since)
+    if len(snapshots) < 2:
+        return snapshots, None, None, None
+
+    key = chart_key(snapshots, chart="portfolio", max_positions=MAX_POSITIONS)
+    return snapshots, key, chart_cache.get_file_id(key), chart_cache.get(key)
+
+
+# Rendert das Diagramm und legt es im ChartCache ab. Gibt den Pfad zurück.
+def render_chart(key, snapshots):
+    logger.info(f"Rendering chart {key}...")
+    return chart_cache.put(key, render_portfolio_chart(snapshots))
+
+
+# Der Benutzer hat /chart [Tage] aufgerufen. Das Diagramm wird aus der gespeicherten Historie der
+# Snapshots gerendert, es wird also kein Request an die Bank ausgelöst. Wurde dasselbe Diagramm
+# (gleiche Daten, gleiche Parameter) bereits verschickt, wird es über die file_id von Telegram
+# erneut verschickt, ansonsten wird es aus dem ChartCache geladen oder neu gerendert.
+async def chart(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not await check_allowed_user(update):
+        return
+
+    days = (
+        int(context.args[0])
+        if context.args and context.args[0].isdigit()
+        else DEFAULT_CHART_DAYS
+    )
+    if not 0 < days <= MAX_CHART_DAYS:
+        await update.message.reply_text(
+            f"Bitte eine Anzahl an Tagen zwischen 1 und {MAX_CHART_DAYS} angeben, z.B. /chart 90"
+        )
+        return
+
+    try:
+        snapshots, key, file_id, path = await run_in_thread(load_chart, days)
+
+        if key is None:
+            await update.message.reply_text(
+                "Für ein Diagramm werden mindestens zwei Snapshots benötigt. Snapshots werden z.B. mit /analytics erstellt."
+            )
+            return
+
+        caption = f"Entwicklung der letzten {days} Tage ({len(snapshots)} Snapshots)"
+
+        if file_id:
+            try:
+                await update.message.reply_photo(file_id, caption=caption)
+                return
+            except BadRequest as e:
+                logger.info(f"Telegram rejected cached file_id for chart {key}: {e}")
+                await run_in_thread(chart_cache.put_file_id, key, None)
+
+        if path is None:
+            path = await run_in_thread(render_chart, key, snapshots)
+
+        with open(path, "rb") as png_file:
+            message = await update.message.reply_photo(png_file, caption=caption)
+
+        await run_in_thread(chart_cache.put_file_id, key, message.photo[-1].file_id)
     except Exception as e:
         logger.error(f"An unknown error occured: {e}")
         await update.message.reply_text(f"Ein unbekannter Fehler ist aufgetreten: {e}")
 
-    return ConversationHandler.END
-
 
 # Konversation: Der Benutzer hat mit /cancel abgebrochen.
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    async with bank_session.lock:
+        bank_session.remove_waiting_chat(update.effective_chat.id)
+
     await update.message.reply_text(
         f"Die Konversation wurde vom Benutzer abgebrochen. (Mit /portfolio kann sie erneut gestartet werden.)"
     )
     return ConversationHandler.END
 
 
-# Konversation: Der Benutzer hat zu lange gebraucht, um das OTP einzugeben.
+# Konversation: Der Benutzer hat zu lange gebraucht, um das OTP einzugeben. Übergeben wird das
+# letzte Update der Konversation, hat der Benutzer gar nicht geantwortet, ist das der Aufruf von
+# /portfolio selbst.
 async def timeout(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    await update.message.reply_text(
+    async with bank_session.lock:
+        bank_session.remove_waiting_chat(update.effective_chat.id)
+
+    await update.effective_message.reply_text(
         f"Die Eingabe des OTP (One-Time-Passwort) hat zu lange gedauert. Die Konversation wird abgebrochen. "
     )
     return ConversationHandler.END
 
 
+# Plant die nächste Ausführung des monatlichen Portfolio-Updates. Der Zeitpunkt stammt aus dem
+# gespeicherten Job-Zustand (siehe job_state.py), sodass ein Neustart den Rhythmus nicht
+# zurücksetzt und nicht jedes Mal ein Login ausgelöst wird.
+def schedule_monthly(job_queue) -> None:
+    delay = job_state.due_in(MONTHLY_JOB)
+    logger.info(f"Next monthly portfolio update in {delay}")
+    job_queue.run_once(send_monthly, when=delay, name=MONTHLY_JOB)
+
+    # Kurz vorher wird der Snapshot bereits abgefragt, solange die Sitzung sicher noch gültig ist.
+    if delay > PREWARM_LEAD:
+        job_queue.run_once(prewarm_snapshot, when=delay - PREWARM_LEAD)
+
+
+# Plant den nächsten Keep-Alive (siehe keep_alive()) und ersetzt dabei einen bereits geplanten.
+# Nach einem Login wird so nicht erst der lange Abstand abgewartet, der gilt, solange niemand
+# eingeloggt ist.
+def schedule_keep_alive(job_queue) -> None:
+    for job in job_queue.get_jobs_by_name(KEEP_ALIVE_JOB):
+        job.schedule_removal()
+    job_queue.run_once(
+        keep_alive, when=bank_session.next_check_in(), name=KEEP_ALIVE_JOB
+    )
+
+
+# Hält die Sitzung bei der Bank im Hintergrund am Leben, damit /portfolio nicht erst einen
+# Login (und ggf. ein OTP) benötigt. Das Intervall passt die BankSession an die beobachtete
+# Gültigkeitsdauer der Sitzung an, daher plant sich der Job jedes Mal selbst neu ein.
+#
+# Die Requests der Jobs laufen in einem eigenen Thread und mit niedrigerer Priorität (siehe
+# RequestBudget.py), damit sie die Befehle der Benutzer nicht aufhalten. Die Prüfung läuft unter
+# dem Lock der BankSession, damit ein gleichzeitiger Login sie nicht verfälscht.
+async def keep_alive(context: tg_ext.CallbackContext) -> None:
+    try:
+        async with bank_session.lock:
+            # Während auf ein OTP gewartet wird, wird nicht geprüft.
+            if not bank_session.otp_pending:
+                with request_priority(BACKGROUND):
+                    valid = await run_in_thread(bank_session.api.is_session_valid)
+                bank_session.record_session_check(valid)
+    except Exception as e:
+        logger.error(f"Keep-alive failed: {e}")
+    finally:
+        schedule_keep_alive(context.job_queue)
+
+
+# Fragt kurz vor dem monatlichen Update den Snapshot ab, solange die Sitzung gültig ist. Das
+# Update selbst muss dann keinen Login und keine Abfrage mehr durchführen.
+async def prewarm_snapshot(context: tg_ext.CallbackContext) -> None:
+    try:
+        async with bank_session.lock:
+            if bank_session.otp_pending:
+                logger.info("Pre-warming snapshot skipped, waiting for OTP.")
+                return
+
+            with request_priority(BACKGROUND):
+                if not await run_in_thread(bank_session.api.is_session_valid):
+                    logger.info("Pre-warming snapshot skipped, session is not valid.")
+                    return
+
+                await run_in_thread(fetch_snapshot, bank_session.api)
+            logger.info("Snapshot pre-warmed for the monthly portfolio update.")
+    except Exception as e:
+        logger.error(f"Pre-warming snapshot failed: {e}")
+
+
 # Diese Methode wird alle 30 Tage aufgerufen und verschickt das monatliche Portfolio-Update, sofern der
 # Benutzer eingeloggt ist. Dies wird aus den Cookies ermittelt.
 async def send_monthly(context: tg_ext.CallbackContext):
     logger.info("Sending monthly portfolio update...")
 
     try:
-        api = OnVistaApi(
-            "cookies.txt", get_onvistabank_username(), get_onvistabank_password()
-        )
+        async with bank_session.lock:
+            # Ein Login während ein Benutzer gerade das OTP eingibt, würde dieses ungültig machen.
+            if bank_session.otp_pending:
+                logger.info("Sending portfolio update postponed, waiting for OTP.")
+                job_state.retry_later(MONTHLY_JOB, timedelta(hours=1))
+                return
 
-        portfolio_message = get_portfolio_message_markdown(api)
+            # Wurde der Snapshot kurz vorher (ggf. von einem anderen Prozess) abgefragt, wird er
+            # direkt verwendet. Ansonsten wird kein OTP per SMS angefordert, da niemand darauf
+            # wartet.
+            snapshot = await run_in_thread(
+                get_shared_snapshot, bank_session.api, max_age=2 * PREWARM_LEAD
+            )
+            if snapshot is None:
+                with request_priority(SCHEDULED):
+                    await run_in_thread(
+                        ensure_login, bank_session.api, auto_generate_otp=False
+                    )
+                    snapshot = await run_in_thread(fetch_snapshot, bank_session.api)
 
-        for user_id in get_allowed_user_ids():
-            logger.info(f"Sending portfolio update to user {user_id}...")
-            await context.bot.send_message(
-                chat_id=user_id, text=portfolio_message, parse_mode="MarkdownV2"
+        await run_in_thread(snapshot_store.append_if_new, snapshot)
+        portfolio_message = get_snapshot_message_markdown(snapshot)
+
+        # Wurde genau diese Nachricht bereits verschickt (z.B. bei einem Neustart direkt nach
+        # dem Versand), wird sie nicht noch einmal verschickt.
+        result_hash = hashlib.sha256(portfolio_message.encode()).hexdigest()
+        if result_hash == job_state.get(MONTHLY_JOB).get("last_result_hash"):
+            logger.info(
+                "Portfolio update unchanged since the last run, not sending it."
             )
-    except OnVistaApiOTPRequiredException:
+        else:
+            for user_id in get_allowed_user_ids():
+                logger.info(f"Sending portfolio update to user {user_id}...")
+                await context.bot.send_message(
+                    chat_id=user_id, text=portfolio_message, parse_mode="MarkdownV2"
+                )
+
+        job_state.record_run(MONTHLY_JOB, MONTHLY_INTERVAL, result_hash)
+    except OTPRequiredException:
         logger.info("Sending portfolio update failed, OTP required.")
+        job_state.retry_later(MONTHLY_JOB, MONTHLY_RETRY_DELAY)
 
         for user_id in get_allowed_user_ids():
-            await context
+            await context.bot.send_message(
+                chat_id=user_id,
+                text=f"Für das monatliche Portfolio-Update ist ein Login mit OTP (One-Time-Passwort) notwendig. Bitte /portfolio aufrufen.",
+            )
     except Exception as e:
         logger.error(f"Sending portfolio update failed: {e}")
+        job_state.retry_later(MONTHLY_JOB, MONTHLY_RETRY_DELAY)
 
         for user_id in get_allowed_user_ids():
             await context.bot.send_message(
                 chat_id=user_id,
                 text=f"Beim Versenden des monatlichen Portfolio-Updates ist ein Fehler aufgetreten: {e}",
             )
+    finally:
+        schedule_monthly(context.job_queue)
+
+
+# Nur Administratoren dürfen z.B. das Profiling starten. Gibt False zurück und informiert den
+# Benutzer, wenn er nicht berechtigt ist.
+async def check_admin_user(update: Update) -> bool:
+    if not update.effective_user or not str(update.effective_user.id) in (
+        get_admin_user_ids()
+    ):
+        logger.info(
+            f"User {update.effective_user.id} tried to use an admin command, but is not allowed. (admins are {get_admin_user_ids()})"
+        )
+        await update.effective_message.reply_text(
+            f"Sorry {update.effective_user.first_name}, this command is only available for admins."
+        )
+        return False
+
+    return True
+
+
+# Beendet das laufende Profiling und verschickt den Bericht als Datei an den Chat, der es
+# gestartet hat. Wurde es über die Kommandozeile gestartet, wird der Bericht stattdessen in eine
+# Datei im aktuellen Verzeichnis geschrieben.
+async def deliver_profile_report(bot) -> None:
+    global profiling_job
+
+    # Wurde das Profiling vorzeitig beendet, darf der Job kein späteres Profiling beenden.
+    if profiling_job is not None:
+        profiling_job.schedule_removal()
+        profiling_job = None
+
+    chat_id = profiler.report_chat_id
+    report = profiler.stop()
+    file_name = f"profile-{datetime.now().strftime('%Y%m%d-%H%M%S')}.txt"
+
+    if chat_id is None:
+        with open(file_name, "w") as report_file:
+            report_file.write(report)
+        logger.info(f"Profiling report written to {file_name}")
+        return
+
+    await bot.send_document(
+        chat_id=chat_id, document=report.encode(), filename=file_name
+    )
+
+
+# Das Zeitfenster des Profilings ist abgelaufen.
+async def finish_profiling(context: tg_ext.CallbackContext) -> None:
+    global profiling_job
+    profiling_job = None
+
+    if profiler.running:
+        await deliver_profile_report(context.bot)
+
 
+# Umschließt einen Handler, sodass seine Ausführung profiliert wird, falls gerade ein Profiling
+# für die nächsten N Ausführungen läuft (siehe /profile).
+def profiled(handler):
+    async def profiled_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        with profiler.run():
+            result = await handler(update, context)
 
-# Hiermit kann das Menü für den Bot in Telegram gesetzt werden.
+        if profiler.finished:
+            await deliver_profile_report(context.bot)
+
+        return result
+
+    return profiled_handler
+
+
+# Der Administrator hat /profile aufgerufen. Varianten:
+#
+#   /profile          -> die nächsten 5 Ausführungen von /portfolio profilieren
+#   /profile 3        -> die nächsten 3 Ausführungen von /portfolio profilieren
+#   /profile 60s      -> alles in den nächsten 60 Sekunden profilieren
+#   /profile stop     -> das laufende Profiling sofort beenden und den Bericht verschicken
+async def profile(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    global profiling_job
+
+    if not await check_admin_user(update):
+        return
+
+    argument = context.args[0] if context.args else "5"
+
+    if argument == "stop":
+        if not profiler.running:
+            await update.message.reply_text("Es läuft kein Profiling.")
+            return
+        await deliver_profile_report(context.bot)
+        return
+
+    if profiler.running:
+        await update.message.reply_text(
+            "Es läuft bereits ein Profiling. Mit /profile stop kann es beendet werden."
+        )
+        return
+
+    if re.fullmatch(r"\d+s", argument):
+        seconds = int(argument[:-1])
+        profiler.start(seconds=seconds, report_chat_id=update.effective_chat.id)
+        profiling_job = context.job_queue.run_once(finish_profiling, when=seconds)
+        await update.message.reply_text(
+            f"Profiling läuft für {seconds} Sekunden, danach wird der Bericht verschickt."
+        )
+    elif argument.isdigit() and int(argument) > 0:
+        profiler.start(runs=int(argument), report_chat_id=update.effective_chat.id)
+        await update.message.reply_text(
+            f"Die nächsten {argument} Ausführungen von /portfolio werden profiliert, danach wird der Bericht verschickt."
+        )
+    else:
+        await update.message.reply_text(
+            "Aufruf: /profile [Anzahl | Sekunden mit s, z.B. 60s | stop]"
+        )
+
+
+# Der Administrator hat /stats aufgerufen. Zeigt je Prioritätsklasse, wie viele Requests an die
+# Bank gestellt wurden, wie viele davon auf das Request-Budget warten mussten (mit
+# durchschnittlicher und maximaler Wartezeit) und wie viele abgelehnt wurden. Außerdem die
+# Verzögerung der Event-Loop (siehe loop_watchdog.py).
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not await check_admin_user(update):
+        return
+
+    budget_stats = request_budget.stats()
+
+    message = f"Request-Budget: {budget_stats['tokens']:.1f} von {request_budget.burst} Tokens frei\n"
+    for name, metrics in budget_stats["classes"].items():
+        message += (
+            f"\n{name}: {metrics['requests']} Requests, {metrics['waited']} mit Wartezeit "
+            f"(Ø {metrics['wait_average']:.2f}s, max. {metrics['wait_max']:.2f}s), "
+            f"{metrics['rejected']} abgelehnt"
+        )
+
+    lag = loop_watchdog.stats()
+    message += (
+        f"\n\nEvent-Loop-Lag ({lag['samples']} Messungen): p50 {lag['p50'] * 1000:.0f} ms, "
+        f"p90 {lag['p90'] * 1000:.0f} ms, p99 {lag['p99'] * 1000:.0f} ms, "
+        f"max. {lag['max'] * 1000:.0f} ms, {lag['stalls']} Blockaden"
+    )
+
+    await update.message.reply_text(message)
+
+
+# Hiermit kann das Menü für den Bot in Telegram gesetzt werden. Außerdem wird der Watchdog der
+# Event-Loop gestartet und systemd mitgeteilt, dass der Bot bereit ist (Type=notify).
 async def post_init(application: Application) -> None:
     await application.bot.set_my_commands(
         [
             ("portfolio", "Zeigt alle verknüpften Konten und deren Performance an."),
+            ("quote", "Zeigt die aktuellen Kurse zu den angegebenen ISINs an."),
+            ("analytics", "Wertet die Entwicklung des Depots aus."),
+            ("chart", "Zeigt die Entwicklung des Depots als Diagramm an."),
+            ("position", "Sucht eine Position nach ISIN, WKN oder Name."),
+            (
+                "sync",
+                "Gleicht die Transaktionen ab und zeigt Kostenbasis und Gewinne an.",
+            ),
             ("cancel", "Bricht eine bestehende Konversation ab."),
         ]
     )
 
+    application.create_task(loop_watchdog.run())
+    sd_notify("READY=1")
+
+
+# Das Profiling kann auch direkt beim Start über die Kommandozeile aktiviert werden, der Bericht
+# wird dann in eine Datei im aktuellen Verzeichnis geschrieben.
+argument_parser = argparse.ArgumentParser()
+argument_parser.add_argument(
+    "--profile-runs",
+    type=int,
+    help="Profiliert die ersten N Ausführungen von /portfolio.",
+)
+argument_parser.add_argument(
+    "--profile-seconds",
+    type=int,
+    help="Profiliert die ersten N Sekunden nach dem Start.",
+)
+arguments = argument_parser.parse_args()
 
 app = ApplicationBuilder().token(get_telegram_token()).post_init(post_init).build()
 
 # Siehe hierzu auch die Dokumentation der python-telegram-bot-Bibliothek:
 portfolio_with_otp_handler = ConversationHandler(
-    entry_points=[CommandHandler("portfolio", portfolio)],
+    entry_points=[CommandHandler("portfolio", profiled(portfolio))],
     states={
         REPLY_WITH_OTP: [
             MessageHandler(filters.TEXT & ~filters.COMMAND, reply_with_otp)
         ],
-        ConversationHandler.TIMEOUT: [
-            MessageHandler(filters.TEXT & ~filters.COMMAND, timeout)
-        ],
+        ConversationHandler.TIMEOUT: [TypeHandler(Update, timeout)],
     },
     fallbacks=[CommandHandler("cancel", cancel)],
     # Maximal 10 Minuten, das ist mehr als genug Zeit, um eine TAN einzugeben.
-    conversation_timeout=timedelta(seconds=60 * 10),
+    conversation_timeout=OTP_TIMEOUT,
 )
 
-p = app.job_queue.run_repeating(
-    send_monthly, interval=timedelta(days=30), first=timedelta(seconds=10)
-)
+schedule_monthly(app.job_queue)
+schedule_keep_alive(app.job_queue)
 
 app.add_handler(portfolio_with_otp_handler)
-app.run_polling()
+app.add_handler(CommandHandler("quote", quote))
+app.add_handler(CommandHandler("analytics", analytics))
+app.add_handler(CommandHandler("chart", chart))
+app.add_handler(CommandHandler("position", position))
+app.add_handler(CommandHandler("sync", sync))
+app.add_handler(CommandHandler("profile", profile))
+app.add_handler(CommandHandler("stats", stats))
+app.add_handler(
+    CallbackQueryHandler(profiled(portfolio_page), pattern=f"^{CALLBACK_PREFIX}")
+)
+
+if arguments.profile_runs:
+    profiler.start(runs=arguments.profile_runs)
+elif arguments.profile_seconds:
+    profiler.start(seconds=arguments.profile_seconds)
+    profiling_job = app.job_queue.run_once(
+        finish_profiling, when=arguments.profile_seconds
+    )
+
+# Die lokale JSON-API für andere Programme liest nur die vorhandenen Snapshots, siehe json_api.py.
+if is_json_api_enabled():
+    JsonApiServer(
+        bank_session.api, snapshot_store, get_json_api_token(), get_json_api_port()
+    ).start()
+
+if is_webhook_enabled():
+    # Telegram schickt die Updates per HTTPS an uns, statt dass wir sie per Long-Polling abholen.
+    # Der lokale HTTP-Server prüft dabei den Header X-Telegram-Bot-Api-Secret-Token.
+    webhook_cert, webhook_key = get_webhook_tls_files()
+
+    logger.info(
+        f"Starting webhook on {get_webhook_listen()}:{get_webhook_port()}/{get_webhook_url_path()}"
+    )
+    app.run_webhook(
+        listen=get_webhook_listen(),
+        port=get_webhook_port(),
+        url_path=get_webhook_url_path(),
+        secret_token=get_webhook_secret_token(),
+        webhook_url=get_webhook_url(),
+        cert=webhook_cert,
+        key=webhook_key,
+    )
+else:
+    app.run_polling()
@@ -0,0 +1,168 @@
+import importlib.util
+
+import certifi
+import requests as req
+from loguru import logger
+from requests.adapters import HTTPAdapter
+from requests.cookies import cookiejar_from_dict
+from urllib3.util.retry import Retry
+
+# Der Endpunkt der Webtrading-API.
+DEFAULT_BASE_URL = "https://webtrading.onvista-bank.de/services/api/"
+
+
+# Gibt die Kompressionsverfahren zurück, die für Accept-Encoding angeboten werden. Brotli (br)
+# wird nur angeboten, wenn das Paket brotli installiert ist, da die Antwort sonst nicht entpackt
+# werden kann.
+def _accept_encoding():
+    if importlib.util.find_spec("brotli"):
+        return "gzip, deflate, br"
+    return "gzip, deflate"
+
+
+# Die Transports kapseln die HTTP-Verbindung der OnVistaLowLevelApi, damit sie konfiguriert und
+# ausgetauscht werden kann. Jeder Transport bietet dieselben Methoden:
+#
+#   - post(params, data, headers): schickt einen POST-Request an base_url und gibt die Antwort als
+#     JSON zurück
+#   - get_cookies() / set_cookies(cookies): die Cookies der Sitzung als Dictionary
+#   - last_response_bytes: die Größe der letzten Antwort, wie sie übertragen wurde (also ggf.
+#     komprimiert), z.B. für transport_benchmark.py
+#
+# Gemeinsame Parameter:
+#
+#   - base_url: der Endpunkt der API (z.B. ein lokaler Ersatz-Server zum Testen)
+#   - pool_size: die maximale Anzahl gleichzeitig offener Verbindungen
+#   - keepalive_expiry: wie lange (in Sekunden) eine unbenutzte Verbindung offen gehalten wird
+#   - timeout: Timeout (in Sekunden) für Verbindungsaufbau und Antwort
+#   - compression: ob komprimierte Antworten angefordert werden (Accept-Encoding)
+#
+# Verbindungsfehler beim Aufbau werden mit kurzer Wartezeit wiederholt. Ein bereits gesendeter
+# Request wird dagegen nie wiederholt, da z.B. ein Login oder die Prüfung eines OTP nicht
+# doppelt ausgeführt werden darf.
+
+
+# Der Standard-Transport mit requests (HTTP/1.1 mit Keep-Alive).
+#
+# requests schließt unbenutzte Verbindungen nicht selbst nach einer festen Zeit, keepalive_expiry
+# wird daher nur vom HttpxTransport unterstützt.
+class RequestsTransport:
+    def __init__(
+        self,
+        base_url=DEFAULT_BASE_URL,
+        pool_size=4,
+        keepalive_expiry=None,
+        timeout=30,
+        compression=True,
+    ):
+        self.base_url = base_url
+        self.timeout = timeout
+        self.last_response_bytes = None
+
+        self.session = req.Session()
+        self.session.verify = certifi.where()
+        self.session.headers["Accept-Encoding"] = (
+            _accept_encoding() if compression else "identity"
+        )
+
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=pool_size,
+            max_retries=Retry(
+                total=None, connect=3, read=0, status=0, backoff_factor=0.5
+            ),
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def post(self, params, data, headers):
+        response = self.session.post(
+            self.base_url,
+            params=params,
+            data=data,
+            headers=headers,
+            timeout=self.timeout,
+        )
+        # tell() liefert die Anzahl der gelesenen Bytes vor dem Entpacken
+        self.last_response_bytes = response.raw.tell()
+        return response.json()
+
+    def get_cookies(self):
+        return self.session.cookies.get_dict()
+
+    def set_cookies(self, cookies):
+        self.session.cookies = cookiejar_from_dict(cookies)
+
+
+# Ein Transport mit httpx. Mit http2 = True werden alle Requests über eine einzige
+# HTTP/2-Verbindung gebündelt (Multiplexing), sofern der Server es unterstützt (über TLS per ALPN
+# ausgehandelt, ansonsten wird HTTP/1.1 verwendet).
+#
+# httpx (und für HTTP/2 zusätzlich h2) wird nur für diesen Transport benötigt und daher erst hier
+# importiert. Fehlt h2, wird mit einer Warnung HTTP/1.1 verwendet.
+class HttpxTransport:
+    def __init__(
+        self,
+        base_url=DEFAULT_BASE_URL,
+        pool_size=4,
+        keepalive_expiry=30,
+        timeout=30,
+        compression=True,
+        http2=True,
+    ):
+        import httpx
+
+        if http2 and not importlib.util.find_spec("h2"):
+            logger.warning("Package h2 is not installed, using HTTP/1.1")
+            http2 = False
+
+        self.base_url = base_url
+        self.last_response_bytes = None
+        self.client = httpx.Client(
+            timeout=timeout,
+            transport=httpx.HTTPTransport(
+                http2=http2,
+                verify=certifi.where(),
+                limits=httpx.Limits(
+                    max_connections=pool_size,
+                    max_keepalive_connections=pool_size,
+                    keepalive_expiry=keepalive_expiry,
+                ),
+                retries=3,
+            ),
+            headers={
+                "Accept-Encoding": _accept_encoding() if compression else "identity"
+            },
+        )
+
+    def post(self, params, data, headers):
+        # Header ohne Wert (z.B. X-XSRF-TOKEN vor dem ersten Request) werden wie bei requests
+        # nicht gesendet.
+        response = self.client.post(
+            self.base_url,
+            params=params,
+            data=data,
+            headers={
+                name: value for name, value in headers.items() if value is not None
+            },
+        )
+        self.last_response_bytes = response.num_bytes_downloaded
+        logger.debug(f"Response via {response.http_version}")
+        return response.json()
+
+    def get_cookies(self):
+        return dict(self.client.cookies)
+
+    def set_cookies(self, cookies):
+        self.client.cookies.clear()
+        self.client.cookies.update(cookies)
+
+
+# Erzeugt den Transport der konfigurierten Art (requests oder httpx).
+def make_transport(kind="requests", **options):
+    if kind == "requests":
+        return RequestsTransport(**options)
+    if kind == "httpx":
+        return HttpxTransport(**options)
+
+    raise ValueError(f"Unknown HTTP transport {kind}")
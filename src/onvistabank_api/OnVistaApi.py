@@ -1,7 +1,14 @@
 import logging as log
+import uuid
 from loguru import logger
 from requests.cookies import cookiejar_from_dict
-from onvistabank_api.OnVistaLowLevelApi import OnVistaLowLevelApi
+from onvistabank_api.OnVistaLowLevelApi import (
+    OnVistaLowLevelApi,
+    OnVistaException,
+    OnVistaAccessDeniedException,
+    OnVistaPerformanceDataError,
+)
+from onvistabank_api.QuoteCache import QuoteCache
 
 
 class OnVistaApiOTPRequiredException(Exception):
@@ -9,6 +16,13 @@ class OnVistaApiOTPRequiredException(Exception):
         super().__init__("An OTP (One-Time-Password) is required to continue.")
 
 
+# Ein anderer Prozess (bzw. eine andere Instanz) mit demselben session_store hat bereits ein OTP
+# angefordert, das noch nicht eingegeben wurde. Es wird kein neuer Login durchgeführt, das bereits
+# per SMS verschickte OTP kann aber wie gewohnt mit enterOTP() eingegeben werden.
+class OnVistaApiOTPPendingException(OnVistaApiOTPRequiredException):
+    pass
+
+
 # Eine etwas höherlevelige API für den Online-Broker OnVistaBank.
 #
 # Sie kann in zwei Modi verwendet werden, je nachdem ob der Parameter
@@ -17,15 +31,40 @@ class OnVistaApiOTPRequiredException(Exception):
 # der otp_callback aufgerufen, wenn ein OTP benötigt wird. Wenn er nicht
 # gesetzt ist, muss der Login-Prozess manuell durchgeführt werden. Dafür
 # ist der Prozess flexibler.
+#
+# Mit session_store (siehe SessionStore.py) teilen sich mehrere Prozesse bzw.
+# Rechner eine Sitzung. Login und OTP-Eingabe laufen dann unter einer
+# gemeinsamen Sperre, und ein Login findet nur statt, wenn die gemeinsame
+# Sitzung nicht ohnehin schon gültig ist. Zwischen dem Anfordern und der
+# Eingabe eines OTP (höchstens otp_timeout Sekunden) wird außerdem im
+# session_store vermerkt, dass auf das OTP gewartet wird, damit kein anderer
+# Prozess in dieser Zeit einen neuen Login auslöst.
 class OnVistaApi:
-    def __init__(self, cookies_file_name, loginName, password, otp_callback=None):
-        self.api = OnVistaLowLevelApi(cookies_file_name)
+    def __init__(
+        self,
+        cookies_file_name,
+        loginName,
+        password,
+        otp_callback=None,
+        session_store=None,
+        request_budget=None,
+        transport=None,
+        otp_timeout=600,
+    ):
+        self.api = OnVistaLowLevelApi(
+            cookies_file_name, session_store, request_budget, transport
+        )
         self.loginName = loginName
         self.password = password
         self.otp_callback = otp_callback
+        self.otp_timeout = otp_timeout
+        self.instance_id = uuid.uuid4().hex
+        self.quote_cache = QuoteCache()
 
     # Einloggen im System. Wenn ein OTP benötigt wird, wird eine
-    # OnVistaApiOTPRequiredException geworfen.
+    # OnVistaApiOTPRequiredException geworfen. Wartet ein anderer Prozess
+    # bereits auf ein OTP, wird stattdessen (ohne Login) eine
+    # OnVistaApiOTPPendingException geworfen.
     #
     # Ist auto_generate_otp = True, wird automatisch ein OTP generiert
     # falls einer benötigt wird. Danach muss er mittels enterOTP() eingegeben
@@ -44,17 +83,34 @@ class OnVistaApi:
     def login(self, auto_generate_otp=True):
         logger.info("Login with username {} requested...", self.loginName)
 
-        self.api.session_auth_refresh()
+        with self.api.session_store.lock("login"):
+            # Ein anderer Prozess kann sich inzwischen eingeloggt haben. Dann wird dessen
+            # Sitzung verwendet, statt sie durch einen erneuten Login ungültig zu machen.
+            if self.is_session_valid():
+                logger.info("Session is already valid, login skipped")
+                return
 
-        logger.info("Login with username {}", self.loginName)
-        login_result = self.api.login(self.loginName, self.password)
+            # Ein neuer Login würde das OTP, auf das ein anderer Prozess wartet, ungültig machen.
+            if self._otp_pending_elsewhere():
+                logger.info("Another process is waiting for an OTP, login skipped")
+                raise OnVistaApiOTPPendingException()
 
-        if login_result["otpInfo"]["hasToPassOtp"]:
-            if auto_generate_otp:
-                self.generateOTP()
+            logger.info("Login with username {}", self.loginName)
+            login_result = self.api.login(self.loginName, self.password)
+
+            if login_result["otpInfo"]["hasToPassOtp"]:
+                if auto_generate_otp:
+                    self.generateOTP()
+
+                logger.info("Login was attempted, but OTP is required")
+                raise OnVistaApiOTPRequiredException()
 
-            logger.info("Login was attempted, but OTP is required")
-            raise OnVistaApiOTPRequiredException()
+    # Prüft mit dem günstigsten Request (Session_Auth.refresh), ob die Sitzung noch gültig ist,
+    # der Benutzer also eingeloggt ist und kein OTP benötigt wird. Der Request hält die Sitzung
+    # zugleich am Leben.
+    def is_session_valid(self):
+        result = self.api.session_auth_refresh()
+        return bool(result.get("user")) and not result["otpInfo"]["hasToPassOtp"]
 
     # Generiert eine OTP (One-Time-Password) und sendet sie per SMS an den
     # Benutzer. Muss aufgerufen werden nachdem eine OnVistaApiOTPRequiredException
@@ -62,25 +118,44 @@ class OnVistaApi:
     # wird sie automatisch von login() aufgerufen.
     def generateOTP(self):
         logger.info("Generate One-Time-Password (OTP)")
-        return self.api.generateOTP()
+        result = self.api.generateOTP()
+        self.api.session_store.set_otp_pending(self.instance_id, self.otp_timeout)
+        return result
 
-    # OTP in das System eingeben, sodass der Benutzer authentifiziert werden kann.
+    # OTP in das System eingeben, sodass der Benutzer authentifiziert werden kann. Das OTP kann
+    # auch von einem anderen Prozess mit demselben session_store angefordert worden sein.
     def enterOTP(self, otpToken):
         logger.info(f"Check One-Time-Password (OTP): Supplied is {otpToken}")
-        return self.api.checkOTP(otpToken)
+        with self.api.session_store.lock("login"):
+            result = self.api.checkOTP(otpToken)
+            self.api.session_store.clear_otp_pending()
+            return result
+
+    # Gibt zurück, ob ein anderer Prozess auf die Eingabe eines OTP wartet.
+    def _otp_pending_elsewhere(self):
+        owner = self.api.session_store.otp_pending_owner()
+        return owner is not None and owner != self.instance_id
 
     def _autologin_if_needed(self):
-        self.api.session_auth_refresh()
-        login_result = self.api.login(self.loginName, self.password)
+        with self.api.session_store.lock("login"):
+            if self.is_session_valid():
+                return
+
+            # Wartet ein anderer Prozess auf ein OTP, wird kein neuer Login durchgeführt, sondern
+            # direkt das bereits verschickte OTP abgefragt.
+            if not self._otp_pending_elsewhere():
+                login_result = self.api.login(self.loginName, self.password)
+                if not login_result["otpInfo"]["hasToPassOtp"]:
+                    return
 
-        if login_result["otpInfo"]["hasToPassOtp"]:
-            log.info("Generate One-Time-Password (OTP)")
-            self.api.generateOTP()
+                log.info("Generate One-Time-Password (OTP)")
+                self.generateOTP()
 
             token = self.otp_callback()
 
             log.info(f"Check One-Time-Password (OTP): Supplied is {token}")
             self.api.checkOTP(token)
+            self.api.session_store.clear_otp_pending()
 
     def _try_with_autologin(self, block):
         try:
@@ -114,3 +189,73 @@ class OnVistaApi:
     # des eingeloggten Benutzers zurück.
     def trading_positions(self, account_key):
         return self.api.tradingPositions(account_key)
+
+    # Gibt die aktuellen Kurse zu den übergebenen ISINs als Dictionary ISIN -> Kurs zurück.
+    #
+    # Kurse, die sich noch im Zwischenspeicher (siehe QuoteCache) befinden, werden nicht erneut
+    # abgefragt. Alle übrigen ISINs werden gemeinsam in einem einzigen Request abgefragt.
+    #
+    # Schlägt die Abfrage einzelner ISINs fehl (z.B. unbekannte ISIN), ist deren Wert die
+    # OnVistaException, die Kurse der übrigen ISINs werden trotzdem zurückgegeben. Fehler der
+    # Sitzung (abgelaufen, gesperrt) werden dagegen geworfen, da sie alle ISINs betreffen.
+    def get_quotes(self, isins):
+        isins = list(dict.fromkeys(isins))
+
+        quotes = {isin: self.quote_cache.get(isin) for isin in isins}
+        missing_isins = [isin for isin, quote in quotes.items() if quote is None]
+
+        logger.info(
+            f"Quotes requested for {isins}, {len(missing_isins)} not in cache: {missing_isins}"
+        )
+
+        if missing_isins:
+            for isin, quote in zip(missing_isins, self.api.getQuotes(missing_isins)):
+                if isinstance(
+                    quote, (OnVistaAccessDeniedException, OnVistaPerformanceDataError)
+                ):
+                    raise quote
+                if isinstance(quote, OnVistaException):
+                    logger.info(f"Quote for {isin} could not be requested: {quote}")
+                else:
+                    self.quote_cache.put(isin, quote)
+                quotes[isin] = quote
+
+        return quotes
+
+    # Speichert den zuletzt abgefragten Snapshot (siehe snapshot_store.py) im session_store, damit
+    # ihn auch andere Prozesse ohne eigene Abfrage verwenden können.
+    def save_snapshot(self, snapshot):
+        self.api.session_store.save_snapshot(snapshot)
+
+    # Gibt den zuletzt (ggf. von einem anderen Prozess) abgefragten Snapshot zurück oder None.
+    def load_snapshot(self):
+        return self.api.session_store.load_snapshot()
+
+    # Gibt für ein Konto alle Einträge der Transaktionshistorie (kind = "transactions") bzw. der
+    # Orderhistorie (kind = "orders") ab dem Datum since (YYYY-MM-DD, inklusive) zurück.
+    #
+    # Die Historie wird seitenweise (page_size Einträge je Seite) abgefragt, wobei jeweils
+    # pages_per_request Seiten in einem einzigen Request gebündelt werden. Es wird abgebrochen,
+    # sobald eine Seite nicht mehr voll ist.
+    def get_history(self, kind, account_key, since, page_size=50, pages_per_request=4):
+        request = {
+            "transactions": self.api.getTransactionsHistory,
+            "orders": self.api.getOrdersHistory,
+        }[kind]
+
+        entries = []
+        first_page = 0
+        while True:
+            pages = range(first_page, first_page + pages_per_request)
+            results = request(account_key, since, pages, page_size)
+
+            for result in results:
+                page_entries = result.get(kind, [])
+                entries.extend(page_entries)
+                if len(page_entries) < page_size:
+                    logger.info(
+                        f"{len(entries)} {kind} since {since} fetched for account {account_key}"
+                    )
+                    return entries
+
+            first_page += pages_per_request
@@ -1,12 +1,10 @@
-import requests as req
 import logging as log
-import json
-import certifi
-import urllib3
+import threading
 
 from loguru import logger
 
-from requests.cookies import cookiejar_from_dict
+from onvistabank_api.HttpTransport import RequestsTransport
+from onvistabank_api.SessionStore import FileSessionStore
 
 
 # Exceptions und Fehler-Codes der OnVista-API
@@ -54,27 +52,41 @@ class OnVistaLowLevelApi:
     # Erzeugt eine neue Instanz der OnVistaLowLevelApi. Für jeden Benutzer sollte eine eigene Instanz
     # mit einem eigenen Cookie-File erzeugt werden. Das Cookie-File wird automatisch erstellt und fortgeschrieben
     # und ermöglicht das automatische Login ohne erneute Eingabe eines OTP (One-Time-Password).
-    def __init__(self, cookies_file_name):
-        self.session = req.Session()
-
-        self.cookies_file_name = cookies_file_name
-        try:
-            cookies_file = open(cookies_file_name)
-
-            with cookies_file:
-                cookies = json.load(cookies_file)
-                self.session.cookies = cookiejar_from_dict(cookies)
-
-                log.debug(
-                    f"Aus der Datei {cookies_file_name} wurden die Cookies {cookies} gelesen."
-                )
-
-        except IOError as e:
-            log.debug(
-                f"Von der Datei {cookies_file_name} konnten keine Dateien geladen werden: {e}"
-            )
+    #
+    # Statt des Cookie-Files kann ein session_store (siehe SessionStore.py) übergeben werden, über den
+    # sich mehrere Prozesse bzw. Rechner eine Sitzung teilen. Speichert ein anderer Prozess neue Cookies,
+    # werden diese vor dem nächsten Request übernommen.
+    #
+    # Mit request_budget (siehe RequestBudget.py) werden alle Requests über ein gemeinsames, nach
+    # Priorität geordnetes Budget abgewickelt. Mit transport (siehe HttpTransport.py) kann die
+    # HTTP-Verbindung (Endpunkt, HTTP/2, Kompression, Verbindungs-Pool) konfiguriert werden.
+    def __init__(
+        self,
+        cookies_file_name=None,
+        session_store=None,
+        request_budget=None,
+        transport=None,
+    ):
+        self.transport = transport or RequestsTransport()
+        self.session_store = session_store or FileSessionStore(cookies_file_name)
+        self.request_budget = request_budget
+        self.cookies_version = None
+        # Requests können aus mehreren Threads gleichzeitig kommen (siehe main.py). Das Laden und
+        # Speichern der Cookies ist daher gesperrt, die Requests selbst laufen parallel.
+        self._cookies_lock = threading.Lock()
+
+        self.reload_cookies()
+
+    # Lädt die Cookies aus dem session_store in die HTTP-Session.
+    def reload_cookies(self):
+        self.cookies_version = self.session_store.cookies_version()
+        cookies = self.session_store.load_cookies()
+        if cookies is None:
             return
 
+        self.transport.set_cookies(cookies)
+        log.debug(f"Aus dem Session-Store wurden die Cookies {cookies} gelesen.")
+
     # Gibt die Informationen über die aktuelle Session zurück.
     #
     # Beispiel-Response 1:
@@ -92,16 +104,23 @@ class OnVistaLowLevelApi:
         logger.info("Refresh session requested...")
         return self.low_level_request("Session_Auth", "refresh", {})
 
-    # Diese Methode speichert die Cookies der HTTP-Session in der vorgegebenen Datei.
-    def _save_cookies(self):
-        with open(self.cookies_file_name, "w") as cookies_file:
-            cookies_dict = self.session.cookies.get_dict()
+    # Diese Methode speichert die Cookies der HTTP-Session im session_store, sofern dort noch die
+    # Cookies mit der Version version liegen, die zu Beginn des Requests geladen waren. Hat ein
+    # anderer Prozess inzwischen neue Cookies gespeichert (z.B. nach einem Login), bleiben dessen
+    # Cookies erhalten und werden vor dem nächsten Request übernommen.
+    def _save_cookies(self, version):
+        cookies_dict = self.transport.get_cookies()
+        if not self.session_store.save_cookies_if_unchanged(cookies_dict, version):
+            logger.info(
+                "Cookies were changed by another process during the request, not saving them"
+            )
+            return
 
-            json.dump(cookies_dict, fp=cookies_file, indent=4)
+        self.cookies_version = self.session_store.cookies_version()
 
-            log.debug(
-                f"In die Datei {self.cookies_file_name} wurden die Cookies {cookies_dict} geschrieben."
-            )
+        log.debug(
+            f"In den Session-Store wurden die Cookies {cookies_dict} geschrieben."
+        )
 
     # Alle Requests an die OnVista-API werden über diese Methode abgewickelt. Sie fügt die notwendigen
     # Metadaten hinzu und gibt die Antwort der API zurück. Dabei wird nur das relevante result-Objekt
@@ -124,8 +143,19 @@ class OnVistaLowLevelApi:
     # - getAccountsList (in der Domain Bank_Account)
     # - getPositions (in der Domain Trading_Position)
     def low_level_request(self, domain, service, params):
-        new_params = {"action[s0][params][" + k + "]": v for (k, v) in params.items()}
+        return self.low_level_batch_request([(domain, service, params)])[0]
 
+    # Die API erlaubt es, mehrere Aktionen in einem einzigen HTTP-Request zu bündeln. Die Aktionen
+    # werden dabei durchnummeriert (s0, s1, s2, ...) und die Antwort enthält für jede Aktion ein
+    # eigenes result-Objekt unter demselben Schlüssel. low_level_request() ist der Spezialfall mit
+    # genau einer Aktion (s0).
+    #
+    # actions ist eine Liste von Tupeln (domain, service, params). Zurückgegeben wird die Liste
+    # der result-Objekte in derselben Reihenfolge. Schlägt eine der Aktionen fehl, wird die
+    # entsprechende Exception geworfen. Mit raise_errors = False steht die Exception stattdessen
+    # an der Stelle des result-Objekts, die Ergebnisse der übrigen Aktionen bleiben so erhalten.
+    # Schlägt der gesamte Request fehl, wird die Exception in jedem Fall geworfen.
+    def low_level_batch_request(self, actions, raise_errors=True):
         post_params = {
             "hash[timestamp]": "",
             # hash[nonce] ist statisch
@@ -138,28 +168,45 @@ class OnVistaLowLevelApi:
             "hash[key]": "JKEIMG1J1NIJ5619",
             # hash[signature] ist statisch
             "hash[signature]": "ODlhOGE1MDA5NzMyNWE4ZDhhODhhNmQ3NTM4NDAxYWMwNTg1M2M5Nw%3D%3D",
-            "action[s0][domain]": domain,
-            "action[s0][service]": service,
         }
 
-        params = {"s0": f"{domain}.{service}"}
-        data = {**post_params, **new_params}
+        params = {}
+        data = {**post_params}
+        for i, (domain, service, action_params) in enumerate(actions):
+            key = f"s{i}"
+            params[key] = f"{domain}.{service}"
+            data[f"action[{key}][domain]"] = domain
+            data[f"action[{key}][service]"] = service
+            data.update(
+                {
+                    f"action[{key}][params][" + k + "]": v
+                    for (k, v) in action_params.items()
+                }
+            )
 
         logger.debug(
-            f"Request: https://webtrading.onvista-bank.de/services/api/ mit params={params} und data={data}"
+            f"Request: {self.transport.base_url} mit params={params} und data={data}"
         )
 
-        result = self.session.post(
-            f"https://webtrading.onvista-bank.de/services/api/",
+        if self.request_budget:
+            self.request_budget.acquire()
+
+        # Hat ein anderer Prozess inzwischen neue Cookies gespeichert (z.B. nach einem Login),
+        # werden diese verwendet.
+        with self._cookies_lock:
+            if self.session_store.cookies_version() != self.cookies_version:
+                self.reload_cookies()
+            version = self.cookies_version
+
+        result_data = self.transport.post(
             params=params,
             data=data,
-            headers={"X-XSRF-TOKEN": self.session.cookies.get("XSRF-TOKEN")},
+            headers={"X-XSRF-TOKEN": self.transport.get_cookies().get("XSRF-TOKEN")},
         )
 
         # Cookies sofort nach jedem Request abspeichern
-        self._save_cookies()
-
-        result_data = result.json()
+        with self._cookies_lock:
+            self._save_cookies(version)
 
         logger.debug(f"Response: {result_data}")
 
@@ -168,18 +215,25 @@ class OnVistaLowLevelApi:
             logger.info(f"Error in Response: {err}")
             raise make_onvista_exception(err["code"], err["message"])
 
-        if not "s0" in result_data:
-            logger.info("s0 is missing in ressponse data")
+        results = []
+        for key in params.keys():
+            if not key in result_data:
+                logger.info(f"{key} is missing in ressponse data")
 
-        if "error" in result_data["s0"]:
-            err = result_data["s0"]["error"]
-            logger.info(f"Error in Response: {err}")
-            raise make_onvista_exception(err["code"], err["message"])
+            if "error" in result_data[key]:
+                err = result_data[key]["error"]
+                logger.info(f"Error in Response: {err}")
+                if raise_errors:
+                    raise make_onvista_exception(err["code"], err["message"])
+                results.append(make_onvista_exception(err["code"], err["message"]))
+                continue
+
+            if not "result" in result_data[key]:
+                logger.info(f"{key}.result is missing in response data")
 
-        if not "result" in result_data["s0"]:
-            logger.info("s0.result is missing in response data")
+            results.append(result_data[key]["result"])
 
-        return result_data["s0"]["result"]
+        return results
 
     # Wird im Rahmen des OTP-Verfahrens ausgeführt. Nach dem unfruchtbaren login()-Aufruf muss das OTP
     # durch diese Methode generiert werden. Dann wird das OTP per SMS an das Handy des Benutzers gesendet.
@@ -396,3 +450,128 @@ class OnVistaLowLevelApi:
             "getPositions",
             {"accountKey": accountKey, "withMemos": 1},
         )
+
+    # Gibt für eine Liste von ISINs die aktuellen Kurse zurück. Alle ISINs werden dabei in einem
+    # einzigen HTTP-Request abgefragt (siehe low_level_batch_request()), die Liste der Antworten
+    # hat dieselbe Reihenfolge wie die übergebenen ISINs. Schlägt die Abfrage einer einzelnen ISIN
+    # fehl (z.B. weil sie unbekannt ist), steht an ihrer Stelle die OnVistaException.
+    #
+    # Die Domain Trading_Instrument mit dem Service getQuote wurde wie die übrigen Services aus dem
+    # Webtrading-Interface ermittelt. Die Antwort entspricht dem instrument-Objekt einer Position
+    # (siehe tradingPositions()).
+    #
+    # Beispiel-Response (je ISIN):
+    #
+    # {
+    #     'symbol': 'LU1681045370.XETR.EUR',
+    #     'label': 'AMUNDI MSCI EMU',
+    #     'isin': 'LU1681045370',
+    #     'wkn': 'A2H58J',
+    #     'variation': -0.00085106382978723,
+    #     'last': 75.12,
+    #     'currency': 'EUR',
+    #     'previousClose': 75.18,
+    #     'open': 75.12,
+    #     'high': 75.54,
+    #     'low': 74.98,
+    #     'tradeDate': '2019-03-07 21:45:31',
+    #     'exchangeLabel': 'Frankfurt',
+    #     '_meta': {
+    #         'requestExecutionTime': 0.0123
+    #     }
+    # }
+    def getQuotes(self, isins):
+        return self.low_level_batch_request(
+            [("Trading_Instrument", "getQuote", {"isin": isin}) for isin in isins],
+            raise_errors=False,
+        )
+
+    # Gibt für ein Konto mehrere Seiten der Transaktionshistorie (ausgeführte Käufe, Verkäufe,
+    # Ausschüttungen usw.) ab dem Datum fromDate (inklusive, Format YYYY-MM-DD) zurück. Alle Seiten
+    # werden in einem einzigen HTTP-Request abgefragt (siehe low_level_batch_request()), die Liste
+    # der Antworten hat dieselbe Reihenfolge wie pages (Seitennummern ab 0).
+    #
+    # Die Domain Trading_Transaction mit dem Service getTransactionsHistory wurde wie die übrigen
+    # Services aus dem Webtrading-Interface ermittelt.
+    #
+    # Beispiel-Response (je Seite):
+    #
+    # {
+    #     'transactions': [
+    #         {
+    #             'id': '20240307-000123',
+    #             'date': '2024-03-07 15:31:02',
+    #             'type': 'BUY',
+    #             'isin': 'LU1681045370',
+    #             'label': 'AMUNDI MSCI EMU',
+    #             'quantity': 20,
+    #             'price': 75.12,
+    #             'amount': -1507.4,
+    #             'fees': 5,
+    #             'currency': 'EUR'
+    #         }
+    #     ],
+    #     'totalCount': 1,
+    #     '_meta': {
+    #         'requestExecutionTime': 0.2134
+    #     }
+    # }
+    def getTransactionsHistory(self, accountKey, fromDate, pages, pageSize):
+        return self.low_level_batch_request(
+            [
+                (
+                    "Trading_Transaction",
+                    "getTransactionsHistory",
+                    {
+                        "accountKey": accountKey,
+                        "fromDate": fromDate,
+                        "page": page,
+                        "pageSize": pageSize,
+                    },
+                )
+                for page in pages
+            ]
+        )
+
+    # Wie getTransactionsHistory(), aber für die Orderhistorie (alle Orders inklusive der nicht
+    # ausgeführten bzw. gestrichenen). Die Domain Trading_Order mit dem Service getOrdersHistory
+    # wurde ebenfalls aus dem Webtrading-Interface ermittelt.
+    #
+    # Beispiel-Response (je Seite):
+    #
+    # {
+    #     'orders': [
+    #         {
+    #             'id': 'O-4711',
+    #             'date': '2024-03-07 15:30:58',
+    #             'direction': 'BUY',
+    #             'status': 'EXECUTED',
+    #             'isin': 'LU1681045370',
+    #             'label': 'AMUNDI MSCI EMU',
+    #             'quantity': 20,
+    #             'executedQuantity': 20,
+    #             'limit': 75.2,
+    #             'orderType': 'LIMIT'
+    #         }
+    #     ],
+    #     'totalCount': 1,
+    #     '_meta': {
+    #         'requestExecutionTime': 0.1987
+    #     }
+    # }
+    def getOrdersHistory(self, accountKey, fromDate, pages, pageSize):
+        return self.low_level_batch_request(
+            [
+                (
+                    "Trading_Order",
+                    "getOrdersHistory",
+                    {
+                        "accountKey": accountKey,
+                        "fromDate": fromDate,
+                        "page": page,
+                        "pageSize": pageSize,
+                    },
+                )
+                for page in pages
+            ]
+        )
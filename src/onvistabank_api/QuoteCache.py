@@ -0,0 +1,49 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+# Ein kleiner Zwischenspeicher für Kurse, damit wiederholte Abfragen derselben ISINs (z.B. eine
+# Watchlist, die mehrmals hintereinander mit /quote abgefragt wird) keine neuen Requests auslösen.
+#
+# Jeder Eintrag ist nur ttl_seconds lang gültig, danach gilt er als veraltet und wird bei der
+# nächsten Abfrage neu geladen. Zusätzlich ist die Anzahl der Einträge auf max_entries begrenzt,
+# bei Überschreitung wird der am längsten nicht mehr verwendete Eintrag verworfen (LRU).
+#
+# Die Abfragen laufen in eigenen Threads (siehe main.py), daher sind alle Zugriffe gesperrt.
+class QuoteCache:
+    def __init__(self, ttl_seconds=60, max_entries=256, clock=time.monotonic):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.clock = clock
+
+        # ISIN -> (Zeitpunkt der Abfrage, Kurs), die Reihenfolge entspricht der letzten Verwendung.
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    # Gibt den Kurs zur ISIN zurück oder None, falls er nicht (mehr) im Zwischenspeicher ist.
+    def get(self, isin):
+        with self._lock:
+            entry = self._entries.get(isin)
+            if entry is None:
+                return None
+
+            fetched_at, quote = entry
+            if self.clock() - fetched_at > self.ttl_seconds:
+                del self._entries[isin]
+                return None
+
+            self._entries.move_to_end(isin)
+            return quote
+
+    # Legt den Kurs zur ISIN im Zwischenspeicher ab.
+    def put(self, isin, quote):
+        with self._lock:
+            self._entries[isin] = (self.clock(), quote)
+            self._entries.move_to_end(isin)
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
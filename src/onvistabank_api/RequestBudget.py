@@ -0,0 +1,182 @@
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from loguru import logger
+
+# Die Prioritätsklassen der Requests an die Bank. Eine kleinere Zahl ist wichtiger.
+INTERACTIVE = 0
+SCHEDULED = 1
+BACKGROUND = 2
+
+PRIORITY_NAMES = {
+    INTERACTIVE: "interactive",
+    SCHEDULED: "scheduled",
+    BACKGROUND: "background",
+}
+
+# Die Tokens, die für wichtigere Klassen freigehalten werden, und die maximale Wartezeit (in
+# Sekunden) je Klasse (siehe RequestBudget).
+DEFAULT_RESERVE = {INTERACTIVE: 0, SCHEDULED: 2, BACKGROUND: 4}
+DEFAULT_MAX_WAIT = {INTERACTIVE: 30, SCHEDULED: 120, BACKGROUND: 10}
+
+# Die Priorität der Requests im aktuellen Kontext (siehe request_priority()). Ohne Angabe gilt
+# ein Request als interaktiv. asyncio.to_thread() übernimmt den Kontext in den Thread.
+_current_priority = ContextVar("request_priority", default=INTERACTIVE)
+
+
+# Setzt die Priorität aller Requests innerhalb des with-Blocks.
+#
+# Beispielanwendung:
+#
+#   with request_priority(BACKGROUND):
+#       await asyncio.to_thread(api.is_session_valid)
+@contextmanager
+def request_priority(priority):
+    token = _current_priority.set(priority)
+    try:
+        yield
+    finally:
+        _current_priority.reset(token)
+
+
+class RequestBudgetExceededException(Exception):
+    def __init__(self, priority, wait):
+        super().__init__(
+            f"No request budget for a {PRIORITY_NAMES[priority]} request within {wait:.1f} seconds."
+        )
+
+
+# Ein gemeinsames Budget (Token-Bucket) für alle Requests an die Bank, damit z.B. viele
+# Hintergrund-Requests in kurzer Zeit nicht zu einer Sperre des Zugangs führen.
+#
+# Der Bucket fasst burst Tokens und wird mit rate Tokens pro Sekunde aufgefüllt. Jeder HTTP-Request
+# (auch ein gebündelter, siehe low_level_batch_request()) verbraucht ein Token. Ist kein Token
+# frei, wartet der Request, bis wieder eines frei ist.
+#
+# Dabei gilt die Priorität der Requests (interaktiv > geplant > Hintergrund):
+#
+#   - Für jede Klasse wird eine Reserve (reserve) an Tokens freigehalten, die nur wichtigere
+#     Requests verbrauchen dürfen. Ein Hintergrund-Request kann einen Benutzer also nie ganz
+#     ohne Tokens zurücklassen.
+#   - Wartet ein wichtigerer Request, erhalten weniger wichtige Requests kein Token.
+#   - Wartet ein Request länger als max_wait seiner Klasse, wird er mit einer
+#     RequestBudgetExceededException abgelehnt.
+#
+# Das Budget ist threadsicher. Da die Requests blockierend sind, sollten geplante Jobs und
+# Hintergrund-Requests in einem eigenen Thread laufen (asyncio.to_thread()), damit ihr Warten
+# die interaktiven Befehle nicht aufhält.
+class RequestBudget:
+    def __init__(
+        self,
+        rate=1.0,
+        burst=10,
+        reserve=DEFAULT_RESERVE,
+        max_wait=DEFAULT_MAX_WAIT,
+        clock=time.monotonic,
+    ):
+        self.rate = rate
+        self.burst = burst
+        self.reserve = reserve
+        self.max_wait = max_wait
+        self.clock = clock
+
+        self.tokens = float(burst)
+        self.updated_at = clock()
+        self.condition = threading.Condition()
+        self.waiting = {priority: 0 for priority in PRIORITY_NAMES}
+        self.metrics = {
+            priority: {
+                "requests": 0,
+                "waited": 0,
+                "rejected": 0,
+                "wait_total": 0.0,
+                "wait_max": 0.0,
+            }
+            for priority in PRIORITY_NAMES
+        }
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def _higher_priority_waiting(self, priority):
+        return any(self.waiting[other] for other in PRIORITY_NAMES if other < priority)
+
+    # Verbraucht ein Token für einen Request mit der angegebenen Priorität (ohne Angabe die des
+    # aktuellen Kontexts, siehe request_priority()). Wartet ggf. auf ein freies Token und wirft
+    # eine RequestBudgetExceededException, wenn das länger als max_wait dauern würde.
+    def acquire(self, priority=None):
+        priority = _current_priority.get() if priority is None else priority
+        needed = 1 + self.reserve.get(priority, 0)
+        started_at = self.clock()
+        deadline = started_at + self.max_wait[priority]
+
+        with self.condition:
+            self.waiting[priority] += 1
+            try:
+                while True:
+                    self._refill()
+                    if self.tokens >= needed and not self._higher_priority_waiting(
+                        priority
+                    ):
+                        self.tokens -= 1
+                        break
+
+                    now = self.clock()
+                    if now >= deadline:
+                        self._record(priority, now - started_at, rejected=True)
+                        raise RequestBudgetExceededException(priority, now - started_at)
+
+                    self.condition.wait(
+                        min(
+                            max(needed - self.tokens, 0) / self.rate or 0.05,
+                            deadline - now,
+                        )
+                    )
+            finally:
+                self.waiting[priority] -= 1
+                # Wartende Requests mit niedrigerer Priorität können jetzt ggf. weitermachen.
+                self.condition.notify_all()
+
+            self._record(priority, self.clock() - started_at)
+
+    def _record(self, priority, wait, rejected=False):
+        metrics = self.metrics[priority]
+        if rejected:
+            metrics["rejected"] += 1
+            logger.warning(
+                f"Request budget exceeded for a {PRIORITY_NAMES[priority]} request after {wait:.1f}s"
+            )
+            return
+
+        metrics["requests"] += 1
+        if wait > 0.001:
+            metrics["waited"] += 1
+            metrics["wait_total"] += wait
+            metrics["wait_max"] = max(metrics["wait_max"], wait)
+            logger.debug(
+                f"{PRIORITY_NAMES[priority]} request waited {wait:.2f}s for the request budget"
+            )
+
+    # Gibt die Kennzahlen je Prioritätsklasse zurück: Anzahl der Requests, davon mit Wartezeit,
+    # abgelehnte Requests, durchschnittliche und maximale Wartezeit (in Sekunden) sowie die
+    # aktuell freien Tokens.
+    def stats(self):
+        with self.condition:
+            self._refill()
+            return {
+                "tokens": self.tokens,
+                "classes": {
+                    PRIORITY_NAMES[priority]: {
+                        **metrics,
+                        "wait_average": (
+                            metrics["wait_total"] / metrics["waited"]
+                            if metrics["waited"]
+                            else 0.0
+                        ),
+                    }
+                    for priority, metrics in self.metrics.items()
+                },
+            }
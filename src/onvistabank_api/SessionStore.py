@@ -0,0 +1,363 @@
+import fcntl
+import json
+import os
+import sqlite3
+import time
+import uuid
+from contextlib import contextmanager
+from loguru import logger
+
+# Der Speicher für die Sitzung (Cookies) und den zuletzt abgefragten Snapshot.
+#
+# Mehrere Prozesse (z.B. der Bot und ein Export per Cron) oder sogar mehrere Rechner können sich
+# über einen gemeinsamen Speicher eine einzige Sitzung bei der Bank teilen, statt sich jeweils
+# selbst einzuloggen und sich damit gegenseitig die Sitzung ungültig zu machen. Dafür gibt es
+# zusätzlich eine Sperre (lock()), die um Login und OTP-Eingabe gelegt wird.
+#
+# Jeder Speicher bietet dieselben Methoden:
+#
+#   - load_cookies() / save_cookies(cookies): die Cookies als Dictionary
+#   - cookies_version(): ein Wert, der sich bei jedem save_cookies() ändert. Damit kann ein
+#     Prozess günstig feststellen, ob ein anderer Prozess neue Cookies gespeichert hat.
+#   - save_cookies_if_unchanged(cookies, version): speichert die Cookies nur, wenn
+#     cookies_version() noch version ist, und gibt zurück, ob gespeichert wurde. So überschreibt
+#     ein Request, der vor einem Login eines anderen Prozesses gestartet wurde, nicht dessen
+#     neue Cookies.
+#   - load_snapshot() / save_snapshot(snapshot): der zuletzt abgefragte Snapshot
+#   - set_otp_pending(owner, ttl) / otp_pending_owner() / clear_otp_pending(): die Markierung, dass
+#     owner ein OTP angefordert hat, das noch nicht eingegeben wurde. Sie läuft nach ttl Sekunden
+#     ab (so lange ist das OTP gültig). Solange sie besteht, darf sich kein anderer Prozess neu
+#     einloggen, da das das OTP ungültig machen würde (siehe OnVistaApi.login()).
+#   - lock(name, timeout): Kontextmanager für eine prozess- bzw. rechnerübergreifende Sperre
+#
+# Implementiert sind:
+#
+#   - FileSessionStore: JSON-Dateien und flock() (mehrere Prozesse auf einem Rechner)
+#   - SQLiteSessionStore: eine SQLite-Datenbank (mehrere Prozesse auf einem Rechner)
+#   - RedisSessionStore: ein Redis-kompatibler Server (mehrere Rechner)
+
+
+class SessionLockTimeoutException(Exception):
+    def __init__(self, name):
+        super().__init__(f"The session lock {name} could not be acquired in time.")
+
+
+# Die Cookies liegen (wie bisher) als JSON in cookies_file_name, der Snapshot daneben in
+# <cookies_file_name>.snapshot.json. Die Sperren sind flock()-Sperren auf eigenen Lock-Dateien,
+# sie werden vom Betriebssystem auch beim Absturz eines Prozesses freigegeben.
+class FileSessionStore:
+    def __init__(self, cookies_file_name):
+        self.cookies_file_name = cookies_file_name
+        self.snapshot_file_name = f"{cookies_file_name}.snapshot.json"
+        self.otp_file_name = f"{cookies_file_name}.otp.json"
+
+    def _read_json(self, file_name):
+        try:
+            with open(file_name) as json_file:
+                return json.load(json_file)
+        except (IOError, ValueError) as e:
+            logger.debug(
+                f"Von der Datei {file_name} konnten keine Daten geladen werden: {e}"
+            )
+            return None
+
+    # Schreibt erst in eine temporäre Datei und ersetzt dann die eigentliche Datei, damit andere
+    # Prozesse nie eine halb geschriebene Datei lesen.
+    def _write_json(self, file_name, data):
+        with open(f"{file_name}.{os.getpid()}.tmp", "w") as json_file:
+            json.dump(data, fp=json_file, indent=4)
+        os.replace(f"{file_name}.{os.getpid()}.tmp", file_name)
+
+    def load_cookies(self):
+        return self._read_json(self.cookies_file_name)
+
+    def save_cookies(self, cookies):
+        self._write_json(self.cookies_file_name, cookies)
+
+    # os.replace() legt bei jedem Speichern eine neue Datei an, die Inode ändert sich also auch
+    # dann, wenn zwei Prozesse innerhalb derselben Zeitauflösung des Dateisystems speichern.
+    def cookies_version(self):
+        try:
+            stat = os.stat(self.cookies_file_name)
+            return stat.st_ino, stat.st_mtime_ns
+        except OSError:
+            return None
+
+    def save_cookies_if_unchanged(self, cookies, version):
+        with self.lock("cookies"):
+            if self.cookies_version() != version:
+                return False
+            self.save_cookies(cookies)
+            return True
+
+    def load_snapshot(self):
+        return self._read_json(self.snapshot_file_name)
+
+    def save_snapshot(self, snapshot):
+        self._write_json(self.snapshot_file_name, snapshot)
+
+    def set_otp_pending(self, owner, ttl):
+        self._write_json(
+            self.otp_file_name, {"owner": owner, "expires_at": time.time() + ttl}
+        )
+
+    def otp_pending_owner(self):
+        marker = self._read_json(self.otp_file_name)
+        if marker is None or marker["expires_at"] < time.time():
+            return None
+        return marker["owner"]
+
+    def clear_otp_pending(self):
+        try:
+            os.remove(self.otp_file_name)
+        except FileNotFoundError:
+            pass
+
+    @contextmanager
+    def lock(self, name, timeout=60):
+        with open(f"{self.cookies_file_name}.{name}.lock", "w") as lock_file:
+            deadline = time.monotonic() + timeout
+            while True:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    if time.monotonic() > deadline:
+                        raise SessionLockTimeoutException(name)
+                    time.sleep(0.1)
+
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+# Alle Daten liegen in einer SQLite-Datenbank in der Tabelle session_data (Schlüssel -> JSON).
+# Die Sperren sind Zeilen in der Tabelle session_locks mit einem Ablaufzeitpunkt, damit die Sperre
+# eines abgestürzten Prozesses nach ttl Sekunden wieder frei wird.
+class SQLiteSessionStore:
+    def __init__(self, file_name, ttl=120):
+        self.file_name = file_name
+        self.ttl = ttl
+
+        with self._connect() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS session_data (key TEXT PRIMARY KEY, value TEXT NOT NULL, version INTEGER NOT NULL)"
+            )
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS session_locks (name TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+
+    def _connect(self):
+        return sqlite3.connect(self.file_name, timeout=30)
+
+    def _get(self, key):
+        with self._connect() as connection:
+            row = connection.execute(
+                "SELECT value, version FROM session_data WHERE key = ?", (key,)
+            ).fetchone()
+        return (json.loads(row[0]), row[1]) if row else (None, None)
+
+    def _set(self, key, value):
+        with self._connect() as connection:
+            connection.execute(
+                "INSERT INTO session_data (key, value, version) VALUES (?, ?, 1) "
+                "ON CONFLICT(key) DO UPDATE SET value = excluded.value, version = version + 1",
+                (key, json.dumps(value)),
+            )
+
+    def load_cookies(self):
+        return self._get("cookies")[0]
+
+    def save_cookies(self, cookies):
+        self._set("cookies", cookies)
+
+    def cookies_version(self):
+        return self._get("cookies")[1]
+
+    def save_cookies_if_unchanged(self, cookies, version):
+        with self._connect() as connection:
+            if version is None:
+                cursor = connection.execute(
+                    "INSERT OR IGNORE INTO session_data (key, value, version) VALUES ('cookies', ?, 1)",
+                    (json.dumps(cookies),),
+                )
+            else:
+                cursor = connection.execute(
+                    "UPDATE session_data SET value = ?, version = version + 1 WHERE key = 'cookies' AND version = ?",
+                    (json.dumps(cookies), version),
+                )
+            return cursor.rowcount == 1
+
+    def load_snapshot(self):
+        return self._get("snapshot")[0]
+
+    def save_snapshot(self, snapshot):
+        self._set("snapshot", snapshot)
+
+    def set_otp_pending(self, owner, ttl):
+        self._set("otp_pending", {"owner": owner, "expires_at": time.time() + ttl})
+
+    def otp_pending_owner(self):
+        marker = self._get("otp_pending")[0]
+        if marker is None or marker["expires_at"] < time.time():
+            return None
+        return marker["owner"]
+
+    def clear_otp_pending(self):
+        with self._connect() as connection:
+            connection.execute("DELETE FROM session_data WHERE key = 'otp_pending'")
+
+    def _try_acquire(self, name, owner):
+        connection = self._connect()
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            connection.execute(
+                "DELETE FROM session_locks WHERE name = ? AND expires_at < ?",
+                (name, time.time()),
+            )
+            acquired = (
+                connection.execute(
+                    "INSERT OR IGNORE INTO session_locks (name, owner, expires_at) VALUES (?, ?, ?)",
+                    (name, owner, time.time() + self.ttl),
+                ).rowcount
+                == 1
+            )
+            connection.commit()
+            return acquired
+        finally:
+            connection.close()
+
+    @contextmanager
+    def lock(self, name, timeout=60):
+        owner = str(uuid.uuid4())
+        deadline = time.monotonic() + timeout
+        while not self._try_acquire(name, owner):
+            if time.monotonic() > deadline:
+                raise SessionLockTimeoutException(name)
+            time.sleep(0.1)
+
+        try:
+            yield
+        finally:
+            with self._connect() as connection:
+                connection.execute(
+                    "DELETE FROM session_locks WHERE name = ? AND owner = ?",
+                    (name, owner),
+                )
+
+
+# Alle Daten liegen als JSON unter <prefix>:<Schlüssel> in einem Redis-kompatiblen Server. Die
+# Sperren werden mit SET NX PX gesetzt und nur vom Besitzer wieder gelöscht (Lua-Skript), damit
+# ein Prozess nach Ablauf der ttl nicht versehentlich die Sperre eines anderen freigibt.
+#
+# Das Paket redis wird nur für dieses Backend benötigt und daher erst hier importiert. Statt
+# einer URL kann auch ein fertiger Client übergeben werden, z.B. für einen lokalen Ersatz-Server
+# beim Testen.
+class RedisSessionStore:
+    RELEASE_SCRIPT = """
+        if redis.call("get", KEYS[1]) == ARGV[1] then
+            return redis.call("del", KEYS[1])
+        end
+        return 0
+    """
+
+    # Speichert die Cookies (KEYS[1]) und erhöht die Version (KEYS[2]) nur, wenn die Version noch
+    # ARGV[2] ist (leer, falls noch keine Cookies gespeichert wurden).
+    SAVE_IF_UNCHANGED_SCRIPT = """
+        local version = redis.call("get", KEYS[2])
+        if (version or "") ~= ARGV[2] then
+            return 0
+        end
+        redis.call("set", KEYS[1], ARGV[1])
+        redis.call("incr", KEYS[2])
+        return 1
+    """
+
+    def __init__(self, url=None, prefix="onvistabank", ttl=120, client=None):
+        if client is None:
+            import redis
+
+            client = redis.Redis.from_url(url)
+
+        self.client = client
+        self.prefix = prefix
+        self.ttl = ttl
+
+    def _key(self, key):
+        return f"{self.prefix}:{key}"
+
+    def _get(self, key):
+        value = self.client.get(self._key(key))
+        return json.loads(value) if value is not None else None
+
+    def load_cookies(self):
+        return self._get("cookies")
+
+    def save_cookies(self, cookies):
+        pipeline = self.client.pipeline()
+        pipeline.set(self._key("cookies"), json.dumps(cookies))
+        pipeline.incr(self._key("cookies_version"))
+        pipeline.execute()
+
+    def cookies_version(self):
+        return self.client.get(self._key("cookies_version"))
+
+    def save_cookies_if_unchanged(self, cookies, version):
+        if isinstance(version, bytes):
+            version = version.decode()
+        return (
+            self.client.eval(
+                self.SAVE_IF_UNCHANGED_SCRIPT,
+                2,
+                self._key("cookies"),
+                self._key("cookies_version"),
+                json.dumps(cookies),
+                "" if version is None else str(version),
+            )
+            == 1
+        )
+
+    def load_snapshot(self):
+        return self._get("snapshot")
+
+    def save_snapshot(self, snapshot):
+        self.client.set(self._key("snapshot"), json.dumps(snapshot))
+
+    def set_otp_pending(self, owner, ttl):
+        self.client.set(self._key("otp_pending"), owner, ex=int(ttl))
+
+    def otp_pending_owner(self):
+        owner = self.client.get(self._key("otp_pending"))
+        return owner.decode() if isinstance(owner, bytes) else owner
+
+    def clear_otp_pending(self):
+        self.client.delete(self._key("otp_pending"))
+
+    @contextmanager
+    def lock(self, name, timeout=60):
+        key = self._key(f"lock:{name}")
+        owner = str(uuid.uuid4())
+        deadline = time.monotonic() + timeout
+        while not self.client.set(key, owner, nx=True, px=self.ttl * 1000):
+            if time.monotonic() > deadline:
+                raise SessionLockTimeoutException(name)
+            time.sleep(0.1)
+
+        try:
+            yield
+        finally:
+            self.client.eval(self.RELEASE_SCRIPT, 1, key, owner)
+
+
+# Erzeugt den Speicher für das konfigurierte Backend (file, sqlite oder redis). location ist der
+# Dateiname bzw. die Redis-URL.
+def make_session_store(backend, location):
+    if backend == "file":
+        return FileSessionStore(location)
+    if backend == "sqlite":
+        return SQLiteSessionStore(location)
+    if backend == "redis":
+        return RedisSessionStore(location)
+
+    raise ValueError(f"Unknown session backend {backend}")
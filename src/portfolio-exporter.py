@@ -2,7 +2,7 @@
 
 # Exportiert das Portfolio des Nutzers als CSV-Datei mit ; als Spaltentrenner. Login erfordert ggf. TAN-Eingabe.
 
-from operator import itemgetter,attrgetter
+from operator import itemgetter, attrgetter
 from config import get_allowed_user_ids, get_telegram_token
 from onvistabank_api.OnVistaApi import OnVistaApiOTPRequiredException
 from onvistabank_api.OnVistaLowLevelApi import OnVistaOTPIsWrongException
@@ -11,47 +11,70 @@ from loguru import logger
 import sys
 from onvistabank_api.OnVistaApi import OnVistaApi
 from config import get_onvistabank_username, get_onvistabank_password
+from config import get_session_backend, get_session_location
+from config import get_http_transport, get_http_transport_options
+from onvistabank_api.SessionStore import make_session_store
+from onvistabank_api.HttpTransport import make_transport
 from typing import Optional
+from snapshot_store import SnapshotStore, fetch_snapshot, get_shared_snapshot
+from portfolio_analytics import analyze
+
 
 def format_number(number: float) -> str:
     return (
         "{:,.2f}".format(number).replace(",", " ").replace(".", ",").replace(" ", ".")
     )
 
+
 logger.remove(0)
 
 logger.add(sys.stderr, level="ERROR")
 
 api = None
 
+snapshot_store = SnapshotStore("snapshots.jsonl")
+
+# Die Sitzung wird über den Session-Store mit dem Bot geteilt, sodass sich beide nicht
+# gegenseitig ausloggen (siehe onvistabank_api/SessionStore.py).
 api = OnVistaApi(
-    "cookies.txt", get_onvistabank_username(), get_onvistabank_password()
+    None,
+    get_onvistabank_username(),
+    get_onvistabank_password(),
+    session_store=make_session_store(get_session_backend(), get_session_location()),
+    transport=make_transport(get_http_transport(), **get_http_transport_options()),
 )
 
-try:
-    api.login()
-except OnVistaApiOTPRequiredException:
-    otp = input("Bitte OTP-Passwort eingeben: ")
-    api.enterOTP(otp)
-
-# Die Konten dieses Logins abfragen
-accounts_result = api.get_accounts()
-
-print("accountNumber;iban;currentBalance;name;isin;quantity;buyingValue;lastValue;totalValue;actualValue;totalPerformance;performancePercentage")
-for i, account in enumerate(accounts_result["accountsList"], start=1):
+# Hat der Bot (oder ein anderer Export) das Depot gerade erst abgefragt, wird dieser Snapshot
+# verwendet. Ansonsten die Konten und Positionen abfragen. In beiden Fällen landet der Snapshot in
+# der lokalen Historie, sofern er dort noch nicht liegt (z.B. von einem anderen Rechner über den
+# Redis-Store), damit die Auswertung unten nie auf einer leeren Historie läuft.
+snapshot = get_shared_snapshot(api, max_age=timedelta(minutes=5))
+if snapshot is None:
+    try:
+        api.login()
+    except OnVistaApiOTPRequiredException:
+        otp = input("Bitte OTP-Passwort eingeben: ")
+        api.enterOTP(otp)
+
+    snapshot = fetch_snapshot(api)
+snapshot_store.append_if_new(snapshot)
+
+print(
+    "accountNumber;iban;currentBalance;name;isin;quantity;buyingValue;lastValue;totalValue;actualValue;totalPerformance;performancePercentage"
+)
+for i, entry in enumerate(snapshot["accounts"], start=1):
+    account = entry["account"]
     logger.info("Account: {}", account)
 
-    account_key = account["accountKey"]
-
-    # Die (Aktien-)Positionen für diesen Account abfragen
-    positions = sorted(api.trading_positions(account_key)["portfolio"]["positions"], key=itemgetter('isin'))
+    # Die (Aktien-)Positionen für diesen Account
+    positions = sorted(entry["portfolio"]["positions"], key=itemgetter("isin"))
 
     for position in positions:
         message = ""
         message += f'{account["accountNumber"]};'
         message += f'{account["iban"]};'
         message += f'{format_number(account["currentBalance"])};'
-        
+
         message += f'{position["name"]};'
         message += f'{position["isin"]};'
         message += f'{position["quantity"]};'
@@ -61,13 +84,31 @@ for i, account in enumerate(accounts_result["accountsList"], start=1):
 
         message += f"{format_number(position['totalValue'])};"
         message += f"{format_number(position['actualValue'])};"
-        
+
         message += f"{format_number(position['totalPerformance'])};"
         message += f"{format_number(position['performancePercentage'])}"
-        #message += "\n"
+        # message += "\n"
         print(message)
 
-    print(f"overall actualValue: {format_number(sum([position['actualValue'] for position in positions]))}\n")
-    print(f"overall totalPerformance: {format_number(sum([position['totalPerformance'] for position in positions]))}\n")
+    print(
+        f"overall actualValue: {format_number(entry['portfolio']['total']['actualValue'])}\n"
+    )
+    print(
+        f"overall totalPerformance: {format_number(entry['portfolio']['total']['totalPerformance'])}\n"
+    )
 
+# Auswertung über alle bisher gespeicherten Snapshots (siehe portfolio_analytics.py)
+analytics = analyze(snapshot_store.load())
 
+for label, value, weight in analytics["allocation"]:
+    print(f"allocation {label}: {format_number(value)} ({format_number(weight)} %)")
+print(f"weighted dailyPerformance: {format_number(analytics['daily_performance'])} %")
+print(
+    f"timeWeightedReturn since {analytics['since']}: {format_number(analytics['time_weighted_return'])} %"
+)
+print(
+    f"moneyWeightedReturn since {analytics['since']}: {format_number(analytics['money_weighted_return'])} % p.a."
+)
+print(
+    f"maxDrawdown: {format_number(analytics['max_drawdown'])} % ({analytics['max_drawdown_at']})"
+)
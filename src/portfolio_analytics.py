@@ -0,0 +1,268 @@
+import numpy as np
+
+# Auswertungen über einen oder mehrere Snapshots (siehe snapshot_store.py).
+#
+# Alle Berechnungen erfolgen mit NumPy-Arrays statt mit Schleifen über die einzelnen
+# Dictionaries. Dafür werden die Positionen aller Snapshots einmalig in flache Arrays
+# überführt (eine Zeile pro Position und Snapshot, mit dem Index des Snapshots und der
+# ISIN als Zuordnung). Summen pro Snapshot entstehen dann mit np.bincount, Werte pro
+# Snapshot und ISIN als Matrix. So bleiben auch Jahre an täglichen Snapshots deutlich
+# unter einer Sekunde.
+
+CASH_LABEL = "Kontostand"
+
+
+# Überführt die Positionen der Snapshots in flache Arrays. Gibt ein Dictionary mit den Arrays
+# snapshot (Index des Snapshots), isin, name, category und den Zahlenfeldern zurück.
+def _flatten_positions(snapshots):
+    positions = [
+        (i, position)
+        for i, snapshot in enumerate(snapshots)
+        for account in snapshot["accounts"]
+        for position in account["portfolio"]["positions"]
+    ]
+
+    def numbers(field):
+        return np.fromiter(
+            (position.get(field, 0.0) for _, position in positions),
+            dtype=float,
+            count=len(positions),
+        )
+
+    return {
+        "snapshot": np.fromiter(
+            (i for i, _ in positions), dtype=np.intp, count=len(positions)
+        ),
+        "isin": np.array([position["isin"] for _, position in positions], dtype=str),
+        "name": np.array([position["name"] for _, position in positions], dtype=str),
+        "category": np.array(
+            [position.get("category", "") for _, position in positions], dtype=str
+        ),
+        "quantity": numbers("quantity"),
+        "lastValue": numbers("lastValue"),
+        "actualValue": numbers("actualValue"),
+        "totalValue": numbers("totalValue"),
+        "totalPerformance": numbers("totalPerformance"),
+        "performancePercentage": numbers("performancePercentage"),
+        "dailyTotalPerformance": numbers("dailyTotalPerformance"),
+    }
+
+
+# Gibt pro Snapshot die Summe der Kontostände aller Konten zurück.
+def _cash(snapshots):
+    return np.array(
+        [
+            sum(
+                account["account"]["currentBalance"] for account in snapshot["accounts"]
+            )
+            for snapshot in snapshots
+        ],
+        dtype=float,
+    )
+
+
+# Die Vermögensaufteilung eines Snapshots nach Kategorie (z.B. ETF, STK) inklusive der
+# Kontostände. Gibt eine nach Wert absteigend sortierte Liste von (Kategorie, Wert, Anteil in %)
+# zurück.
+def asset_allocation(snapshot):
+    flat = _flatten_positions([snapshot])
+    categories, inverse = np.unique(flat["category"], return_inverse=True)
+    values = np.bincount(
+        inverse, weights=flat["actualValue"], minlength=len(categories)
+    )
+
+    labels = np.append(categories, CASH_LABEL)
+    values = np.append(values, _cash([snapshot])[0])
+    weights = values / values.sum() * 100 if values.sum() else np.zeros_like(values)
+
+    order = np.argsort(-values)
+    return [
+        (str(labels[i]), float(values[i]), float(weights[i]))
+        for i in order
+        if values[i] != 0
+    ]
+
+
+# Die Gewichte der einzelnen Positionen eines Snapshots (ohne Kontostände), nach Gewicht
+# absteigend sortiert. Gibt eine Liste von (ISIN, Name, Wert, Anteil in %) zurück. Dieselbe
+# ISIN in mehreren Konten wird zusammengefasst.
+def position_weights(snapshot):
+    flat = _flatten_positions([snapshot])
+    isins, first, inverse = np.unique(
+        flat["isin"], return_index=True, return_inverse=True
+    )
+    values = np.bincount(inverse, weights=flat["actualValue"], minlength=len(isins))
+    weights = values / values.sum() * 100 if values.sum() else np.zeros_like(values)
+
+    order = np.argsort(-values)
+    return [
+        (
+            str(isins[i]),
+            str(flat["name"][first[i]]),
+            float(values[i]),
+            float(weights[i]),
+        )
+        for i in order
+    ]
+
+
+# Die Tagesperformance eines Snapshots in %, gewichtet mit dem Wert der Positionen zu Beginn
+# des Tages (aktueller Wert abzüglich der Tagesperformance).
+def weighted_daily_performance(snapshot):
+    flat = _flatten_positions([snapshot])
+    previous_values = flat["actualValue"] - flat["dailyTotalPerformance"]
+    if previous_values.sum() == 0:
+        return 0.0
+
+    returns = np.divide(
+        flat["dailyTotalPerformance"],
+        previous_values,
+        out=np.zeros_like(previous_values),
+        where=previous_values != 0,
+    )
+    weights = previous_values / previous_values.sum()
+    return float(np.dot(weights, returns) * 100)
+
+
+# Die Zeitreihen über alle Snapshots als Arrays:
+#
+#   - times: Zeitpunkte der Snapshots (datetime64)
+#   - values: Gesamtwert (Positionen + Kontostände)
+#   - gains: Kursgewinne seit dem vorherigen Snapshot, also die Veränderung von lastValue für die
+#     Stückzahl, die im vorherigen Snapshot gehalten wurde. Käufe, Verkäufe, Ein- und
+#     Auszahlungen verändern den Gesamtwert, aber nicht die Kursgewinne.
+#   - flows: Ein- bzw. Auszahlungen seit dem vorherigen Snapshot, also die Veränderung des
+#     Gesamtwertes, die nicht durch Kursgewinne erklärt wird.
+#   - position_values: Matrix (Snapshots x ISINs) der Werte je Position
+#   - position_performance: Matrix (Snapshots x ISINs) der Gesamtperformance je Position in %,
+#     NaN wenn die Position in dem Snapshot nicht gehalten wurde
+#   - isins, names: ISINs und Namen zu den Spalten von position_values
+def history(snapshots):
+    flat = _flatten_positions(snapshots)
+    n = len(snapshots)
+
+    times = np.array(
+        [snapshot["timestamp"] for snapshot in snapshots], dtype="datetime64[s]"
+    )
+    values = np.bincount(
+        flat["snapshot"], weights=flat["actualValue"], minlength=n
+    ) + _cash(snapshots)
+
+    isins, first, column = np.unique(
+        flat["isin"], return_index=True, return_inverse=True
+    )
+    quantities = np.zeros((n, len(isins)))
+    prices = np.full((n, len(isins)), np.nan)
+    position_performance = np.full((n, len(isins)), np.nan)
+    position_values = np.zeros((n, len(isins)))
+    np.add.at(quantities, (flat["snapshot"], column), flat["quantity"])
+    np.add.at(position_values, (flat["snapshot"], column), flat["actualValue"])
+    prices[flat["snapshot"], column] = flat["lastValue"]
+    position_performance[flat["snapshot"], column] = flat["performancePercentage"]
+
+    # Wurde eine Position im aktuellen Snapshot verkauft, ist ihr Kurs unbekannt. Sie zählt dann
+    # mit dem letzten bekannten Kurs, trägt also keinen Kursgewinn bei.
+    price_changes = np.nan_to_num(np.diff(prices, axis=0))
+    gains = np.concatenate(([0.0], (quantities[:-1] * price_changes).sum(axis=1)))
+    flows = np.concatenate(([0.0], np.diff(values))) - gains
+
+    return {
+        "times": times,
+        "values": values,
+        "gains": gains,
+        "flows": flows,
+        "position_values": position_values,
+        "position_performance": position_performance,
+        "isins": isins,
+        "names": flat["name"][first],
+    }
+
+
+# Die zeitgewichtete Rendite (TWR) in %. Die Rendite jedes Zeitraums zwischen zwei Snapshots
+# ist der Kursgewinn bezogen auf den Gesamtwert zu Beginn des Zeitraums, Ein- und Auszahlungen
+# fließen also nicht ein. Gibt die kumulierte Rendite für jeden Snapshot zurück.
+def time_weighted_returns(values, gains):
+    previous_values = values[:-1]
+    period_returns = np.divide(
+        gains[1:],
+        previous_values,
+        out=np.zeros_like(previous_values),
+        where=previous_values != 0,
+    )
+    return (np.concatenate(([1.0], np.cumprod(1 + period_returns))) - 1) * 100
+
+
+# Die geldgewichtete Rendite (MWR, interner Zinsfuß) in % pro Jahr. Der Anfangswert und alle
+# Einzahlungen werden als Investition, der Endwert als Rückfluss betrachtet. Der Zinsfuß wird
+# mit dem Newton-Verfahren bestimmt, jede Iteration rechnet dabei über alle Zahlungen auf einmal.
+def money_weighted_return(times, values, flows, iterations=50):
+    if len(values) < 2 or values[0] <= 0:
+        return 0.0
+
+    years = (times[-1] - times).astype("timedelta64[s]").astype(float) / (
+        365.25 * 24 * 3600
+    )
+    if years[0] == 0:
+        return 0.0
+
+    # Zahlungen aus Sicht des Anlegers: Investitionen negativ, der Endwert positiv.
+    payments = -flows.copy()
+    payments[0] = -values[0]
+    payments[-1] += values[-1]
+
+    rate = 0.0
+    for _ in range(iterations):
+        growth = (1 + rate) ** years
+        npv = np.dot(payments, growth)
+        derivative = np.dot(payments, years * (1 + rate) ** (years - 1))
+        if derivative == 0:
+            break
+
+        step = npv / derivative
+        rate = max(rate - step, -0.99)
+        if abs(step) < 1e-10:
+            break
+
+    return float(rate * 100)
+
+
+# Die Drawdowns in %, also der Rückgang der zeitgewichteten Wertentwicklung gegenüber dem
+# bisherigen Höchststand, für jeden Snapshot. Das Minimum ist der maximale Drawdown.
+def drawdowns(time_weighted):
+    index = 1 + time_weighted / 100
+    running_max = np.maximum.accumulate(index)
+    return (index / running_max - 1) * 100
+
+
+# Führt alle Auswertungen für die Historie der Snapshots aus. Der letzte Snapshot gilt als der
+# aktuelle Stand.
+def analyze(snapshots):
+    current = snapshots[-1]
+    result = {
+        "timestamp": current["timestamp"],
+        "allocation": asset_allocation(current),
+        "weights": position_weights(current),
+        "daily_performance": weighted_daily_performance(current),
+        "snapshots": len(snapshots),
+        "since": snapshots[0]["timestamp"],
+    }
+
+    series = history(snapshots)
+    time_weighted = time_weighted_returns(series["values"], series["gains"])
+    drawdown = drawdowns(time_weighted)
+    max_drawdown_at = int(np.argmin(drawdown))
+
+    result.update(
+        {
+            "value": float(series["values"][-1]),
+            "flows": float(series["flows"].sum()),
+            "time_weighted_return": float(time_weighted[-1]),
+            "money_weighted_return": money_weighted_return(
+                series["times"], series["values"], series["flows"]
+            ),
+            "current_drawdown": float(drawdown[-1]),
+            "max_drawdown": float(drawdown[max_drawdown_at]),
+            "max_drawdown_at": str(series["times"][max_drawdown_at]),
+        }
+    )
+    return result
@@ -0,0 +1,47 @@
+import io
+import numpy as np
+from matplotlib.figure import Figure
+from portfolio_analytics import history
+
+# Rendert die Entwicklung des Depots als PNG. Es wird direkt mit einem Figure-Objekt gearbeitet
+# (ohne pyplot), damit ausschließlich das Agg-Backend verwendet wird und kein Display benötigt
+# wird. Das Rendern ist auf dem Raspberry Pi vergleichsweise teuer, daher werden die Bilder im
+# ChartCache (siehe chart_cache.py) zwischengespeichert.
+
+# Anzahl der Positionen (nach aktuellem Wert), deren Performance einzeln dargestellt wird.
+MAX_POSITIONS = 8
+
+
+# Gibt ein PNG (als bytes) mit zwei Diagrammen zurück: oben der Gesamtwert des Depots
+# (Positionen + Kontostände) über die Zeit, unten die Gesamtperformance in % der größten
+# Positionen über die Zeit.
+def render_portfolio_chart(snapshots, max_positions=MAX_POSITIONS):
+    series = history(snapshots)
+    times = series["times"].astype("datetime64[s]").astype(object)
+
+    figure = Figure(figsize=(8, 8), dpi=100)
+    value_axes, performance_axes = figure.subplots(2, 1, sharex=True)
+
+    value_axes.plot(times, series["values"], color="tab:blue")
+    value_axes.set_title("Gesamtwert (EUR)")
+    value_axes.grid(True, alpha=0.3)
+
+    largest = np.argsort(-series["position_values"][-1])[:max_positions]
+    for column in largest:
+        performance_axes.plot(
+            times,
+            series["position_performance"][:, column],
+            label=str(series["names"][column])[:25],
+        )
+    performance_axes.axhline(0, color="grey", linewidth=0.8)
+    performance_axes.set_title("Performance je Position (%)")
+    performance_axes.grid(True, alpha=0.3)
+    if len(largest):
+        performance_axes.legend(fontsize="small", loc="upper left")
+
+    figure.autofmt_xdate()
+    figure.tight_layout()
+
+    png = io.BytesIO()
+    figure.savefig(png, format="png")
+    return png.getvalue()
@@ -1,3 +1,12 @@
+from typing import Optional
+from loguru import logger
+from onvistabank_api.OnVistaApi import OnVistaApi, OnVistaApiOTPRequiredException
+from onvistabank_api.OnVistaLowLevelApi import (
+    OnVistaException,
+    OnVistaOTPIsWrongException,
+)
+
+
 class OTPRequiredException(Exception):
     def __init__(self):
         super().__init__("An OTP (One-Time-Password) is required to continue.")
@@ -22,24 +31,30 @@ def format_number(number: float) -> str:
     )
 
 
-# Gibt für einen Account bei der OnVistaBank alle verknüpften Konten
-# und deren Positionen sowie die Gesamtperformance und weitere Daten
-# in einer Nachricht im Markdown-Format zurück. Diese kann dann so als
-# Telegram-Nachricht verschickt werden.
-#
-# Im ersten Aufruf muss keine TAN übergeben werden. Wenn der Server
-# eine TAN anfordert, wird eine OTPRequiredException geworfen. In diesem
-# Fall muss die Funktion erneut aufgerufen werden und die TAN übergeben
-# werden. Wenn die TAN falsch ist, wird eine OTPWrongException geworfen.
-#
-# Beispielanwendung:
-#
-#   try:
-#       message = get_portfolio_message_markdown(api)
-#   except OTPRequiredException:
-#       message = get_portfolio_message_markdown(api, tan)
+# Maskiert die Zeichen, die in Telegrams MarkdownV2 eine Sonderbedeutung haben, aber in unseren
+# Nachrichten nur als normaler Text vorkommen (Fettschrift mit * bleibt erhalten).
+def escape_markdown(message: str) -> str:
+    return (
+        message.replace(".", "\\.")
+        .replace("(", "\\(")
+        .replace(")", "\\)")
+        .replace("-", "\\-")
+        .replace("+", "\\+")
+        .replace("!", "\\!")
+        .replace("=", "\\=")
+    )
+
+
+# Stellt sicher, dass der Benutzer eingeloggt ist. Wenn der Server eine TAN anfordert,
+# wird eine OTPRequiredException geworfen. In diesem Fall muss die Funktion erneut
+# aufgerufen werden und die TAN übergeben werden. Wenn die TAN falsch ist, wird eine
+# OTPWrongException geworfen.
 #
-def get_portfolio_message_markdown(api: OnVistaApi, tan: Optional[str] = None):
+# Mit auto_generate_otp = False wird kein OTP per SMS verschickt, wenn eines benötigt wird. Das
+# ist für Jobs gedacht, bei denen niemand auf eine SMS wartet.
+def ensure_login(
+    api: OnVistaApi, tan: Optional[str] = None, auto_generate_otp: bool = True
+):
     try:
         if tan:
             try:
@@ -47,62 +62,192 @@ def get_portfolio_message_markdown(api: OnVistaApi, tan: Optional[str] = None):
             except OnVistaOTPIsWrongException:
                 raise OTPWrongException()
 
-        api.login()
+        api.login(auto_generate_otp=auto_generate_otp)
     except OnVistaApiOTPRequiredException:
         raise OTPRequiredException()
 
-    res = api.get_accounts()
 
-    # Die Konten dieses Logins abfragen
-    accounts_result = api.get_accounts()
-    for i, account in enumerate(accounts_result["accountsList"], start=1):
-        logger.info("Account: {}", account)
+# Gibt die Kurzbezeichnung eines Kontos zurück, wie sie in allen Nachrichten verwendet wird.
+def format_account_title(i: int, account) -> str:
+    return f"Konto {i} ({account['iban'][-3:]})"
+
 
-        account_key = account["accountKey"]
+# Gibt die Details einer einzelnen Position (noch ohne Markdown-Maskierung) zurück.
+def format_position(position) -> str:
+    message = f'{position["name"]} (ISIN: {position["isin"]})\n'
+    message += f'Anzahl: *{position["quantity"]} Anteile*\n'
+    message += "\n"
 
-        # Die (Aktien-)Positionen für diesen Account abfragen
-        positions = api.trading_positions(account_key)["portfolio"]["positions"]
+    message += "Werte pro Anteil:\n"
+    message += f"Kaufwert: *{format_number(position['buyingValue'])} EUR*\n"
+    message += f"Aktueller Wert: *{format_number(position['lastValue'])} EUR*\n"
+    message += "\n"
 
-        message = "\n"
-        message += f"*Konto {i}* ({account['iban'][-3:]})\n"
+    message += "Performance (heute)\n"
+    message += f"absolut: *{format_number(position['dailyTotalPerformance'])} EUR*\n"
+    message += f"relativ: *{format_number(position['dailyPerformancePx'])} %*\n"
+    message += "\n"
+
+    message += "Performance (gesamt)\n"
+    message += f"Kaufwert: *{format_number(position['totalValue'])} EUR*\n"
+    message += f"Aktueller Wert: *{format_number(position['actualValue'])} EUR*\n"
+    message += f"absolut: *{format_number(position['totalPerformance'])} EUR*\n"
+    message += f"relativ: *{format_number(position['performancePercentage'])} %*\n"
+    return message
+
+
+# Gibt alle Konten und deren Positionen eines Snapshots (siehe snapshot_store.py) in einer
+# Nachricht im Markdown-Format zurück.
+def get_snapshot_message_markdown(snapshot):
+    message = ""
+
+    for i, entry in enumerate(snapshot["accounts"], start=1):
+        account = entry["account"]
+        portfolio = entry["portfolio"]
+        logger.info("Account: {}", account)
+
+        message += "\n"
+        message += f"*{format_account_title(i, account)}*\n"
         message += f"Kaufkraft: {format_number(account['buyPower'])} EUR\n"
         message += f"Kontostand: {format_number(account['currentBalance'])} EUR\n"
-        message += f"Gesamtwert: {format_number(sum([position['actualValue'] for position in positions]) + account['currentBalance'])} EUR\n"
+        message += f"Gesamtwert: {format_number(portfolio['total']['actualValue'] + account['currentBalance'])} EUR\n"
 
-        for position in positions:
-            message += "\n"
-            message += f'{position["name"]} (ISIN: {position["isin"]})\n'
-            message += f'Anzahl: *{position["quantity"]} Anteile*\n'
+        for position in portfolio["positions"]:
             message += "\n"
+            message += format_position(position)
 
-            message += "Werte pro Anteil:\n"
-            message += f"Kaufwert: *{format_number(position['buyingValue'])} EUR*\n"
-            message += f"Aktueller Wert: *{format_number(position['lastValue'])} EUR*\n"
-            message += "\n"
+    return escape_markdown(message)
 
-            message += "Performance (heute)\n"
-            message += (
-                f"absolut: *{format_number(position['dailyTotalPerformance'])} EUR*\n"
-            )
-            message += f"relativ: *{format_number(position['dailyPerformancePx'])} %*\n"
-            message += "\n"
 
-            message += "Performance (gesamt)\n"
-            message += f"Kaufwert: *{format_number(position['totalValue'])} EUR*\n"
-            message += (
-                f"Aktueller Wert: *{format_number(position['actualValue'])} EUR*\n"
-            )
-            message += f"absolut: *{format_number(position['totalPerformance'])} EUR*\n"
+# Die Übersichtsseite des Portfolios: alle Konten mit Kaufkraft und Kontostand. Dafür
+# reicht die Antwort von getAccountsList, es werden also keine Positionen abgefragt.
+def get_overview_message_markdown(accounts_result):
+    accounts = accounts_result["accountsList"]
+
+    message = "*Übersicht*\n"
+    for i, account in enumerate(accounts, start=1):
+        message += "\n"
+        message += f"*{format_account_title(i, account)}*\n"
+        message += f"Kaufkraft: {format_number(account['buyPower'])} EUR\n"
+        message += f"Kontostand: {format_number(account['currentBalance'])} EUR\n"
+
+    message += "\n"
+    message += f"Summe Kontostände: *{format_number(sum([account['currentBalance'] for account in accounts]))} EUR*\n"
+    message += "\n"
+    message += "Für die Positionen und den Depotwert bitte ein Konto auswählen.\n"
+
+    return escape_markdown(message)
+
+
+# Die Seite eines einzelnen Kontos mit dem Depotwert laut der Antwort von getPositions.
+# Die einzelnen Positionen werden nicht ausgegeben, sondern als Buttons angezeigt.
+def get_account_message_markdown(i: int, account, portfolio, page: int, pages: int):
+    total = portfolio["total"]
+
+    message = f"*{format_account_title(i, account)}*\n"
+    message += f"Kaufkraft: {format_number(account['buyPower'])} EUR\n"
+    message += f"Kontostand: {format_number(account['currentBalance'])} EUR\n"
+    message += f"Gesamtwert: *{format_number(total['actualValue'] + account['currentBalance'])} EUR*\n"
+    message += "\n"
+    message += f"Depotwert: {format_number(total['actualValue'])} EUR\n"
+    message += f"Performance (heute): {format_number(total['totalDailyPerformance'])} EUR ({format_number(total['totalDailyPerformancePx'])} %)\n"
+    message += f"Performance (gesamt): {format_number(total['totalPerformance'])} EUR ({format_number(total['performancePercentage'])} %)\n"
+    message += "\n"
+    message += f"{len(portfolio['positions'])} Positionen (Seite {page + 1}/{pages})\n"
+
+    return escape_markdown(message)
+
+
+# Die Seite einer einzelnen Position.
+def get_position_message_markdown(i: int, account, position):
+    message = f"*{format_account_title(i, account)}*\n"
+    message += "\n"
+    message += format_position(position)
+
+    return escape_markdown(message)
+
+
+# Gibt die Kurse zu den angefragten ISINs (Dictionary ISIN -> Kurs, siehe OnVistaApi.get_quotes())
+# als Nachricht im Markdown-Format zurück. ISINs, deren Abfrage fehlgeschlagen ist, werden mit
+# einem Hinweis aufgeführt.
+def get_quotes_message_markdown(quotes):
+    message = ""
+
+    for isin, quote in quotes.items():
+        message += "\n"
+        # Die Meldung der Bank wird nicht übernommen, sie könnte Zeichen enthalten, die in
+        # MarkdownV2 eine Sonderbedeutung haben.
+        if isinstance(quote, OnVistaException):
+            message += f"ISIN {isin}: kein Kurs verfügbar (Fehler {quote.code})\n"
+            continue
+
+        message += f"{quote.get('label', isin)} (ISIN: {isin})\n"
+        message += (
+            f"Kurs: *{format_number(quote['last'])} {quote.get('currency', 'EUR')}*\n"
+        )
+
+        if quote.get("previousClose"):
+            change = quote["last"] - quote["previousClose"]
+            message += f"Veränderung: *{format_number(change)} {quote.get('currency', 'EUR')}* ({format_number(change / quote['previousClose'] * 100)} %)\n"
+
+        if quote.get("tradeDate"):
             message += (
-                f"relativ: *{format_number(position['performancePercentage'])} %*\n"
+                f"Stand: {quote['tradeDate']} ({quote.get('exchangeLabel', '')})\n"
             )
 
-    return (
-        message.replace(".", "\.")
-        .replace("(", "\(")
-        .replace(")", "\)")
-        .replace("-", "\-")
-        .replace("+", "\+")
-        .replace("!", "\!")
-        .replace("=", "\=")
+    return escape_markdown(message)
+
+
+# Gibt das Ergebnis der Auswertungen (siehe portfolio_analytics.analyze()) als Nachricht im
+# Markdown-Format zurück.
+def get_analytics_message_markdown(analytics, max_positions=10):
+    message = f"*Auswertung* (Stand: {analytics['timestamp']})\n"
+    message += f"Gesamtwert: *{format_number(analytics['value'])} EUR*\n"
+    message += f"Performance (heute, gewichtet): *{format_number(analytics['daily_performance'])} %*\n"
+    message += "\n"
+
+    message += "*Aufteilung*\n"
+    for label, value, weight in analytics["allocation"]:
+        message += f"{label}: {format_number(value)} EUR ({format_number(weight)} %)\n"
+    message += "\n"
+
+    message += "*Gewichte der Positionen*\n"
+    for isin, name, value, weight in analytics["weights"][:max_positions]:
+        message += f"{name}: {format_number(weight)} %\n"
+    if len(analytics["weights"]) > max_positions:
+        message += f"... und {len(analytics['weights']) - max_positions} weitere\n"
+    message += "\n"
+
+    message += f"*Historie* ({analytics['snapshots']} Snapshots seit {analytics['since'][:10]})\n"
+    message += f"Ein-/Auszahlungen: {format_number(analytics['flows'])} EUR\n"
+    message += f"Zeitgewichtete Rendite: *{format_number(analytics['time_weighted_return'])} %*\n"
+    message += f"Geldgewichtete Rendite: *{format_number(analytics['money_weighted_return'])} % p.a.*\n"
+    message += f"Aktueller Drawdown: {format_number(analytics['current_drawdown'])} %\n"
+    message += f"Maximaler Drawdown: {format_number(analytics['max_drawdown'])} % ({analytics['max_drawdown_at'][:10]})\n"
+
+    return escape_markdown(message)
+
+
+# Gibt das Ergebnis eines Abgleichs der Historie (siehe transaction_store.py) mit der
+# Kostenbasis und den realisierten Gewinnen (siehe cost_basis.py) im Markdown-Format zurück.
+def get_cost_basis_message_markdown(added, cost_basis, max_positions=15):
+    message = f"*Historie abgeglichen*\n"
+    message += (
+        f"Neue Transaktionen: {added['transactions']}, neue Orders: {added['orders']}\n"
     )
+    message += "\n"
+
+    message += "*Kostenbasis (FIFO)*\n"
+    held = [position for position in cost_basis["positions"] if position["quantity"]]
+    for position in held[:max_positions]:
+        message += f"{position['name']}: {position['quantity']} Anteile, Einstand *{format_number(position['cost_basis'])} EUR* (Ø {format_number(position['average_cost'])} EUR)\n"
+    if len(held) > max_positions:
+        message += f"... und {len(held) - max_positions} weitere\n"
+    message += "\n"
+
+    message += "*Realisierte Gewinne und Erträge*\n"
+    for year, totals in cost_basis["years"].items():
+        message += f"{year}: Gewinne {format_number(totals['realized_gain'])} EUR, Erträge {format_number(totals['income'])} EUR\n"
+    message += f"Gesamt: Gewinne *{format_number(cost_basis['realized_gain'])} EUR*, Erträge *{format_number(cost_basis['income'])} EUR*\n"
+
+    return escape_markdown(message)
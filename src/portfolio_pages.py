@@ -0,0 +1,182 @@
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from onvistabank_api.OnVistaApi import OnVistaApi
+from portfolio_message import (
+    get_overview_message_markdown,
+    get_account_message_markdown,
+    get_position_message_markdown,
+    escape_markdown,
+)
+
+# Die seitenweise Darstellung des Portfolios mit Inline-Keyboards. Statt bei jedem
+# /portfolio alle Positionen aller Konten abzufragen, wird zunächst nur die Übersicht
+# (ein Request an getAccountsList) angezeigt. Erst wenn der Benutzer auf ein Konto tippt,
+# werden dessen Positionen abgefragt. Die Seiten werden per Callback-Query an Ort und
+# Stelle ausgetauscht (edit_message_text), es entstehen also keine neuen Nachrichten.
+#
+# Die Callback-Daten (maximal 64 Bytes) haben folgendes Format:
+#
+#   pf:o                                 -> Übersicht
+#   pf:a:<accountKey>:<page>[:r]         -> Konto, Seite <page> der Positionsliste, mit :r
+#                                           werden die Positionen neu abgefragt
+#   pf:p:<accountKey>:<isin>:<page>      -> Position, <page> ist die Seite für "Zurück"
+CALLBACK_PREFIX = "pf:"
+
+# Anzahl der Positionen pro Seite eines Kontos.
+POSITIONS_PER_PAGE = 8
+
+
+# Die Antworten der API werden pro Chat in chat_data zwischengespeichert, damit z.B. das
+# Öffnen einer Position und das Zurückblättern keine erneuten Requests auslöst. Beim Öffnen
+# der Übersicht bzw. eines Kontos werden die Daten immer neu abgefragt.
+def _get_accounts(api: OnVistaApi, chat_data, refresh: bool):
+    if refresh or "portfolio_accounts" not in chat_data:
+        chat_data["portfolio_accounts"] = api.get_accounts()
+        chat_data["portfolio_positions"] = {}
+
+    return chat_data["portfolio_accounts"]
+
+
+def _get_portfolio(api: OnVistaApi, chat_data, account_key, refresh: bool):
+    positions_cache = chat_data.setdefault("portfolio_positions", {})
+    if refresh or account_key not in positions_cache:
+        positions_cache[account_key] = api.trading_positions(account_key)["portfolio"]
+
+    return positions_cache[account_key]
+
+
+# Sucht das Konto mit dem angegebenen Account-Key und gibt es zusammen mit seiner
+# Nummer (beginnend bei 1) zurück.
+def _find_account(accounts_result, account_key):
+    for i, account in enumerate(accounts_result["accountsList"], start=1):
+        if account["accountKey"] == account_key:
+            return i, account
+
+    raise KeyError(f"Unknown account {account_key}")
+
+
+# Gibt die Übersichtsseite als (Nachricht, Keyboard) zurück.
+def overview_page(api: OnVistaApi, chat_data):
+    accounts_result = _get_accounts(api, chat_data, refresh=True)
+
+    keyboard = [
+        [
+            InlineKeyboardButton(
+                f"Konto {i} ({account['iban'][-3:]})",
+                callback_data=f"{CALLBACK_PREFIX}a:{account['accountKey']}:0:r",
+            )
+        ]
+        for i, account in enumerate(accounts_result["accountsList"], start=1)
+    ]
+
+    return get_overview_message_markdown(accounts_result), InlineKeyboardMarkup(
+        keyboard
+    )
+
+
+# Gibt die Seite eines Kontos als (Nachricht, Keyboard) zurück. Das Keyboard enthält die
+# Positionen der aktuellen Seite, die Navigation zwischen den Seiten und den Weg zurück.
+def account_page(api: OnVistaApi, chat_data, account_key, page: int, refresh: bool):
+    i, account = _find_account(
+        _get_accounts(api, chat_data, refresh=False), account_key
+    )
+    portfolio = _get_portfolio(api, chat_data, account_key, refresh)
+    positions = portfolio["positions"]
+
+    pages = max(1, -(-len(positions) // POSITIONS_PER_PAGE))
+    page = min(max(page, 0), pages - 1)
+
+    keyboard = [
+        [
+            InlineKeyboardButton(
+                position["name"],
+                callback_data=f"{CALLBACK_PREFIX}p:{account_key}:{position['isin']}:{page}",
+            )
+        ]
+        for position in positions[
+            page * POSITIONS_PER_PAGE : (page + 1) * POSITIONS_PER_PAGE
+        ]
+    ]
+
+    navigation = []
+    if page > 0:
+        navigation.append(
+            InlineKeyboardButton(
+                "« Zurück",
+                callback_data=f"{CALLBACK_PREFIX}a:{account_key}:{page - 1}",
+            )
+        )
+    if page < pages - 1:
+        navigation.append(
+            InlineKeyboardButton(
+                "Weiter »",
+                callback_data=f"{CALLBACK_PREFIX}a:{account_key}:{page + 1}",
+            )
+        )
+    if navigation:
+        keyboard.append(navigation)
+
+    keyboard.append(
+        [InlineKeyboardButton("Übersicht", callback_data=f"{CALLBACK_PREFIX}o")]
+    )
+
+    return get_account_message_markdown(
+        i, account, portfolio, page, pages
+    ), InlineKeyboardMarkup(keyboard)
+
+
+# Gibt die Seite einer Position als (Nachricht, Keyboard) zurück. Die Position stammt aus
+# dem Zwischenspeicher der Kontoseite, es wird also in der Regel kein Request ausgelöst.
+#
+# Ein Button kann veraltet sein, z.B. nach einem Verkauf oder einem Neustart des Bots (dann ist
+# chat_data leer und die Positionen werden neu abgefragt). Gibt es die Position nicht mehr, wird
+# stattdessen die Kontoseite mit einem Hinweis angezeigt.
+def position_page(api: OnVistaApi, chat_data, account_key, isin, page: int):
+    i, account = _find_account(
+        _get_accounts(api, chat_data, refresh=False), account_key
+    )
+    portfolio = _get_portfolio(api, chat_data, account_key, refresh=False)
+
+    position = next(
+        (position for position in portfolio["positions"] if position["isin"] == isin),
+        None,
+    )
+    if position is None:
+        message, keyboard = account_page(
+            api, chat_data, account_key, page, refresh=False
+        )
+        return (
+            escape_markdown(f"Position {isin} nicht mehr vorhanden.")
+            + "\n\n"
+            + message,
+            keyboard,
+        )
+
+    keyboard = [
+        [
+            InlineKeyboardButton(
+                "« Konto", callback_data=f"{CALLBACK_PREFIX}a:{account_key}:{page}"
+            ),
+            InlineKeyboardButton("Übersicht", callback_data=f"{CALLBACK_PREFIX}o"),
+        ]
+    ]
+
+    return get_position_message_markdown(i, account, position), InlineKeyboardMarkup(
+        keyboard
+    )
+
+
+# Wertet die Callback-Daten eines Buttons aus und gibt die entsprechende Seite als
+# (Nachricht, Keyboard) zurück.
+def page_for_callback(api: OnVistaApi, chat_data, callback_data: str):
+    parts = callback_data[len(CALLBACK_PREFIX) :].split(":")
+
+    if parts[0] == "a":
+        # Beim Blättern innerhalb eines Kontos werden die Positionen nicht neu abgefragt,
+        # nur beim Öffnen des Kontos aus der Übersicht heraus.
+        return account_page(
+            api, chat_data, parts[1], int(parts[2]), refresh=parts[3:] == ["r"]
+        )
+    if parts[0] == "p":
+        return position_page(api, chat_data, parts[1], parts[2], int(parts[3]))
+
+    return overview_page(api, chat_data)
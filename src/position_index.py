@@ -0,0 +1,150 @@
+import difflib
+import re
+from bisect import bisect_left, insort
+
+# Ab dieser Ähnlichkeit (0 bis 1, siehe difflib.SequenceMatcher.ratio()) gilt ein Name bei der
+# unscharfen Suche als Treffer.
+FUZZY_CUTOFF = 0.6
+
+
+def _normalize(text):
+    return " ".join(re.findall(r"\w+", text.lower()))
+
+
+# Die Suchbegriffe einer Position: der vollständige Name und jedes einzelne Wort des Namens, damit
+# z.B. "msci" auch "AMUNDI MSCI EMU" findet.
+def _terms(position):
+    name = _normalize(position.get("name", ""))
+    if not name:
+        return []
+    return sorted({name, *name.split(" ")})
+
+
+# Die Felder einer Position, nach denen gesucht wird. Nur wenn sich diese ändern, muss eine
+# Position neu indiziert werden.
+def _indexed_fields(position):
+    return position["isin"], position.get("wkn"), _terms(position)
+
+
+# Ein Suchindex über die Positionen des neuesten Snapshots (siehe snapshot_store.py) im Speicher.
+#
+# Gesucht wird in dieser Reihenfolge, die erste Stufe mit Treffern gewinnt:
+#
+#   1. exakt nach ISIN oder WKN (Dictionaries)
+#   2. nach dem Anfang des Namens oder eines Wortes im Namen (sortierte Liste, per bisect)
+#   3. unscharf nach dem Namen oder einem Wort im Namen (difflib), z.B. bei Tippfehlern
+#
+# Ein Eintrag ist je Konto und ISIN gespeichert, eine Position in mehreren Konten wird also auch
+# mehrfach gefunden. Mit update() wird der Index auf einen neuen Snapshot gebracht. Dabei werden
+# nur die Positionen neu indiziert, deren Name oder WKN sich geändert hat bzw. die hinzugekommen
+# oder weggefallen sind. Bei allen anderen werden nur die Werte (Kurs, Anzahl usw.) ersetzt.
+class PositionIndex:
+    def __init__(self):
+        self.timestamp = None
+        # (accountKey, ISIN) -> (Nummer des Kontos, Konto, Position)
+        self.entries = {}
+        self.by_isin = {}
+        self.by_wkn = {}
+        # Sortierte Liste von (Suchbegriff, (accountKey, ISIN))
+        self.terms = []
+
+    # Bringt den Index auf den Stand des Snapshots. Ein älterer oder derselbe Snapshot wird
+    # ignoriert. Gibt zurück, wie viele Positionen hinzugekommen, geändert und entfernt wurden.
+    def update(self, snapshot):
+        changes = {"added": 0, "updated": 0, "removed": 0}
+        if self.timestamp is not None and snapshot["timestamp"] <= self.timestamp:
+            return changes
+
+        entries = {}
+        for i, entry in enumerate(snapshot["accounts"], start=1):
+            account = entry["account"]
+            for position in entry["portfolio"]["positions"]:
+                entries[(account["accountKey"], position["isin"])] = (
+                    i,
+                    account,
+                    position,
+                )
+
+        for key in list(self.entries):
+            if key not in entries:
+                self._remove(key)
+                changes["removed"] += 1
+
+        for key, entry in entries.items():
+            old_entry = self.entries.get(key)
+            if old_entry is None:
+                self._add(key, entry)
+                changes["added"] += 1
+            elif _indexed_fields(old_entry[2]) != _indexed_fields(entry[2]):
+                self._remove(key)
+                self._add(key, entry)
+                changes["updated"] += 1
+            else:
+                self.entries[key] = entry
+
+        self.timestamp = snapshot["timestamp"]
+        return changes
+
+    def _add(self, key, entry):
+        position = entry[2]
+        self.entries[key] = entry
+        self.by_isin.setdefault(position["isin"].upper(), set()).add(key)
+        if position.get("wkn"):
+            self.by_wkn.setdefault(position["wkn"].upper(), set()).add(key)
+        for term in _terms(position):
+            insort(self.terms, (term, key))
+
+    def _remove(self, key):
+        position = self.entries.pop(key)[2]
+        self._discard(self.by_isin, position["isin"].upper(), key)
+        if position.get("wkn"):
+            self._discard(self.by_wkn, position["wkn"].upper(), key)
+        for term in _terms(position):
+            i = bisect_left(self.terms, (term, key))
+            if i < len(self.terms) and self.terms[i] == (term, key):
+                del self.terms[i]
+
+    @staticmethod
+    def _discard(index, value, key):
+        keys = index.get(value)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del index[value]
+
+    # Gibt die passenden Positionen als Liste von (Nummer des Kontos, Konto, Position) zurück,
+    # sortiert nach Konto und Name.
+    def search(self, query):
+        return sorted(
+            (self.entries[key] for key in self._search_keys(query)),
+            key=lambda entry: (entry[0], entry[2].get("name", "")),
+        )
+
+    def _search_keys(self, query):
+        identifier = query.strip().upper()
+        if identifier in self.by_isin:
+            return set(self.by_isin[identifier])
+        if identifier in self.by_wkn:
+            return set(self.by_wkn[identifier])
+
+        term = _normalize(query)
+        if not term:
+            return set()
+
+        keys = set()
+        i = bisect_left(self.terms, (term,))
+        while i < len(self.terms) and self.terms[i][0].startswith(term):
+            keys.add(self.terms[i][1])
+            i += 1
+        if keys:
+            return keys
+
+        candidates = {indexed_term for indexed_term, _ in self.terms}
+        for match in difflib.get_close_matches(
+            term, candidates, n=5, cutoff=FUZZY_CUTOFF
+        ):
+            i = bisect_left(self.terms, (match,))
+            while i < len(self.terms) and self.terms[i][0] == match:
+                keys.add(self.terms[i][1])
+                i += 1
+        return keys
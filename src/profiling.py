@@ -0,0 +1,226 @@
+import cProfile
+import io
+import pstats
+import time
+import tracemalloc
+from datetime import datetime
+from loguru import logger
+
+# Funktionen, die im Bericht gesondert aufgeführt werden: das Erstellen der Seiten von /portfolio
+# (siehe portfolio_pages.py), der Login, die Requests an die Bank, das Erstellen der Nachrichten
+# und der Versand über Telegram.
+FOCUS_FUNCTIONS = [
+    "page_for_callback",
+    "overview_page",
+    "account_page",
+    "position_page",
+    "ensure_login",
+    "low_level_batch_request",
+    "_message_markdown",
+    "send_message",
+    "edit_message_text",
+    "reply_text",
+    "reply_markdown_v2",
+    "reply_photo",
+    "_post",
+]
+
+
+# Profiling im laufenden Betrieb, ohne den Bot neu starten zu müssen.
+#
+# Das Profiling läuft entweder für die nächsten N Ausführungen von /portfolio (runs) oder für ein
+# festes Zeitfenster (seconds). Dabei werden mit cProfile alle Funktionsaufrufe und mit
+# tracemalloc alle Speicherallokationen aufgezeichnet. Am Ende wird ein Bericht mit den teuersten
+# Funktionen und den größten Allokationen erstellt (siehe report()).
+#
+# cProfile zeichnet nur den Thread auf, in dem es aktiviert wurde. Die Requests an die Bank und
+# das Erstellen der Seiten laufen aber in eigenen Threads (siehe run_in_thread() in main.py).
+# Diese Aufrufe werden daher mit call() ausgeführt, das sie in ihrem Thread profiliert. Im
+# Bericht werden diese Profile mit dem der Event-Loop zusammengeführt.
+#
+# Im Ausführungs-Modus laufen cProfile und tracemalloc nur während der profilierten Ausführungen,
+# bis zur nächsten Ausführung von /portfolio können ja Tage vergehen. Die Allokationen werden am
+# Ende jeder Ausführung festgehalten und im Bericht zusammengefasst.
+#
+# Beispielanwendung:
+#
+#   profiler.start(runs=3)
+#   ...
+#   with profiler.run():
+#       await portfolio(...)
+#   if profiler.finished:
+#       report = profiler.stop()
+class Profiler:
+    def __init__(self):
+        self.profile = None
+        self.remaining_runs = None
+        self.deadline = None
+        self.started_at = None
+        self.report_chat_id = None
+        self.snapshots = []
+        self.thread_profiles = []
+        self.enabled = False
+        self._active_runs = 0
+
+    # Gibt zurück, ob gerade ein Profiling läuft.
+    @property
+    def running(self):
+        return self.profile is not None
+
+    # Gibt zurück, ob das laufende Profiling abgeschlossen ist, also alle Ausführungen profiliert
+    # wurden bzw. das Zeitfenster abgelaufen ist.
+    @property
+    def finished(self):
+        if not self.running or self._active_runs:
+            return False
+        if self.remaining_runs is not None:
+            return self.remaining_runs <= 0
+        return time.monotonic() >= self.deadline
+
+    # Startet das Profiling für die nächsten runs Ausführungen oder für seconds Sekunden. Im
+    # Zeitfenster-Modus wird sofort alles profiliert. report_chat_id ist der Chat, der den Bericht
+    # erhalten soll (None z.B. beim Start über die Kommandozeile).
+    def start(self, runs=None, seconds=None, report_chat_id=None):
+        if self.running:
+            raise RuntimeError("Profiling is already running")
+
+        logger.info(f"Profiling started (runs={runs}, seconds={seconds})")
+
+        self.profile = cProfile.Profile()
+        self.remaining_runs = runs
+        self.deadline = time.monotonic() + seconds if seconds else None
+        self.started_at = datetime.now()
+        self.report_chat_id = report_chat_id
+        self.snapshots = []
+        self.thread_profiles = []
+        self._active_runs = 0
+
+        if seconds:
+            tracemalloc.start(25)
+            self.profile.enable()
+            self.enabled = True
+
+    # Profiliert eine Ausführung (Kontextmanager). Läuft kein Profiling im Ausführungs-Modus,
+    # passiert nichts. Überlappende Ausführungen werden gemeinsam profiliert.
+    def run(self):
+        return _ProfiledRun(self)
+
+    def _begin_run(self):
+        if not self.running or self.remaining_runs is None:
+            return False
+        if self.remaining_runs <= 0:
+            return False
+
+        self.remaining_runs -= 1
+        self._active_runs += 1
+        if self._active_runs == 1:
+            tracemalloc.start(25)
+            self.profile.enable()
+            self.enabled = True
+        return True
+
+    def _end_run(self):
+        self._active_runs -= 1
+        # Wurde das Profiling während der Ausführung beendet (/profile stop), ist nichts mehr zu tun.
+        if self._active_runs == 0 and self.running:
+            self.profile.disable()
+            self.enabled = False
+            self._take_snapshot()
+
+    # Führt func(*args, **kwargs) im aktuellen Thread aus. Wird gerade profiliert, wird der Aufruf
+    # mit einem eigenen cProfile für diesen Thread aufgezeichnet und dessen Profil für den Bericht
+    # festgehalten. Endet der Aufruf erst nach dem Profiling, landet es in der Liste des beendeten
+    # Profilings und nicht in der eines späteren.
+    def call(self, func, *args, **kwargs):
+        if not self.enabled:
+            return func(*args, **kwargs)
+
+        thread_profiles = self.thread_profiles
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profile.disable()
+            thread_profiles.append(profile)
+
+    # Hält die bisher aufgezeichneten Allokationen fest und beendet tracemalloc.
+    def _take_snapshot(self):
+        if tracemalloc.is_tracing():
+            self.snapshots.append(tracemalloc.take_snapshot())
+            tracemalloc.stop()
+
+    # Beendet das Profiling und gibt den Bericht zurück.
+    def stop(self):
+        self.profile.disable()
+        self.enabled = False
+        self._take_snapshot()
+
+        report = self.report(self.profile, self.snapshots, self.thread_profiles)
+        logger.info("Profiling stopped")
+
+        self.profile = None
+        self.remaining_runs = None
+        self.deadline = None
+        self.snapshots = []
+        self.thread_profiles = []
+        return report
+
+    # Erstellt den Bericht: die teuersten Funktionen (kumulierte Zeit), die Funktionen aus
+    # FOCUS_FUNCTIONS und die Codezeilen mit den meisten Speicherallokationen (über alle
+    # profilierten Ausführungen zusammengefasst). Die Profile der Threads werden zum Profil der
+    # Event-Loop addiert.
+    def report(self, profile, snapshots, thread_profiles=(), limit=30):
+        output = io.StringIO()
+        output.write(
+            f"Profiling von {self.started_at.isoformat(timespec='seconds')} bis {datetime.now().isoformat(timespec='seconds')}\n\n"
+        )
+
+        output.write("=== Top-Funktionen (kumulierte Zeit) ===\n")
+        stats = pstats.Stats(profile, stream=output)
+        for thread_profile in thread_profiles:
+            # Ein Profil ohne einen einzigen Aufruf kann pstats nicht laden.
+            thread_profile.create_stats()
+            if thread_profile.stats:
+                stats.add(thread_profile)
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(limit)
+
+        output.write(
+            "=== Seiten, Login, Bank-Requests, Nachrichten und Telegram-Versand ===\n"
+        )
+        stats.print_stats("|".join(FOCUS_FUNCTIONS))
+
+        output.write("=== Top-Allokationen ===\n")
+        allocations = {}
+        for snapshot in snapshots:
+            snapshot = snapshot.filter_traces(
+                [
+                    tracemalloc.Filter(False, tracemalloc.__file__),
+                    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+                ]
+            )
+            for stat in snapshot.statistics("lineno"):
+                size, count = allocations.get(stat.traceback, (0, 0))
+                allocations[stat.traceback] = (size + stat.size, count + stat.count)
+
+        for traceback, (size, count) in sorted(
+            allocations.items(), key=lambda allocation: allocation[1][0], reverse=True
+        )[:limit]:
+            output.write(f"{traceback}: size={size / 1024:.1f} KiB, count={count}\n")
+
+        return output.getvalue()
+
+
+class _ProfiledRun:
+    def __init__(self, profiler):
+        self.profiler = profiler
+        self.profiled = False
+
+    def __enter__(self):
+        self.profiled = self.profiler._begin_run()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.profiled:
+            self.profiler._end_run()
+        return False
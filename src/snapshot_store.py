@@ -0,0 +1,164 @@
+import json
+from datetime import datetime, timedelta
+from loguru import logger
+from onvistabank_api.OnVistaApi import OnVistaApi
+
+# Ein Snapshot ist der Stand des Depots zu einem Zeitpunkt: alle Konten mit ihren Positionen.
+# Damit die Historie über Jahre klein bleibt, werden nur die Felder gespeichert, die für die
+# Nachrichten und die Auswertungen (siehe portfolio_analytics.py) benötigt werden.
+#
+# Beispiel:
+#
+# {
+#     'timestamp': '2024-03-07T21:45:31',
+#     'accounts': [
+#         {
+#             'account': {'accountKey': '70ece771d0d23b39c8eb5cae80b3d910', 'iban': 'DE29514108000370093041', 'buyPower': 1164.65, 'currentBalance': 1164.65, ...},
+#             'portfolio': {
+#                 'positions': [{'name': 'AMUNDI MSCI EMU', 'isin': 'LU1681045370', 'quantity': 420, 'actualValue': 29550, ...}],
+#                 'total': {'buyValue': 27451.2, 'actualValue': 29550, ...}
+#             }
+#         }
+#     ]
+# }
+ACCOUNT_FIELDS = [
+    "accountKey",
+    "accountNumber",
+    "iban",
+    "currency",
+    "buyPower",
+    "currentBalance",
+]
+
+POSITION_FIELDS = [
+    "name",
+    "isin",
+    "wkn",
+    "type",
+    "category",
+    "quantity",
+    "lastValue",
+    "buyingValue",
+    "totalValue",
+    "totalPerformance",
+    "performancePercentage",
+    "actualValue",
+    "dailyTotalPerformance",
+    "dailyPerformancePx",
+]
+
+
+def _pick(data, fields):
+    return {field: data[field] for field in fields if field in data}
+
+
+# Fragt die Konten und die Positionen aller Konten ab und gibt sie als Snapshot zurück. Der
+# Benutzer muss bereits eingeloggt sein. Der Snapshot wird zusätzlich im Session-Store abgelegt
+# (siehe get_shared_snapshot()).
+def fetch_snapshot(api: OnVistaApi):
+    accounts = []
+    for account in api.get_accounts()["accountsList"]:
+        portfolio = api.trading_positions(account["accountKey"])["portfolio"]
+
+        accounts.append(
+            {
+                "account": _pick(account, ACCOUNT_FIELDS),
+                "portfolio": {
+                    "positions": [
+                        _pick(position, POSITION_FIELDS)
+                        for position in portfolio["positions"]
+                    ],
+                    "total": portfolio["total"],
+                },
+            }
+        )
+
+    snapshot = {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "accounts": accounts,
+    }
+    api.save_snapshot(snapshot)
+    return snapshot
+
+
+# Gibt den zuletzt abgefragten Snapshot aus dem Session-Store zurück, sofern er nicht älter als
+# max_age ist, ansonsten None. Der Snapshot kann auch von einem anderen Prozess stammen, der sich
+# dieselbe Sitzung teilt, z.B. vom Bot für den Export.
+def get_shared_snapshot(api: OnVistaApi, max_age: timedelta, now=None):
+    now = now or datetime.now()
+    snapshot = api.load_snapshot()
+    if snapshot is None:
+        return None
+    if now - datetime.fromisoformat(snapshot["timestamp"]) > max_age:
+        return None
+
+    return snapshot
+
+
+# Gibt den neuesten Snapshot zurück: den aus dem Session-Store oder den letzten aus der Historie,
+# je nachdem, welcher neuer ist. Es wird kein Request an die Bank ausgelöst.
+def get_latest_snapshot(api: OnVistaApi, snapshot_store):
+    candidates = [api.load_snapshot(), snapshot_store.latest()]
+    candidates = [snapshot for snapshot in candidates if snapshot]
+    if not candidates:
+        return None
+    return max(candidates, key=lambda snapshot: snapshot["timestamp"])
+
+
+# Die Historie der Snapshots in einer Datei mit einem JSON-Objekt pro Zeile (JSON Lines). Neue
+# Snapshots werden nur angehängt, die Datei muss also nie komplett neu geschrieben werden.
+class SnapshotStore:
+    def __init__(self, file_name):
+        self.file_name = file_name
+
+    # Hängt einen Snapshot an die Historie an.
+    def append(self, snapshot):
+        with open(self.file_name, "a") as snapshots_file:
+            snapshots_file.write(json.dumps(snapshot, separators=(",", ":")) + "\n")
+
+        logger.info(
+            f"Snapshot from {snapshot['timestamp']} written to {self.file_name}"
+        )
+
+    # Hängt einen Snapshot an, sofern er neuer als der neueste der Historie ist. Derselbe Snapshot
+    # kann über den Session-Store mehrfach verwendet werden (siehe get_shared_snapshot()), er soll
+    # aber nur einmal in der Historie landen. Gibt zurück, ob er angehängt wurde.
+    def append_if_new(self, snapshot):
+        latest = self.latest()
+        if latest is not None and latest["timestamp"] >= snapshot["timestamp"]:
+            return False
+
+        self.append(snapshot)
+        return True
+
+    # Gibt alle Snapshots (optional nur im Zeitraum von since bis until, jeweils inklusive, als
+    # ISO-Zeitstempel) in zeitlicher Reihenfolge zurück.
+    def load(self, since=None, until=None):
+        try:
+            snapshots_file = open(self.file_name)
+        except IOError as e:
+            logger.debug(f"No snapshots could be read from {self.file_name}: {e}")
+            return []
+
+        snapshots = []
+        with snapshots_file:
+            for line in snapshots_file:
+                # Eine unvollständige letzte Zeile wird gerade von append() geschrieben (z.B.
+                # während die JSON-API liest) und wird übersprungen.
+                if not line.strip() or not line.endswith("\n"):
+                    continue
+
+                snapshot = json.loads(line)
+                if since and snapshot["timestamp"] < since:
+                    continue
+                if until and snapshot["timestamp"] > until:
+                    continue
+
+                snapshots.append(snapshot)
+
+        return snapshots
+
+    # Gibt den neuesten Snapshot zurück oder None, falls noch keiner gespeichert wurde.
+    def latest(self):
+        snapshots = self.load()
+        return snapshots[-1] if snapshots else None
@@ -0,0 +1,129 @@
+import json
+import sqlite3
+from loguru import logger
+from onvistabank_api.OnVistaApi import OnVistaApi
+
+# Ab diesem Datum wird die Historie beim ersten Abgleich abgefragt.
+INITIAL_SINCE = "2000-01-01"
+
+# Die Arten der Historie, die abgeglichen werden (siehe OnVistaApi.get_history()).
+KINDS = ["transactions", "orders"]
+
+# Orders in diesem Status ändern sich nicht mehr. Alle übrigen (z.B. PENDING) sind noch offen.
+FINAL_ORDER_STATUSES = ["EXECUTED", "CANCELLED", "REJECTED", "EXPIRED"]
+
+
+# Die Transaktions- und Orderhistorie aller Konten in einer lokalen SQLite-Datenbank.
+#
+# Beim Abgleich (sync()) werden nur die Einträge abgefragt, die neuer als der gespeicherte Cursor
+# sind. Der Cursor ist je Konto und Art das Datum des neuesten bekannten Eintrags. Da die API nur
+# nach Tagen filtert, wird ab diesem Tag (inklusive) abgefragt, bereits bekannte Einträge werden
+# anhand ihrer ID übersprungen.
+#
+# Orders können ihren Status noch ändern (z.B. von PENDING zu EXECUTED). Bereits bekannte Orders
+# werden daher aktualisiert statt übersprungen, und der Abgleich beginnt spätestens beim Tag der
+# ältesten noch offenen Order, auch wenn der Cursor schon weiter ist.
+#
+# Gespeichert wird der vollständige Eintrag als JSON, sodass spätere Auswertungen (z.B. die
+# Kostenbasis, siehe cost_basis.py) auch Felder verwenden können, die heute noch nicht
+# benötigt werden.
+class TransactionStore:
+    def __init__(self, file_name):
+        self.file_name = file_name
+
+        with self._connect() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS history (kind TEXT NOT NULL, account_key TEXT NOT NULL, id TEXT NOT NULL, date TEXT NOT NULL, data TEXT NOT NULL, PRIMARY KEY (kind, account_key, id))"
+            )
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS cursors (kind TEXT NOT NULL, account_key TEXT NOT NULL, last_date TEXT NOT NULL, PRIMARY KEY (kind, account_key))"
+            )
+
+    def _connect(self):
+        return sqlite3.connect(self.file_name, timeout=30)
+
+    # Gibt das Datum des neuesten bekannten Eintrags zurück oder None, falls noch nie
+    # abgeglichen wurde.
+    def cursor(self, kind, account_key):
+        with self._connect() as connection:
+            row = connection.execute(
+                "SELECT last_date FROM cursors WHERE kind = ? AND account_key = ?",
+                (kind, account_key),
+            ).fetchone()
+        return row[0] if row else None
+
+    # Gibt das Datum der ältesten noch offenen Order zurück oder None, falls keine offen ist.
+    def oldest_open_order(self, account_key):
+        with self._connect() as connection:
+            row = connection.execute(
+                "SELECT MIN(date) FROM history WHERE kind = 'orders' AND account_key = ? "
+                f"AND json_extract(data, '$.status') NOT IN ({', '.join('?' * len(FINAL_ORDER_STATUSES))})",
+                (account_key, *FINAL_ORDER_STATUSES),
+            ).fetchone()
+        return row[0]
+
+    # Speichert die Einträge einer Art für ein Konto und schiebt den Cursor weiter. Bereits
+    # bekannte Transaktionen bleiben unverändert, bereits bekannte Orders werden aktualisiert. Gibt
+    # die Anzahl der neuen Einträge zurück.
+    def add(self, kind, account_key, entries):
+        if not entries:
+            return 0
+
+        added = 0
+        with self._connect() as connection:
+            for entry in entries:
+                entry_id = str(entry["id"])
+                data = json.dumps(entry)
+                inserted = connection.execute(
+                    "INSERT OR IGNORE INTO history (kind, account_key, id, date, data) VALUES (?, ?, ?, ?, ?)",
+                    (kind, account_key, entry_id, entry["date"], data),
+                ).rowcount
+                added += inserted
+
+                if not inserted and kind == "orders":
+                    connection.execute(
+                        "UPDATE history SET date = ?, data = ? WHERE kind = ? AND account_key = ? AND id = ?",
+                        (entry["date"], data, kind, account_key, entry_id),
+                    )
+
+            connection.execute(
+                "INSERT INTO cursors (kind, account_key, last_date) VALUES (?, ?, ?) "
+                "ON CONFLICT(kind, account_key) DO UPDATE SET last_date = MAX(last_date, excluded.last_date)",
+                (kind, account_key, max(entry["date"] for entry in entries)),
+            )
+
+        return added
+
+    # Gleicht die Historie aller Konten mit der Bank ab. Der Benutzer muss bereits eingeloggt sein.
+    # Gibt je Art die Anzahl der neuen Einträge zurück.
+    def sync(self, api: OnVistaApi):
+        added = {kind: 0 for kind in KINDS}
+
+        for account in api.get_accounts()["accountsList"]:
+            account_key = account["accountKey"]
+            for kind in KINDS:
+                cursor = self.cursor(kind, account_key)
+                since = cursor[:10] if cursor else INITIAL_SINCE
+                if kind == "orders":
+                    oldest_open = self.oldest_open_order(account_key)
+                    if oldest_open:
+                        since = min(since, oldest_open[:10])
+
+                entries = api.get_history(kind, account_key, since)
+                added[kind] += self.add(kind, account_key, entries)
+
+        logger.info(f"History synced to {self.file_name}, new entries: {added}")
+        return added
+
+    # Gibt alle gespeicherten Einträge einer Art (optional nur eines Kontos) in zeitlicher
+    # Reihenfolge zurück.
+    def entries(self, kind, account_key=None):
+        query = "SELECT data FROM history WHERE kind = ?"
+        params = [kind]
+        if account_key is not None:
+            query += " AND account_key = ?"
+            params.append(account_key)
+
+        with self._connect() as connection:
+            rows = connection.execute(query + " ORDER BY date, id", params).fetchall()
+        return [json.loads(row[0]) for row in rows]
@@ -0,0 +1,165 @@
+# Ein Benchmark der HTTP-Transports (siehe onvistabank_api/HttpTransport.py) gegen einen lokalen
+# Ersatz-Server, ganz ohne Zugang zur Bank.
+#
+# Der Ersatz-Server beantwortet jeden Request wie die Webtrading-API mit einer Positionsliste
+# (getPositions) und komprimiert die Antwort mit gzip, falls der Client das anbietet. Für jeden
+# Transport werden die übertragenen Bytes je Antwort, die Latenz je Request und die Anzahl der
+# aufgebauten Verbindungen ausgegeben.
+#
+# Aufruf:
+#
+#   pipenv run python ./src/transport_benchmark.py [Anzahl Requests, Standard 200]
+#
+# HTTP/2 wird nur über TLS ausgehandelt, der lokale Ersatz-Server spricht daher immer HTTP/1.1.
+# Der Vorteil von HTTP/2 (eine Verbindung für alle Requests) zeigt sich erst gegen die Bank.
+
+import gzip
+import json
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+from loguru import logger
+from onvistabank_api.HttpTransport import make_transport
+from onvistabank_api.OnVistaLowLevelApi import OnVistaLowLevelApi
+from onvistabank_api.SessionStore import FileSessionStore
+
+
+# Eine Position, wie sie die Bank zurückgibt (gekürzt, siehe OnVistaLowLevelApi.tradingPositions()).
+def make_position(i):
+    isin = f"DE{i:010d}"
+    return {
+        "symbol": f"{isin}.XETR.EUR",
+        "quantity": 10 + i,
+        "name": f"POSITION {i}",
+        "isin": isin,
+        "wkn": f"A{i:05d}",
+        "type": "ETF",
+        "category": "ETF",
+        "lastValue": 75.12 + i,
+        "buyingValue": 70.123456 + i,
+        "totalValue": 27451.2 + i,
+        "totalPerformance": 2098.8,
+        "performancePercentage": 8.2765432109877,
+        "actualValue": 29550 + i,
+        "dailyTotalPerformance": -25.2,
+        "dailyPerformancePx": -0.085106382978723,
+        "instrument": {
+            "symbol": f"{isin}.XETR.EUR",
+            "label": f"POSITION {i}",
+            "isin": isin,
+            "currency": "EUR",
+            "previousClose": 75.18,
+            "exchangeLabel": "Frankfurt",
+            "tradeDate": "2019-03-07 21:45:31",
+        },
+    }
+
+
+RESULT = {
+    "portfolio": {
+        "positions": [make_position(i) for i in range(30)],
+        "total": {"buyValue": 27451.2, "actualValue": 29550},
+    }
+}
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Header und Body werden getrennt geschrieben, ohne TCP_NODELAY käme jede Antwort erst nach
+    # dem verzögerten ACK des Clients (ca. 40 ms) an.
+    disable_nagle_algorithm = True
+    connections = 0
+    bytes_sent = 0
+
+    def setup(self):
+        super().setup()
+        StandInHandler.connections += 1
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        actions = parse_qs(urlparse(self.path).query)
+        body = json.dumps({key: {"result": RESULT} for key in actions}).encode()
+
+        gzipped = "gzip" in self.headers.get("Accept-Encoding", "")
+        if gzipped:
+            body = gzip.compress(body)
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Set-Cookie", "XSRF-TOKEN=benchmark; Path=/")
+        if gzipped:
+            self.send_header("Content-Encoding", "gzip")
+        self.end_headers()
+        self.wfile.write(body)
+        StandInHandler.bytes_sent += len(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def benchmark(name, transport, requests_count):
+    StandInHandler.connections = 0
+    StandInHandler.bytes_sent = 0
+
+    with tempfile.TemporaryDirectory() as directory:
+        api = OnVistaLowLevelApi(
+            session_store=FileSessionStore(f"{directory}/cookies.txt"),
+            transport=transport,
+        )
+
+        latencies = []
+        for _ in range(requests_count):
+            started_at = time.perf_counter()
+            api.tradingPositions("benchmark")
+            latencies.append(time.perf_counter() - started_at)
+
+    latencies.sort()
+    print(
+        f"{name:32} {StandInHandler.bytes_sent / requests_count:8.0f} B/Antwort "
+        f"{transport.last_response_bytes:8} B (Client) "
+        f"p50 {statistics.median(latencies) * 1000:6.2f} ms "
+        f"p90 {latencies[int(len(latencies) * 0.9)] * 1000:6.2f} ms "
+        f"{StandInHandler.connections:4} Verbindungen"
+    )
+
+
+logger.remove(0)
+logger.add(sys.stderr, level="WARNING")
+
+requests_count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+
+server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+threading.Thread(target=server.serve_forever, daemon=True).start()
+base_url = f"http://127.0.0.1:{server.server_address[1]}/services/api/"
+
+benchmark(
+    "requests, ohne Kompression",
+    make_transport("requests", base_url=base_url, compression=False),
+    requests_count,
+)
+benchmark(
+    "requests, gzip",
+    make_transport("requests", base_url=base_url),
+    requests_count,
+)
+
+try:
+    benchmark(
+        "httpx, gzip",
+        make_transport("httpx", base_url=base_url, http2=False),
+        requests_count,
+    )
+    benchmark(
+        "httpx, gzip, HTTP/2 angefragt",
+        make_transport("httpx", base_url=base_url),
+        requests_count,
+    )
+except ImportError as e:
+    print(f"httpx ist nicht installiert, übersprungen: {e}")
+
+server.shutdown()
@@ -0,0 +1,61 @@
+# Eine Datei zum lokalen Testen des Webhook-Modus ganz ohne Telegram-Server.
+#
+# Es wird ein selbst gebautes Update (eine Textnachricht, z.B. "/portfolio") direkt an den
+# lokal laufenden Webhook-Server des Bots gepostet, inklusive des geheimen Tokens im Header
+# X-Telegram-Bot-Api-Secret-Token. Die Antwort des Bots wird dann ganz normal über die
+# Telegram-API an den angegebenen Chat verschickt.
+#
+# Aufruf (der Bot muss mit WEBHOOK_ENABLED = true laufen):
+#
+#   pipenv run python ./src/webhook_fake_update.py 123456789 /portfolio
+#
+# Mit --wrong-secret wird ein falsches Token geschickt, der Server muss dann mit 403 antworten.
+
+import sys
+import time
+import requests as req
+from loguru import logger
+from config import (
+    get_webhook_listen,
+    get_webhook_port,
+    get_webhook_url_path,
+    get_webhook_secret_token,
+)
+
+
+# Baut ein minimales Update-Objekt, wie es Telegram für eine Textnachricht verschicken würde.
+def make_fake_update(user_id, text):
+    user = {"id": user_id, "is_bot": False, "first_name": "Webhook-Test"}
+    message = {
+        "message_id": 1,
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": user,
+        "text": text,
+    }
+
+    # Befehle müssen als solche markiert werden, damit der CommandHandler sie erkennt.
+    if text.startswith("/"):
+        message["entities"] = [
+            {"type": "bot_command", "offset": 0, "length": len(text.split()[0])}
+        ]
+
+    return {"update_id": int(time.time()), "message": message}
+
+
+user_id = int(sys.argv[1])
+text = sys.argv[2] if len(sys.argv) > 2 else "/portfolio"
+secret_token = get_webhook_secret_token()
+if "--wrong-secret" in sys.argv:
+    secret_token = "wrong-" + secret_token
+
+url = f"http://{get_webhook_listen()}:{get_webhook_port()}/{get_webhook_url_path()}"
+logger.info(f"Posting fake update with text {text} to {url}")
+
+result = req.post(
+    url,
+    json=make_fake_update(user_id, text),
+    headers={"X-Telegram-Bot-Api-Secret-Token": secret_token},
+)
+
+logger.info(f"Response: {result.status_code} {result.text}")